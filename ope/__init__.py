@@ -1 +1 @@
-__all__ = ['opec', 'oracle', 'pope', 'mope', 'ciphers', 'cheater', 'nworacle', 'nwopec']
+__all__ = ['opec', 'oracle', 'pope', 'mope', 'ciphers', 'cheater', 'nworacle', 'nwopec', 'rangecache', 'trace', 'commstats', 'validate']
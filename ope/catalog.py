@@ -0,0 +1,173 @@
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+A POPE server process hosting many named indexes.
+
+A Catalog holds named back-end instances, normally all Pope trees on
+the same (pooled) nworacle.OracleClient. The nwopec protocol's CREATE,
+DROP and SELECT opcodes manage them: each connection starts on the
+default index, and every single operation goes to the index it last
+selected, so existing clients keep working unchanged. The BATCH opcode
+runs a list of inserts, lookups, range searches and size requests on
+any indexes in one round trip.
+
+Each index has its own lock, so that with a threaded server, requests
+on different indexes can run at the same time, while the ones on the
+same index take turns.
+"""
+
+import contextlib
+import pickle
+import socketserver
+import threading
+
+from ope import commstats
+from ope import nwopec
+
+DEFAULT = 'default'
+
+class Catalog:
+    """Named indexes, each made by make_index(name) on creation."""
+
+    def __init__(self, make_index, default=DEFAULT):
+        """If default is not None, an index by that name is created."""
+        self._make = make_index
+        self._lock = threading.Lock()
+        self._indexes = {}
+        if default is not None:
+            self.create(default)
+
+    def create(self, name):
+        """Adds a new index. Returns False if the name is taken."""
+        with self._lock:
+            if name in self._indexes:
+                return False
+            self._indexes[name] = (self._make(name), threading.Lock())
+            return True
+
+    def drop(self, name):
+        """Removes an index. Returns False if there was none."""
+        with self._lock:
+            return self._indexes.pop(name, None) is not None
+
+    def get(self, name):
+        """Returns (index, lock) for the named index, or None."""
+        with self._lock:
+            return self._indexes.get(name)
+
+    def names(self):
+        with self._lock:
+            return sorted(self._indexes)
+
+    def __len__(self):
+        return len(self._indexes)
+
+
+class CatalogHandler(nwopec.PopeHandler):
+    # Note: must have field "catalog" added to point to the Catalog.
+    # The field "serv" is set to the selected index for each request.
+    catalog = None
+
+    def setup(self):
+        self.index_name = DEFAULT
+
+    def serve(self, opcode, sockfile):
+        if opcode in (nwopec.CREATE, nwopec.DROP, nwopec.SELECT):
+            if nwopec.DEBUG: print("Received", nwopec.OP_NAMES[opcode].upper(), "request")
+            self.manage(opcode, sockfile)
+        elif opcode == nwopec.BATCH:
+            if nwopec.DEBUG: print("Received BATCH request")
+            self.batch(sockfile)
+        elif opcode == nwopec.COMPRESS:
+            self.dispatch(opcode, sockfile)
+        else:
+            # look the index up every time, in case it was dropped
+            entry = self.catalog.get(self.index_name)
+            if entry is None:
+                raise RuntimeError("POPE SERVER ERROR: no such index", self.index_name)
+            self.serv, lock = entry
+            with lock:
+                self.dispatch(opcode, sockfile)
+
+    def manage(self, opcode, sockfile):
+        # get the index name
+        name = pickle.load(sockfile)
+
+        if opcode == nwopec.CREATE:
+            res = self.catalog.create(name)
+        elif opcode == nwopec.DROP:
+            res = self.catalog.drop(name)
+        else:
+            res = self.catalog.get(name) is not None
+            if res:
+                self.index_name = name
+
+        pickle.dump(res, sockfile)
+        sockfile.flush()
+
+    def batch(self, sockfile):
+        # get the requests
+        requests = pickle.load(sockfile)
+
+        entries = {}
+        for name in sorted(set(name for name, _, _ in requests)):
+            entries[name] = self.catalog.get(name)
+            if entries[name] is None:
+                raise RuntimeError("POPE SERVER ERROR: no such index", name)
+
+        # lock every index involved, always in the same order
+        res = []
+        with contextlib.ExitStack() as stack:
+            for name in sorted(entries):
+                stack.enter_context(entries[name][1])
+            for name, opcode, args in requests:
+                index = entries[name][0]
+                if opcode == nwopec.INSERT:
+                    res.append(index.insert(*args))
+                elif opcode == nwopec.LOOKUP:
+                    res.append(index.lookup(*args))
+                elif opcode == nwopec.RANGE_SEARCH:
+                    res.append(list(index.range_search(*args)))
+                elif opcode == nwopec.SIZE:
+                    res.append(index.size())
+                else:
+                    raise RuntimeError("POPE SERVER ERROR: invalid opcode in batch", opcode)
+
+        # send back all the results
+        pickle.dump(res, sockfile)
+        sockfile.flush()
+
+    def send_stats(self, sockfile):
+        # read the reset flag
+        reset = pickle.load(sockfile)
+
+        res = {'server': self.stats.snapshot(reset)}
+        if hasattr(self.serv, 'stats'):
+            res['tree'] = self.serv.stats(reset)
+        res['indexes'] = {}
+        for name in self.catalog.names():
+            entry = self.catalog.get(name)
+            if entry is not None:
+                res['indexes'][name] = entry[0].size()
+
+        pickle.dump(res, sockfile)
+        sockfile.flush()
+
+
+def get_catalog_server(the_catalog, hostname, port, threaded=False):
+    """Creates a socketserver to relay requests to the indexes in the
+    given Catalog. If threaded, several connections can be open at once,
+    each in its own thread."""
+    class Handler(CatalogHandler):
+        catalog = the_catalog
+        stats = commstats.CommStats()
+    if threaded:
+        server = socketserver.ThreadingTCPServer((hostname, port), Handler)
+        server.daemon_threads = True
+        return server
+    return socketserver.TCPServer((hostname, port), Handler)
@@ -7,67 +7,204 @@
 
 """
 This is a "cheater" replacement for POPE which just decrypts stuff
-and stores it in unsorted order. Used to check correctness.
+and stores it in a plaintext-ordered index. Used to check correctness,
+and as a lower bound on the cost of any OPE scheme.
 """
 
 import bisect
 import heapq
 import itertools
+import operator
+
+from ope import validate
+
+class SortedChunks:
+    """In-memory ordered index of (key,value) entries by plaintext key.
+
+    Entries are kept in a list of sorted chunks, each with a parallel
+    list of its plaintext keys, plus the largest plaintext key of every
+    chunk. A single insert costs a bisect in the chunk maxima, a bisect
+    in one chunk and a list insert of at most 2*load entries. Entries
+    with equal plaintext keys stay in insertion order.
+    """
+
+    def __init__(self, load=1000):
+        self.load = load
+        self.clear()
+
+    def clear(self):
+        self._chunks = []
+        self._ukeys = []
+        self._maxes = []
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def insert(self, ukey, entry):
+        """Adds entry, with plaintext key ukey."""
+        if not self._chunks:
+            self._chunks.append([entry])
+            self._ukeys.append([ukey])
+            self._maxes.append(ukey)
+        else:
+            ci = bisect.bisect_right(self._maxes, ukey)
+            if ci == len(self._maxes):
+                ci -= 1
+                self._maxes[ci] = ukey
+            ukeys = self._ukeys[ci]
+            ind = bisect.bisect_right(ukeys, ukey)
+            ukeys.insert(ind, ukey)
+            self._chunks[ci].insert(ind, entry)
+            if len(ukeys) > 2 * self.load:
+                self._split(ci)
+        self._len += 1
+
+    def insert_many(self, pairs):
+        """Adds all the (ukey, entry) pairs.
+
+        A batch that is large compared to the index is sorted and merged
+        with everything in one pass; a small one is inserted one by one.
+        """
+        pairs = list(pairs)
+        if len(pairs) * 4 < self._len:
+            for ukey, entry in pairs:
+                self.insert(ukey, entry)
+            return
+        pairs.sort(key=operator.itemgetter(0))
+        merged = list(heapq.merge(self.items(), pairs, key=operator.itemgetter(0)))
+        self.clear()
+        for start in range(0, len(merged), self.load):
+            chunk = merged[start:start+self.load]
+            self._ukeys.append([ukey for ukey, _ in chunk])
+            self._chunks.append([entry for _, entry in chunk])
+            self._maxes.append(chunk[-1][0])
+        self._len = len(merged)
+
+    def _split(self, ci):
+        ukeys, chunk = self._ukeys[ci], self._chunks[ci]
+        half = len(ukeys) // 2
+        self._ukeys[ci+1:ci+1] = [ukeys[half:]]
+        self._chunks[ci+1:ci+1] = [chunk[half:]]
+        del ukeys[half:]
+        del chunk[half:]
+        self._maxes[ci:ci+1] = [ukeys[-1], self._ukeys[ci+1][-1]]
+
+    def _locate(self, ukey):
+        """Returns (chunk, index) of the first entry with plaintext key
+        at least ukey."""
+        ci = bisect.bisect_left(self._maxes, ukey)
+        if ci == len(self._maxes):
+            return ci, 0
+        return ci, bisect.bisect_left(self._ukeys[ci], ukey)
+
+    def first(self, ukey):
+        """Returns the first entry with plaintext key ukey, or None."""
+        ci, ind = self._locate(ukey)
+        if ci < len(self._chunks) and self._ukeys[ci][ind] == ukey:
+            return self._chunks[ci][ind]
+        return None
+
+    def range(self, ukey1, ukey2):
+        """Iterates over the entries with ukey1 <= plaintext key < ukey2."""
+        ci, ind = self._locate(ukey1)
+        while ci < len(self._chunks):
+            ukeys, chunk = self._ukeys[ci], self._chunks[ci]
+            stop = bisect.bisect_left(ukeys, ukey2, ind)
+            for entry in itertools.islice(chunk, ind, stop):
+                yield entry
+            if stop < len(ukeys):
+                return
+            ci, ind = ci + 1, 0
+
+    def at(self, index):
+        """Returns the (ukey, entry) pair with the given rank, from 0."""
+        if not 0 <= index < self._len:
+            raise IndexError("SortedChunks index out of range")
+        for ukeys, chunk in zip(self._ukeys, self._chunks):
+            if index < len(chunk):
+                return ukeys[index], chunk[index]
+            index -= len(chunk)
+
+    def items(self):
+        """Iterates over all (ukey, entry) pairs in order."""
+        for ukeys, chunk in zip(self._ukeys, self._chunks):
+            for pair in zip(ukeys, chunk):
+                yield pair
+
+    def check(self):
+        assert len(self._chunks) == len(self._ukeys) == len(self._maxes)
+        assert sum(len(chunk) for chunk in self._chunks) == self._len
+        prev = None
+        for ukeys, chunk, mx in zip(self._ukeys, self._chunks, self._maxes):
+            assert 1 <= len(ukeys) == len(chunk) <= 2 * self.load
+            assert mx == ukeys[-1]
+            assert prev is None or prev <= ukeys[0]
+            assert all(ukeys[i] <= ukeys[i+1] for i in range(len(ukeys)-1))
+            prev = mx
+
 
 class Cheater:
     noop = False # set to true to make all operations do nothing
 
-    def __init__(self, oracle):
-        self.slst = []
-        self.ulst = []
+    def __init__(self, oracle, validation=None):
+        """validation is a level from the validate module, or a Validator."""
+        self._index = SortedChunks()
         self._cmp = oracle
         self.crypt = oracle.crypt
-        self.sampval = None
+        self._valid = validate.get_validator(validation, oracle)
 
     def insert(self, key, val):
         if self.noop:
             return
         ukey = self.crypt.decode(key)
-        self.ulst.append((ukey,key,val))
-        if not self.sampval:
-            self.sampval = type(val)()
+        self._index.insert(ukey, (key,val))
+        self._valid.touch((ukey,key,val))
+        self._valid.done(self)
+
+    def insert_many(self, items):
+        """Inserts all the (key,value) pairs in items at once."""
+        if self.noop:
+            return
+        pairs = [(self.crypt.decode(key), (key,val)) for key, val in items]
+        self._index.insert_many(pairs)
+        for ukey, (key, val) in pairs:
+            self._valid.touch((ukey,key,val))
+        self._valid.done(self)
 
     def lookup(self, key):
         if self.noop:
             return None
-        ukey = self.crypt.decode(key)
-        if self.ulst:
-            self.ulst.sort()
-            self.slst = list(heapq.merge(self.slst, self.ulst))
-            self.ulst = []
-        ind = bisect.bisect_left(self.slst, (ukey,key,self.sampval))
-        if ind < len(self.slst) and self.slst[ind][0] == ukey:
-            return self.slst[ind][2]
-        else:
-            return None
+        entry = self._index.first(self.crypt.decode(key))
+        self._valid.done(self)
+        return None if entry is None else entry[1]
 
     def range_search(self, key1, key2):
+        """Returns the (key,value) pairs with key1 <= key < key2."""
         if self.noop:
             return ()
         uk1 = self.crypt.decode(key1)
         uk2 = self.crypt.decode(key2)
-        if self.ulst:
-            self.ulst.sort()
-            self.slst = list(heapq.merge(self.slst, self.ulst))
-            self.ulst = []
-        ind1 = bisect.bisect_left(self.slst, (uk1,key1,self.sampval))
-        ind2 = bisect.bisect_right(self.slst, (uk2,key2,self.sampval))
-        return ((k,v) for (uk,k,v) in itertools.islice(self.slst, ind1, ind2))
+        self._valid.done(self)
+        return self._index.range(uk1, uk2)
 
     def size(self):
-        return len(self.slst) + len(self.ulst)
+        return len(self._index)
 
     def traverse(self):
-        for (ukey, key, val) in self.slst:
-            yield (key,val)
-        for (ukey, key, val) in self.ulst:
-            yield (key,val)
+        for ukey, key_value in self._index.items():
+            yield key_value
 
     def check(self, full=False, info=False):
         if info:
             print("Cheater size is", self.size())
+        self._index.check()
+        if full:
+            for ukey, (key, val) in self._index.items():
+                self.check_node((ukey,key,val), full)
+
+    def check_node(self, entry, full=False):
+        """Checks one (ukey, key, value) entry. Used by validate.Validator."""
+        assert len(entry) == 3
+        if full:
+            assert self.crypt.decode(entry[1]) == entry[0]
@@ -0,0 +1,209 @@
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+Brings up a whole networked OPE setup with a single call.
+
+A Cluster starts one comparison oracle server and one or more POPE or
+mOPE servers, all on ephemeral localhost ports, either in threads of
+this process or in child processes. Each back-end server gets its own
+connection to the oracle, and one NwOpeClient is opened to each
+back-end. Stats are gathered from every component with the STATS
+opcodes, and stop() shuts everything down, in reverse order.
+
+    with Cluster(crypt, 50, ['pope', 'mope']) as clu:
+        for client in clu.clients:
+            client.insert('hello', 'world')
+        print(clu.stats())
+"""
+
+import multiprocessing
+import pickle
+import socket
+import threading
+
+from ope import nworacle
+from ope import nwopec
+from ope import compress
+from ope.oracle import Oracle
+from ope.pope import Pope
+from ope.mope import Mope
+
+# back-ends that can run without the decryption key
+ENGINES = {'pope': Pope, 'mope': Mope}
+
+def remote_stats(address, opcode, reset=False):
+    """Sends one STATS request to the server at address, on a fresh
+    connection, and returns the reply."""
+    with socket.create_connection(address) as conn:
+        with conn.makefile('rwb') as sockfile:
+            sockfile.write(opcode)
+            pickle.dump(reset, sockfile)
+            sockfile.flush()
+            return pickle.load(sockfile)
+
+
+def oracle_server(crypt, L):
+    """Returns a threaded oracle server and the things to close after it."""
+    orc = Oracle(crypt, L)
+    return nworacle.get_oracle_server(orc, 'localhost', 0, threaded=True), []
+
+def backend_server(engine, oracle_address, codec=None, threshold=compress.DEFAULT_THRESHOLD):
+    """Returns a threaded back-end server, connected to the oracle, and
+    the things to close after it."""
+    orc = nworacle.OracleClient(*oracle_address, codec=codec, threshold=threshold)
+    orc.open()
+    serv = ENGINES[engine](orc)
+    return nwopec.get_pope_server(serv, 'localhost', 0, threaded=True), [orc]
+
+
+class ThreadComponent:
+    """A server running in a thread of this process."""
+
+    def __init__(self, make, *args):
+        self.server, self._closers = make(*args)
+        self.address = self.server.server_address[:2]
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self._thread.join()
+        self.server.server_close()
+        for obj in self._closers:
+            obj.close()
+
+
+def _child_main(make, args, conn):
+    """Runs in a child process until the parent says to stop."""
+    comp = ThreadComponent(make, *args)
+    conn.send(comp.address)
+    conn.recv()
+    comp.stop()
+    conn.send(None)
+    conn.close()
+
+class ProcessComponent:
+    """A server running in a child process. The child is forked, so the
+    cipher and everything else need not be picklable."""
+
+    def __init__(self, make, *args):
+        ctx = multiprocessing.get_context('fork')
+        self._conn, child = ctx.Pipe()
+        self._proc = ctx.Process(target=_child_main, args=(make, args, child), daemon=True)
+        self._proc.start()
+        child.close()
+        self.address = self._conn.recv()
+
+    def stop(self, timeout=5):
+        try:
+            self._conn.send(None)
+            if self._conn.poll(timeout):
+                self._conn.recv()
+        except (EOFError, OSError):
+            pass
+        self._proc.join(timeout)
+        if self._proc.is_alive():
+            self._proc.terminate()
+            self._proc.join()
+        self._conn.close()
+
+
+class Cluster:
+    """An oracle server, back-end servers and one client per back-end.
+    Use as a context manager, or call start() and stop().
+    """
+
+    def __init__(self, crypt, L, engines=('pope',), processes=False, debug=False,
+                 codec=None, threshold=compress.DEFAULT_THRESHOLD):
+        """crypt is the cipher used by the oracle and the clients, and L
+        the oracle's local storage size. engines names one back-end
+        server to start for each entry (see ENGINES). If processes is
+        True, each server runs in its own child process instead of a
+        thread. debug turns on the servers' DEBUG printing. codec and
+        threshold turn on compression for every connection (see the
+        compress module).
+        """
+        for engine in engines:
+            assert engine in ENGINES
+        self.crypt = crypt
+        self.L = L
+        self.engines = list(engines)
+        self.debug = debug
+        self.codec = codec
+        self.threshold = threshold
+        self._make = ProcessComponent if processes else ThreadComponent
+        self.oracle = None
+        self.backends = []
+        self.clients = []
+
+    def start(self):
+        """Starts every server and opens the clients."""
+        nworacle.DEBUG = nwopec.DEBUG = self.debug
+        try:
+            self.oracle = self._make(oracle_server, self.crypt, self.L)
+            for engine in self.engines:
+                self.backends.append(
+                    self._make(backend_server, engine, self.oracle.address,
+                               self.codec, self.threshold))
+            for backend in self.backends:
+                client = nwopec.NwOpeClient(*backend.address, self.crypt,
+                                            codec=self.codec, threshold=self.threshold)
+                client.open()
+                self.clients.append(client)
+        except:
+            self.stop()
+            raise
+        return self
+
+    def run(self, scenario):
+        """Calls scenario(clients) and returns what it returns along with
+        the stats gathered afterwards, as a pair."""
+        res = scenario(self.clients)
+        return res, self.stats()
+
+    def stats(self, reset=False):
+        """Gathers the counters of every component.
+
+        The result has the oracle server's STATS reply under 'oracle',
+        a list of the back-end servers' STATS replies under 'backends'
+        (with the engine name added), and a list of the clients' own
+        byte counts under 'clients'. The STATS requests themselves are
+        counted by each server under the 'stats' operation.
+        """
+        res = {
+            'oracle': remote_stats(self.oracle.address, nworacle.STATS, reset),
+            'backends': [],
+            'clients': [client.comm_stats(reset) for client in self.clients],
+        }
+        for engine, backend in zip(self.engines, self.backends):
+            bstats = remote_stats(backend.address, nwopec.STATS, reset)
+            bstats['engine'] = engine
+            res['backends'].append(bstats)
+        return res
+
+    def stop(self):
+        """Closes the clients and stops every server, back-ends first."""
+        while self.clients:
+            client = self.clients.pop()
+            try:
+                # wait for any request still in flight to be answered
+                client.size()
+            except (OSError, EOFError):
+                pass
+            client.close()
+        while self.backends:
+            self.backends.pop().stop()
+        if self.oracle:
+            self.oracle.stop()
+            self.oracle = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
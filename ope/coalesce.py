@@ -0,0 +1,221 @@
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+Coalescing of concurrent queries in a POPE server.
+
+Every lookup or range search splits its keys down from the root, with
+one oracle round for each node on the way. When many clients query at
+once, their splits go through the same root and upper nodes, so doing
+them together (see Pope.search_many) saves those rounds.
+
+A Coalescer collects the queries that arrive within a short window, up
+to L keys' worth, and runs them as one batch. The first waiting query
+leads: it waits out the window (or until the batch is full), runs the
+batch under the server's lock, and hands every query in it its result.
+Meanwhile the next query to arrive can already start gathering the
+next batch.
+
+get_coalescing_server() makes a threaded POPE server whose LOOKUP and
+RANGE_SEARCH requests go through a Coalescer. Its STATS reply has the
+coalescer's counters under 'coalesce'.
+"""
+
+import pickle
+import socketserver
+import threading
+import time
+
+from ope import commstats
+from ope import nwopec
+from ope import trace
+
+DEFAULT_WINDOW = 0.002 # seconds
+
+class Pending:
+    """One query waiting in a Coalescer."""
+
+    def __init__(self, query):
+        self.query = query
+        self.keys = len(query) - 1
+        self.arrived = time.perf_counter()
+        self.taken = False
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+class Coalescer:
+    """Runs queries on a Pope in batches, gathered over a window."""
+
+    def __init__(self, serv, lock, window=DEFAULT_WINDOW, max_keys=None):
+        """serv is the Pope, and lock the lock that its other users
+        take. A batch is run window seconds after its first query
+        arrived, or as soon as it has max_keys keys (the oracle's L by
+        default)."""
+        self.serv = serv
+        self.lock = lock
+        self.window = window
+        self.max_keys = serv._tsize if max_keys is None else max_keys
+        self._cond = threading.Condition()
+        self._queue = []
+        self._queued_keys = 0
+        self._leading = False
+        self._reset_counts()
+
+    def _reset_counts(self):
+        self.batches = 0
+        self.queries = 0
+        self.keys = 0
+        self.largest = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def lookup(self, key):
+        return self.submit(('lookup', key))
+
+    def range_search(self, key1, key2):
+        return self.submit(('range_search', key1, key2))
+
+    def submit(self, query):
+        """Queues one query for Pope.search_many, waits for its batch to
+        run, and returns its result."""
+        entry = Pending(query)
+        with self._cond:
+            self._queue.append(entry)
+            self._queued_keys += entry.keys
+            self._cond.notify_all()
+        while True:
+            batch = self._next_batch(entry)
+            if batch is None:
+                break
+            self._run(batch)
+        if entry.error is not None:
+            raise entry.error
+        return entry.result
+
+    def _next_batch(self, entry):
+        """Waits until entry is answered, and returns None, or until
+        no one else is gathering a batch while entry is still queued,
+        and returns the batch this thread gathered."""
+        with self._cond:
+            while not entry.done and (entry.taken or self._leading):
+                self._cond.wait()
+            if entry.done:
+                return None
+            self._leading = True
+            try:
+                deadline = self._queue[0].arrived + self.window
+                while self._queued_keys < self.max_keys:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = []
+                keys = 0
+                while self._queue and (not batch or
+                                       keys + self._queue[0].keys <= self.max_keys):
+                    pending = self._queue.pop(0)
+                    pending.taken = True
+                    keys += pending.keys
+                    batch.append(pending)
+                self._queued_keys -= keys
+                return batch
+            finally:
+                self._leading = False
+                self._cond.notify_all()
+
+    def _run(self, batch):
+        """Runs a gathered batch and hands out the results."""
+        with trace.span('coalesce.batch'), self.lock:
+            began = time.perf_counter()
+            try:
+                results = self.serv.search_many([pending.query for pending in batch])
+                error = None
+            except Exception as e:
+                results = [None] * len(batch)
+                error = e
+        with self._cond:
+            self.batches += 1
+            self.queries += len(batch)
+            self.keys += sum(pending.keys for pending in batch)
+            self.largest = max(self.largest, len(batch))
+            for pending, res in zip(batch, results):
+                wait = began - pending.arrived
+                self.wait_time += wait
+                self.max_wait = max(self.max_wait, wait)
+                pending.result = res
+                pending.error = error
+                pending.done = True
+            self._cond.notify_all()
+
+    def stats(self, reset=False):
+        """Returns a dictionary with the batches run, the queries and
+        keys in them, the largest batch, the splits saved by running
+        queries together (queries minus batches, which is not the number
+        of oracle rounds saved), and the time queries
+        spent queued before their batch started (total, mean and
+        worst)."""
+        with self._cond:
+            res = {
+                'window': self.window,
+                'max_keys': self.max_keys,
+                'batches': self.batches,
+                'queries': self.queries,
+                'keys': self.keys,
+                'largest': self.largest,
+                'splits_saved': self.queries - self.batches,
+                'wait_seconds': self.wait_time,
+                'mean_wait_seconds': self.wait_time / self.queries if self.queries else 0.0,
+                'max_wait_seconds': self.max_wait,
+            }
+            if reset:
+                self._reset_counts()
+        return res
+
+
+class CoalescingHandler(nwopec.PopeHandler):
+    # Note: must have fields "coalescer" and "lock" added, besides "serv".
+    coalescer = None
+
+    def serve(self, opcode, sockfile):
+        if opcode == nwopec.LOOKUP:
+            if nwopec.DEBUG: print("Received LOOKUP request (coalesced)")
+            key = pickle.load(sockfile)
+            pickle.dump(self.coalescer.lookup(key), sockfile)
+            sockfile.flush()
+        elif opcode == nwopec.RANGE_SEARCH:
+            if nwopec.DEBUG: print("Received RANGE_SEARCH request (coalesced)")
+            key1 = pickle.load(sockfile)
+            key2 = pickle.load(sockfile)
+            self.send_all(sockfile, self.coalescer.range_search(key1, key2))
+        else:
+            super().serve(opcode, sockfile)
+
+    def send_stats(self, sockfile):
+        # read the reset flag
+        reset = pickle.load(sockfile)
+
+        res = {'server': self.stats.snapshot(reset),
+               'tree': self.serv.stats(reset)}
+        res['coalesce'] = self.coalescer.stats(reset)
+
+        pickle.dump(res, sockfile)
+        sockfile.flush()
+
+
+def get_coalescing_server(the_pope, hostname, port, window=DEFAULT_WINDOW, max_keys=None):
+    """Creates a threaded socketserver for the given Pope, which runs
+    concurrent lookups and range searches together in batches."""
+    class Handler(CoalescingHandler):
+        serv = the_pope
+        stats = commstats.CommStats()
+        lock = threading.Lock()
+        coalescer = Coalescer(the_pope, lock, window, max_keys)
+    server = socketserver.ThreadingTCPServer((hostname, port), Handler)
+    server.daemon_threads = True
+    return server
@@ -0,0 +1,213 @@
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+Byte-level communication accounting.
+
+CommStats keeps byte counts per operation and direction, along with the
+number of round trips and the time spent blocked on the socket, and the
+sizes of compressed frames (see the compress module) before and after
+compression.
+CountingFile wraps a socket file so that everything read or written
+through it is counted.
+"""
+
+import threading
+import time
+
+SENT = 'sent'
+RECEIVED = 'received'
+
+class CommStats:
+    """Communication counters, safe to share between threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Sets all counters back to zero."""
+        with self._lock:
+            self._bytes = {}
+            self._requests = {}
+            self._round_trips = 0
+            self._blocked = 0.0
+            self._frames = {SENT: [0, 0], RECEIVED: [0, 0]}
+
+    def add_bytes(self, op, direction, nbytes):
+        """Counts nbytes sent or received for the given operation."""
+        with self._lock:
+            counts = self._bytes.get(op)
+            if counts is None:
+                counts = self._bytes[op] = {SENT: 0, RECEIVED: 0}
+            counts[direction] += nbytes
+
+    def add_request(self, op):
+        """Counts one request (one opcode) for the given operation."""
+        with self._lock:
+            self._requests[op] = self._requests.get(op, 0) + 1
+
+    def add_round_trip(self):
+        with self._lock:
+            self._round_trips += 1
+
+    def add_blocked(self, seconds):
+        with self._lock:
+            self._blocked += seconds
+
+    def add_frame(self, direction, raw, wire):
+        """Counts one frame of raw bytes, which took wire bytes to send."""
+        with self._lock:
+            counts = self._frames[direction]
+            counts[0] += raw
+            counts[1] += wire
+
+    def merge(self, other):
+        """Adds all the counts from a snapshot() of another CommStats."""
+        with self._lock:
+            for op, counts in other['bytes'].items():
+                mine = self._bytes.setdefault(op, {SENT: 0, RECEIVED: 0})
+                for direction, n in counts.items():
+                    mine[direction] += n
+            for op, n in other['requests'].items():
+                self._requests[op] = self._requests.get(op, 0) + n
+            self._round_trips += other['round_trips']
+            self._blocked += other['blocked_seconds']
+            for direction, counts in other.get('frames', {}).items():
+                self._frames[direction][0] += counts['raw']
+                self._frames[direction][1] += counts['wire']
+
+    def snapshot(self, reset=False):
+        """Returns all counts in a dictionary of plain Python types.
+
+        Frame sizes are under 'frames', per direction, and
+        'compression_ratio' is the total raw size of all frames over
+        their size on the wire (1.0 if there were none).
+        """
+        with self._lock:
+            raw = sum(c[0] for c in self._frames.values())
+            wire = sum(c[1] for c in self._frames.values())
+            res = {
+                'bytes': {op: dict(counts) for op, counts in self._bytes.items()},
+                'requests': dict(self._requests),
+                'round_trips': self._round_trips,
+                'blocked_seconds': self._blocked,
+                SENT: sum(c[SENT] for c in self._bytes.values()),
+                RECEIVED: sum(c[RECEIVED] for c in self._bytes.values()),
+                'frames': {direction: {'raw': c[0], 'wire': c[1]}
+                           for direction, c in self._frames.items()},
+                'compression_ratio': raw / wire if wire else 1.0,
+            }
+        if reset:
+            self.reset()
+        return res
+
+    def summary(self, reset=False):
+        """Prints the counts nicely."""
+        snap = self.snapshot(reset)
+        print("Sent {} bytes and received {} bytes over {} round trips, blocked {:.3f} seconds."
+            .format(snap[SENT], snap[RECEIVED], snap['round_trips'],
+                    snap['blocked_seconds']))
+        if any(c['wire'] for c in snap['frames'].values()):
+            print("Compressed frames: {:.2f} times smaller on the wire."
+                .format(snap['compression_ratio']))
+        for op in sorted(snap['bytes']):
+            counts = snap['bytes'][op]
+            print("    {:<16} {:>8} requests {:>12} sent {:>12} received".format(
+                op, snap['requests'].get(op, 0), counts[SENT], counts[RECEIVED]))
+
+
+class CountingFile:
+    """Wraps a binary file (like from socket.makefile('rwb')) to count
+    every byte that goes through it in a CommStats.
+
+    Bytes are charged to the current value of op. Bytes read while op is
+    None (like an incoming opcode) are charged to the next op that is set.
+    A round trip is counted every time a read follows a flush that
+    actually sent something. Time spent reading while op is None is
+    idle time (waiting for a request), not blocked time.
+    """
+
+    def __init__(self, raw, stats):
+        self.raw = raw
+        self.stats = stats
+        self._op = None
+        self._unclaimed = 0
+        self._unflushed = 0
+        self._awaiting = False
+
+    @property
+    def op(self):
+        return self._op
+
+    @op.setter
+    def op(self, name):
+        self._op = name
+        if name is not None:
+            self.stats.add_request(name)
+            if self._unclaimed:
+                self.stats.add_bytes(name, RECEIVED, self._unclaimed)
+                self._unclaimed = 0
+
+    def _blocked(self, start):
+        if self._op is not None:
+            self.stats.add_blocked(time.perf_counter() - start)
+
+    def _received(self, nbytes):
+        if self._awaiting:
+            self.stats.add_round_trip()
+            self._awaiting = False
+        if self._op is None:
+            self._unclaimed += nbytes
+        else:
+            self.stats.add_bytes(self._op, RECEIVED, nbytes)
+
+    def read(self, n=-1):
+        start = time.perf_counter()
+        data = self.raw.read(n)
+        self._blocked(start)
+        self._received(len(data))
+        return data
+
+    def readline(self, limit=-1):
+        start = time.perf_counter()
+        data = self.raw.readline(limit)
+        self._blocked(start)
+        self._received(len(data))
+        return data
+
+    def readinto(self, buf):
+        start = time.perf_counter()
+        n = self.raw.readinto(buf)
+        self._blocked(start)
+        self._received(n or 0)
+        return n
+
+    def write(self, data):
+        n = self.raw.write(data)
+        nbytes = len(data) if n is None else n
+        self.stats.add_bytes('other' if self._op is None else self._op,
+                             SENT, nbytes)
+        self._unflushed += nbytes
+        return n
+
+    def flush(self):
+        start = time.perf_counter()
+        self.raw.flush()
+        self._blocked(start)
+        if self._unflushed:
+            self._awaiting = True
+            self._unflushed = 0
+
+    def close(self):
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, v, r):
+        self.close()
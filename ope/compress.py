@@ -0,0 +1,175 @@
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+Optional per-frame compression for the nworacle and nwopec protocols.
+
+A FramedFile wraps a socket file (normally a commstats.CountingFile,
+so that the counts are of the bytes actually on the wire). It passes
+everything straight through until compression is negotiated with the
+COMPRESS opcode of either protocol: the client sends the algorithm name
+and a size threshold, the server answers whether it accepts, and from
+then on both sides send whatever is written between two flushes as one
+frame. A frame is a flag byte and a 4-byte length followed by the
+payload, which is compressed if it is at least threshold bytes long
+and compression actually makes it smaller.
+"""
+
+import pickle
+import struct
+import zlib
+
+from ope import commstats
+
+# algorithm name -> (compress, decompress)
+CODECS = {'zlib': (zlib.compress, zlib.decompress)}
+try:
+    import bz2
+    CODECS['bz2'] = (bz2.compress, bz2.decompress)
+except ImportError:
+    pass
+try:
+    import lzma
+    CODECS['lzma'] = (lzma.compress, lzma.decompress)
+except ImportError:
+    pass
+
+DEFAULT_THRESHOLD = 512
+
+FRAME = struct.Struct('>BI')
+STORED = 0
+PACKED = 1
+
+class FramedFile:
+    """Wraps a binary file to send and receive compressed frames, once
+    enable() has been called. Frame sizes before and after compression
+    are counted in stats (a commstats.CommStats), if given.
+    """
+
+    def __init__(self, inner, stats=None):
+        self.inner = inner
+        self.stats = stats
+        self.codec = None
+        self.threshold = DEFAULT_THRESHOLD
+        self._wbuf = []
+        self._rbuf = b''
+        self._rpos = 0
+
+    def enable(self, codec, threshold=DEFAULT_THRESHOLD):
+        """Starts framing with the given algorithm from CODECS."""
+        assert codec in CODECS and not self._wbuf
+        self.codec = codec
+        self.threshold = threshold
+        self._compress, self._decompress = CODECS[codec]
+
+    @property
+    def op(self):
+        return self.inner.op
+
+    @op.setter
+    def op(self, name):
+        self.inner.op = name
+
+    def write(self, data):
+        if self.codec is None:
+            return self.inner.write(data)
+        self._wbuf.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        if self._wbuf:
+            data = b''.join(self._wbuf)
+            self._wbuf = []
+            flag, payload = STORED, data
+            if len(data) >= self.threshold:
+                packed = self._compress(data)
+                if len(packed) < len(data):
+                    flag, payload = PACKED, packed
+            self.inner.write(FRAME.pack(flag, len(payload)))
+            self.inner.write(payload)
+            if self.stats is not None:
+                self.stats.add_frame(commstats.SENT, len(data), FRAME.size + len(payload))
+        self.inner.flush()
+
+    def _fill(self):
+        """Reads one more frame into the buffer. False at end of file."""
+        header = self.inner.read(FRAME.size)
+        if len(header) < FRAME.size:
+            return False
+        flag, size = FRAME.unpack(header)
+        payload = self.inner.read(size)
+        if len(payload) < size:
+            return False
+        data = self._decompress(payload) if flag == PACKED else payload
+        if self.stats is not None:
+            self.stats.add_frame(commstats.RECEIVED, len(data), FRAME.size + size)
+        self._rbuf = self._rbuf[self._rpos:] + data
+        self._rpos = 0
+        return True
+
+    def read(self, n=-1):
+        if self.codec is None:
+            return self.inner.read(n)
+        if n is None or n < 0:
+            while self._fill():
+                pass
+            n = len(self._rbuf) - self._rpos
+        while len(self._rbuf) - self._rpos < n and self._fill():
+            pass
+        data = self._rbuf[self._rpos:self._rpos+n]
+        self._rpos += len(data)
+        return data
+
+    def readline(self, limit=-1):
+        if self.codec is None:
+            return self.inner.readline(limit)
+        while True:
+            end = self._rbuf.find(b'\n', self._rpos)
+            if end >= 0 or not self._fill():
+                break
+        size = len(self._rbuf) - self._rpos if end < 0 else end + 1 - self._rpos
+        if limit is not None and limit >= 0:
+            size = min(size, limit)
+        return self.read(size)
+
+    def readinto(self, buf):
+        if self.codec is None:
+            return self.inner.readinto(buf)
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.inner.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, v, r):
+        self.close()
+
+
+def request(sockfile, opcode, codec, threshold=DEFAULT_THRESHOLD):
+    """Client side of the negotiation on a FramedFile, sending the
+    protocol's COMPRESS opcode. Returns whether the server agreed;
+    if not, the connection stays uncompressed."""
+    sockfile.write(opcode)
+    pickle.dump((codec, threshold), sockfile)
+    sockfile.flush()
+    accepted = pickle.load(sockfile)
+    if accepted:
+        sockfile.enable(codec, threshold)
+    return accepted
+
+def accept(sockfile):
+    """Server side of the negotiation, after the COMPRESS opcode."""
+    codec, threshold = pickle.load(sockfile)
+    accepted = codec in CODECS and sockfile.codec is None
+    pickle.dump(accepted, sockfile)
+    sockfile.flush()
+    if accepted:
+        sockfile.enable(codec, threshold)
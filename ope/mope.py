@@ -12,20 +12,43 @@ Encoding". 2013 IEEE Symposium of Security and Privacy,
 https://eprint.iacr.org/2013/129
 """
 
-import bisect
 import collections
 
+from ope import validate
+
 class Mope:
-    def __init__(self, oracle):
-        self._tree = LeafNode(self, [], [])
+    """The mOPE tree, which also stores the data.
+
+    Every node keeps, next to each key and its encoding, the list of
+    (key,value) pairs inserted under that encoding, and the number of
+    encodings in its subtree. So rank lookups and range searches walk
+    down one path, and an insert touches only the nodes whose encodings
+    actually change.
+
+    Encodings are integers: the key at index j of a node is encoded as
+    node.base + (j+1)*node.scale, where the scale of a node at height h
+    is (fanout+2)**h. When a subtree moves, all its encodings are
+    shifted by the same amount.
+    """
+
+    def __init__(self, oracle, fanout=None, validation=None):
+        """fanout is the most keys in any node, and defaults to the
+        oracle's max_size so that every find() uses a full haystack.
+
+        validation is a level from the validate module, or a Validator.
+        """
         self._cmp = oracle
-        self._encodings = []
-        self._data = collections.defaultdict(lambda: [])
+        self._valid = validate.get_validator(validation, oracle)
+        self.maxlen = oracle.max_size if fanout is None else fanout
+        assert 2 <= self.maxlen <= oracle.max_size
+        self.radix = self.maxlen + 2
+        self._tree = LeafNode(self, [], [], [])
+        self._size = 0
 
     def clear(self):
-        self._tree = LeafNode(self, [], [])
-        self._encodings = []
-        self._data = collections.defaultdict(lambda: [])
+        self._valid.reset()
+        self._tree = LeafNode(self, [], [], [])
+        self._size = 0
 
     def encode(self, key, insert):
         """Does the OPE encoding of the given ciphertext.
@@ -33,109 +56,160 @@ class Mope:
         insert is True if the key should actually be inserted
         if not found. Otherwise the successor encryption will be
         returned.
+
+        Returned is (encoding, rank, found), where rank is the number
+        of smaller encodings.
         """
-        if __debug__: self.check()
-        updates = []
-        restup, found = self._tree.encode(key, insert, updates)
-        res = self._tuptoval(restup)
-        if insert and not found:
-            upencs = [(self._tuptoval(oldtup), self._tuptoval(newtup))
-                      for (oldtup,newtup) in updates]
-            upinds = [bisect.bisect_left(self._encodings, old)
-                      for (old, _) in upencs]
-            updata = []
-            for upind, (old, new) in zip(upinds, upencs):
-                assert upind < len(self._encodings)
-                assert self._encodings[upind] == old
-                self._encodings[upind] = new
-                updata.append((new, self._data[old]))
-                del self._data[old]
-            for new, val in updata:
-                self._data[new] = val
-            ind = bisect.bisect_left(self._encodings, res)
-            assert ind == len(self._encodings) or self._encodings[ind] != res
-            self._encodings.insert(ind, res)
-            assert self._encodings == sorted(self._encodings)
-        else:
-            ind = bisect.bisect_left(self._encodings, res)
-            assert not updates
-            assert not found or self._encodings[ind] == res
-        if __debug__: self.check(False, False, res if insert else None)
+        res, ind, found, _ = self._encode(key, insert)
+        self._valid.done(self)
         return res, ind, found
 
+    def _encode(self, key, insert):
+        """Like encode(), but also returns the list of (key,value) pairs
+        stored under the encoding (or None if not found or inserted)."""
+        return self._tree.encode(key, insert, 0)
+
     def insert(self, key, val):
-        encoding, ind, _ = self.encode(key, True)
-        self._data[encoding].append((key,val))
+        _, __, ___, slot = self._encode(key, True)
+        slot.append((key,val))
+        self._size += 1
+        self._valid.done(self)
+
+    def insert_many(self, items):
+        """Inserts all the (key,value) pairs in items.
+
+        The keys go down the tree together, with one find() per visited
+        node for all the keys headed there, so a batch costs one round
+        per node on the paths instead of one per key and level. The keys
+        that land in the same leaf are then sorted among themselves with
+        one more round and put into the leaf at once, and the leaves are
+        filled and split from left to right.
+
+        If more than max_size new keys land in one leaf, they cannot be
+        sorted in one round, and are inserted one at a time instead.
+        """
+        items = list(items)
+        frontier = [(self._tree, items)]
+        leaves = []
+        while frontier:
+            nextfront = []
+            for node, group in frontier:
+                buckets = collections.defaultdict(list)
+                for item, ind in self._cmp.find(group, node.keys, nkey=first):
+                    if ind >= 0:
+                        node.data[ind].append(item)
+                        self._size += 1
+                    else:
+                        buckets[-1-ind].append(item)
+                if isinstance(node, LeafNode):
+                    if buckets:
+                        leaves.append((node, buckets))
+                else:
+                    nextfront.extend((node.children[ind], buckets[ind])
+                                     for ind in sorted(buckets))
+            frontier = nextfront
+        for leaf, buckets in leaves:
+            pending = [item for ind in sorted(buckets) for item in buckets[ind]]
+            if len(pending) > self._cmp.max_size:
+                for key, val in pending:
+                    self.insert(key, val)
+            else:
+                leaf.insert_sorted(self._rank(pending), buckets)
+                self._size += len(pending)
+        self._valid.done(self)
+
+    def _rank(self, pending):
+        """Returns a dictionary mapping the id of each key in the
+        (key,value) pairs of pending to its rank among those keys,
+        where equal keys get equal ranks."""
+        if len(pending) == 1:
+            return {id(pending[0][0]): 0}
+        _, parts = self._cmp.partition_sort(
+            pending, [k for k,v in pending], nkey=first)
+        return {id(item[0]): ind for item, ind in parts}
 
     def lookup(self, key):
-        ekey, _, found = self.encode(key, False)
+        _, __, found, slot = self._encode(key, False)
+        self._valid.done(self)
         if found:
-            return self._data[ekey][0][1]
+            return slot[0][1]
         else:
             return None
 
     def range_search(self, key1, key2):
         _, ind1, __ = self.encode(key1, False)
         _, ind2, __ = self.encode(key2, False)
-        for ii in range(ind1, ind2):
-            for res in self._data[self._encodings[ii]]:
+        for slot in self._tree.slots(ind1, ind2):
+            for res in slot:
                 yield res
 
     def size(self):
-        return sum(len(lst) for lst in self._data.values())
+        return self._size
 
     def traverse(self):
-        for enc in self._encodings:
-            for key_value in self._data[enc]:
+        for slot in self._tree.slots(0, self._tree.count):
+            for key_value in slot:
                 yield key_value
 
-    def _tuptoval(self, tup):
-        res = 0
-        power = 1
-        for x in tup:
-            res *= power
-            res += x
-            power *= (self._tree.maxlen + 1)
-        return res
-
-    def check(self, full=False, info=False, inserted=None):
+    def check(self, full=False, info=False):
         if info:
-            print("mOPE size is", self.size(), "with tree height", self._tree.height())
+            print("mOPE size is", self.size(), "with tree height", self._tree.height(),
+                  "and fanout", self.maxlen)
+        assert self._tree.parent is None and self._tree.base == 0
         intree = list(self._tree.traverse())
-        assert all(len(enc) == len(intree[0]) for enc in intree)
-        ite = list(self._tuptoval(enc) for enc in intree)
-        assert ite == self._encodings
-        assert all((x == inserted or self._data[x]) for x in self._encodings)
-        assert all(len(lst) == 0 or enc in self._encodings 
-                   for enc,lst in self._data.items())
+        assert self._tree.count == len(intree)
+        ite = [enc for enc, _ in intree]
+        assert ite == sorted(set(ite))
+        assert all(enc < self._tree.scale * self.radix for enc in ite)
+        assert all(slot for enc, slot in intree)
+        assert sum(len(slot) for _, slot in intree) == self._size
         if full:
-            for (ekey, lst) in self._data.items():
+            for _, lst in intree:
                 if len(lst) >= 2:
                     fd = self._cmp.crypt.decode(lst[0][0])
                     assert all(self._cmp.crypt.decode(k) == fd for k,v in lst)
             prev = None
-            for ekey in self._encodings:
-                u = self._cmp.crypt.decode(self._data[ekey][0][0])
+            for _, lst in intree:
+                if not lst:
+                    continue
+                u = self._cmp.crypt.decode(lst[0][0])
                 if prev is not None:
                     assert prev < u
                 prev = u
 
+    def check_node(self, node, full=False):
+        """Checks a single node, and its links to its parent and
+        children. Used by validate.Validator."""
+        node.check_local()
+        if node.parent is None:
+            assert self._tree is node and node.base == 0
+        else:
+            par = node.parent
+            assert par.children[node.parind] is node
+            assert node.base == par.base + node.parind * par.scale
+        if full:
+            uk = [self._cmp.crypt.decode(key) for key in node.keys]
+            assert uk == sorted(set(uk))
+            assert all(slot and self._cmp.crypt.decode(slot[0][0]) == u
+                       for u, slot in zip(uk, node.data))
+
 
 class Node:
-    maxlen = 4
+    def __init__(self, serv, base, scale, keys, encs, data, parent=None):
+        """data holds one list of (key,value) pairs per key.
 
-    def __init__(self, serv, suffix, keys, encs, parent=None):
+        encs[j] must already equal base + (j+1)*scale (or be None for a
+        key that is still being inserted).
+        """
         self.serv = serv
         self.parent = parent
         self.keys = list(keys)
         self.encs = list(encs)
-        if parent:
-            self.prefix = None
-            self.parind = None
-        else:
-            self.prefix = ()
-            self.parind = 0
-        self.suffix = suffix
+        self.data = list(data)
+        self.base = base
+        self.scale = scale
+        self.parind = None if parent else 0
+        serv._valid.touch(self)
 
     def find(self, key):
         [(_, ind)] = self.serv._cmp.find([key], self.keys)
@@ -145,137 +219,269 @@ class Node:
             return (-1-ind, False)
 
     def make_parent(self):
+        """The new root has base 0, so no encodings change."""
         if self.parent is None:
             assert self.serv._tree == self
             self.serv._tree = self.parent = InternalNode(
-                    self.serv, (0,) + self.suffix, [], [], [self])
+                    self.serv, 0, self.scale * self.serv.radix, [], [], [], [self])
             self.parind = 0
-            self.prefix = (0,)
         return self.parent
-    
-    def redo_encs(self, updates, start=0):
-        inserted = None
-        for ind in range(start, len(self.encs)):
-            newenc = self.prefix + (ind+1,) + self.suffix
-            if self.encs[ind] is None:
-                assert inserted is None
-                inserted = newenc
-            else:
-                updates.append((self.encs[ind], newenc))
-            self.encs[ind] = newenc
-        return inserted
+
+    def grow(self, num=1):
+        """Counts num more encodings in this subtree and all above it."""
+        node = self
+        while node is not None:
+            node.count += num
+            self.serv._valid.touch(node)
+            node = node.parent
+
+    def settle(self, ind):
+        """Splits this node if it is too full, after a key was put at
+        index ind and all the encodings here were brought up to date.
+
+        Returns the final encoding of the key put at ind, wherever it
+        ends up after the splits above this node are done.
+        """
+        if len(self.keys) <= self.serv.maxlen:
+            return self.encs[ind]
+        split, enc, newsib = self.split_once()
+        if ind < split:
+            return self.encs[ind]
+        elif ind == split:
+            return enc
+        else:
+            return newsib.encs[ind-split-1]
+
+    def split_once(self):
+        """Moves the second half of this node to a new sibling, and the
+        middle key up to the parent.
+        Returns (split index, final encoding of the middle key, sibling).
+        """
+        split = self.serv.maxlen // 2
+        promoted = (self.keys[split], self.encs[split], self.data[split])
+        newsib = self.split_off(split)
+        self.truncate(split)
+        enc = self.parent.add(self.parind, promoted, newsib)
+        return split, enc, newsib
 
 
 class LeafNode(Node):
-    def __init__(self, serv, keys, encs, parent=None):
-        super().__init__(serv, (), keys, encs, parent)
+    def __init__(self, serv, keys, encs, data, parent=None, base=0):
+        super().__init__(serv, base, 1, keys, encs, data, parent)
+        self.count = len(self.keys)
 
-    def encode(self, key, insert, updates):
+    def encode(self, key, insert, offset):
+        """Returns (encoding, rank, found, data list), where the rank is
+        offset plus the rank within this node."""
         ind, found = self.find(key)
+        slot = self.data[ind] if found else None
         if insert and not found:
+            slot = []
             self.keys.insert(ind, key)
             self.encs.insert(ind, None)
-            if len(self.keys) > self.maxlen:
-                split = self.maxlen // 2
-                promoted = (self.keys[split], self.encs[split])
-                newsib = LeafNode(self.serv, 
-                                  self.keys[split+1:],
-                                  self.encs[split+1:],
-                                  self.make_parent())
-                del self.keys[split:]
-                del self.encs[split:]
-                enc = self.parent.add(self.parind, promoted, newsib, updates)
-            else:
-                enc = self.redo_encs(updates, ind)
+            self.data.insert(ind, slot)
+            self.redo_encs(ind)
+            self.grow()
+            enc = self.settle(ind)
         elif ind < len(self.encs):
             enc = self.encs[ind]
         else:
-            enc = self.encs[-1][:-1] + (self.maxlen+1,)
+            # fake successor, between the last key and the parent's next key
+            enc = self.base + (self.serv.maxlen+1)
         assert enc is not None
-        return enc, found
+        return enc, offset + ind, found, slot
+
+    def insert_sorted(self, ranks, buckets):
+        """Puts new keys into this leaf without any comparisons.
+
+        buckets maps each index in this leaf to the (key,value) pairs
+        that go just before the key at that index, and ranks maps the
+        id of each of their keys to its rank among all of them.
+        Then splits as many times as needed, from left to right.
+        """
+        keys, encs, data = [], [], []
+        added = 0
+        for ind in range(len(self.keys) + 1):
+            slots = {}
+            for key, val in buckets.get(ind, ()):
+                rank = ranks[id(key)]
+                if rank not in slots:
+                    slots[rank] = (key, [])
+                slots[rank][1].append((key,val))
+            for rank in sorted(slots):
+                keys.append(slots[rank][0])
+                data.append(slots[rank][1])
+                added += 1
+            if ind < len(self.keys):
+                keys.append(self.keys[ind])
+                data.append(self.data[ind])
+        self.keys, self.data = keys, data
+        self.encs = [None] * len(keys)
+        self.redo_encs()
+        self.grow(added)
+        node = self
+        while len(node.keys) > self.serv.maxlen:
+            _, __, node = node.split_once()
+
+    def redo_encs(self, start=0):
+        for ind in range(start, len(self.encs)):
+            self.encs[ind] = self.base + ind + 1
+
+    def split_off(self, split):
+        """Returns a new node holding the keys after index split, with
+        its encodings left where they are for now."""
+        return LeafNode(self.serv, self.keys[split+1:], self.encs[split+1:],
+                        self.data[split+1:], self.make_parent(),
+                        self.base + (split+1))
+
+    def truncate(self, split):
+        del self.keys[split:]
+        del self.encs[split:]
+        del self.data[split:]
+        self.recount()
+
+    def recount(self):
+        self.count = len(self.keys)
+
+    def shift(self, delta):
+        """Moves every encoding in this subtree up by delta."""
+        self.serv._valid.touch(self)
+        self.base += delta
+        self.encs = [enc + delta for enc in self.encs]
 
-    def redo_all(self, updates):
-        return self.redo_encs(updates)
+    def slots(self, start, stop):
+        """Yields the data lists with ranks start up to stop within
+        this subtree."""
+        for ind in range(max(start, 0), min(stop, len(self.data))):
+            yield self.data[ind]
 
     def height(self):
         return 0
 
+    def check_local(self):
+        assert len(self.keys) == len(self.encs) == len(self.data)
+        assert len(self.keys) <= self.serv.maxlen
+        assert self.count == len(self.keys)
+        assert self.scale == 1
+        for ii,enc in enumerate(self.encs):
+            assert enc == self.base + ii + 1
+
     def traverse(self):
-        assert len(self.keys) == len(self.encs)
-        assert self.suffix == ()
+        """Yields (encoding, data list) for every key in order."""
+        self.check_local()
         for ii,enc in enumerate(self.encs):
-            assert enc == self.prefix + (ii+1,)
-            yield enc
+            yield enc, self.data[ii]
 
 class InternalNode(Node):
-    def __init__(self, serv, suffix, keys, encs, children, parent=None):
-        super().__init__(serv, suffix, keys, encs, parent)
+    def __init__(self, serv, base, scale, keys, encs, data, children, parent=None):
+        super().__init__(serv, base, scale, keys, encs, data, parent)
         self.children = list(children)
         assert len(self.children) == len(self.keys)+1
+        for ii, child in enumerate(self.children):
+            child.parent = self
+            child.parind = ii
+        self.recount()
 
-    def encode(self, key, insert, updates):
+    def recount(self):
+        self.count = len(self.keys) + sum(child.count for child in self.children)
+
+    def encode(self, key, insert, offset):
         (ind, found) = self.find(key)
+        offset += ind + sum(child.count for child in self.children[:ind])
         if found:
-            return (self.encs[ind], True)
+            return (self.encs[ind], offset + self.children[ind].count, True,
+                    self.data[ind])
         else:
-            return self.children[ind].encode(key, insert, updates)
+            return self.children[ind].encode(key, insert, offset)
 
-    def add(self, ind, promoted, newchild, updates):
+    def add(self, ind, promoted, newchild):
+        """Puts the promoted (key, encoding, data) at index ind, and
+        newchild just after it. Returns the final encoding of the
+        promoted key."""
+        self.serv._valid.touch(self)
         self.keys.insert(ind, promoted[0])
         self.encs.insert(ind, promoted[1])
+        self.data.insert(ind, promoted[2])
         self.children.insert(ind+1, newchild)
-        if len(self.keys) > self.maxlen:
-            split = self.maxlen // 2
-            myprom = (self.keys[split], self.encs[split])
-            newsib = InternalNode(self.serv, self.suffix,
-                    self.keys[split+1:],
-                    self.encs[split+1:],
-                    self.children[split+1:],
-                    self.make_parent())
-            del self.keys[split:]
-            del self.encs[split:]
-            del self.children[split+1:]
-            inserted = self.parent.add(self.parind, myprom, newsib, updates)
-        else:
-            inserted = self.redo_encs_children(updates, ind)
-        assert inserted is not None
-        return inserted
-
-    def redo_encs_children(self, updates, start=0):
-        inserted = self.redo_encs(updates, start)
-        for ii in range(start, len(self.children)):
-            self.children[ii].parent = self
-            self.children[ii].prefix = self.prefix + (ii,)
+        self.encs[ind] = self.base + (ind+1)*self.scale
+        for ii in range(ind+1, len(self.encs)):
+            self.encs[ii] += self.scale
+        newchild.parent = self
+        newchild.shift(self.base + (ind+1)*self.scale - newchild.base)
+        for ii in range(ind+1, len(self.children)):
             self.children[ii].parind = ii
-            cins = self.children[ii].redo_all(updates)
-            if cins:
-                assert inserted is None
-                inserted = cins
-        return inserted
+            if ii > ind+1:
+                self.children[ii].shift(self.scale)
+        return self.settle(ind)
+
+    def split_off(self, split):
+        """Returns a new node holding the keys and children after index
+        split, with its encodings left where they are for now."""
+        return InternalNode(self.serv, self.base + (split+1)*self.scale,
+                            self.scale, self.keys[split+1:], self.encs[split+1:],
+                            self.data[split+1:], self.children[split+1:],
+                            self.make_parent())
+
+    def truncate(self, split):
+        del self.keys[split:]
+        del self.encs[split:]
+        del self.data[split:]
+        del self.children[split+1:]
+        self.recount()
+
+    def shift(self, delta):
+        """Moves every encoding in this subtree up by delta."""
+        self.serv._valid.touch(self)
+        self.base += delta
+        self.encs = [enc + delta for enc in self.encs]
+        for child in self.children:
+            child.shift(delta)
 
-    def redo_all(self, updates):
-        return self.redo_encs_children(updates)
+    def slots(self, start, stop):
+        """Yields the data lists with ranks start up to stop within
+        this subtree, skipping over the children outside that range."""
+        pos = 0
+        for ii, child in enumerate(self.children):
+            if pos >= stop:
+                return
+            if pos + child.count > start:
+                for slot in child.slots(start - pos, stop - pos):
+                    yield slot
+            pos += child.count
+            if ii < len(self.keys):
+                if start <= pos < stop:
+                    yield self.data[ii]
+                pos += 1
 
     def height(self):
         assert all(child.height() == self.children[0].height() 
                    for child in self.children)
         return self.children[0].height() + 1
 
-    def traverse(self):
+    def check_local(self):
         assert len(self.children) == 1 + len(self.encs) == 1 + len(self.keys)
-        for ii,(child, enc) in enumerate(zip(self.children, self.encs)):
+        assert len(self.data) == len(self.keys)
+        assert 1 <= len(self.keys) <= self.serv.maxlen
+        assert self.count == len(self.keys) + sum(c.count for c in self.children)
+        for ii, child in enumerate(self.children):
             assert child.parent == self
             assert child.parind == ii
-            assert self.suffix == (0,) + child.suffix
-            assert child.prefix == self.prefix + (ii,)
+            assert self.scale == child.scale * self.serv.radix
+            assert child.base == self.base + ii*self.scale
+        for ii, enc in enumerate(self.encs):
+            assert enc == self.base + (ii+1)*self.scale
+
+    def traverse(self):
+        """Yields (encoding, data list) for every key in order."""
+        self.check_local()
+        for ii,(child, enc) in enumerate(zip(self.children, self.encs)):
             for cenc in child.traverse():
                 yield cenc
-            assert enc == self.prefix + (ii+1,) + self.suffix
-            yield enc
-        ii, child = len(self.encs), self.children[-1]
-        assert child.parent == self
-        assert child.parind == ii
-        assert self.suffix == (0,) + child.suffix
-        assert child.prefix == self.prefix + (ii,)
-        for cenc in child.traverse():
+            yield enc, self.data[ii]
+        for cenc in self.children[-1].traverse():
             yield cenc
+
+
+# helper function to get the key out of a (key,value) pair
+def first(L):
+    return L[0]
@@ -14,46 +14,127 @@ client and POPE server interface.
 
 import socket
 import socketserver
+import threading
 import pickle
 import argparse
 
 from ope import pope
 from ope import nworacle
+from ope import commstats
+from ope import compress
+from ope import trace
 
 """Single byte op-codes"""
 CLEAR = b'c'
 INSERT = b'i'
 LOOKUP = b'l'
 RANGE_SEARCH = b'r'
+RANGE_PAGE = b'p'
+RANGE_NEXT = b'n'
 SIZE = b's'
 TRAVERSE = b't'
+STATS = b'S'
+COMPRESS = b'z'
+CREATE = b'C'
+DROP = b'D'
+SELECT = b'U'
+BATCH = b'B'
+REPLICATE = b'R'
 
 DEBUG = True
 
+# span names for each request, as timed by the server
+SERVE_SPANS = {
+    CLEAR: 'nwopec.serve.clear',
+    INSERT: 'nwopec.serve.insert',
+    LOOKUP: 'nwopec.serve.lookup',
+    RANGE_SEARCH: 'nwopec.serve.range_search',
+    RANGE_PAGE: 'nwopec.serve.range_page',
+    RANGE_NEXT: 'nwopec.serve.range_next',
+    SIZE: 'nwopec.serve.size',
+    TRAVERSE: 'nwopec.serve.traverse',
+    STATS: 'nwopec.serve.stats',
+    COMPRESS: 'nwopec.serve.compress',
+    CREATE: 'nwopec.serve.create',
+    DROP: 'nwopec.serve.drop',
+    SELECT: 'nwopec.serve.select',
+    BATCH: 'nwopec.serve.batch',
+    REPLICATE: 'nwopec.serve.replicate',
+}
+
+# operation names for the communication counters
+OP_NAMES = {
+    CLEAR: 'clear',
+    INSERT: 'insert',
+    LOOKUP: 'lookup',
+    RANGE_SEARCH: 'range_search',
+    RANGE_PAGE: 'range_page',
+    RANGE_NEXT: 'range_next',
+    SIZE: 'size',
+    TRAVERSE: 'traverse',
+    STATS: 'stats',
+    COMPRESS: 'compress',
+    CREATE: 'create',
+    DROP: 'drop',
+    SELECT: 'select',
+    BATCH: 'batch',
+    REPLICATE: 'replicate',
+}
+
+# operations allowed in a BATCH request
+BATCH_OPS = {
+    'insert': INSERT,
+    'lookup': LOOKUP,
+    'range_search': RANGE_SEARCH,
+    'size': SIZE,
+}
+
+# scans that a threaded server answers from a snapshot of the tree
+SNAPSHOT_OPS = (TRAVERSE, RANGE_SEARCH)
+
+# sent in place of the next cursor when RANGE_NEXT is given a cursor
+# that is unknown or has expired
+BAD_CURSOR = False
+
 class NwOpeClient:
     """Same functionality as opec.OpeClient, except only works with POPE and
     does it over a network."""
 
-    def __init__(self, hostname, port, crypt, clearit=True):
+    def __init__(self, hostname, port, crypt, clearit=True,
+                 codec=None, threshold=compress.DEFAULT_THRESHOLD):
         """hostname and port are for the POPE server.
 
         The given encryption algorithm crypt must support encode() and
         decode() methods, and must match the comparison oracle that the
         OPE server relies on.
+
+        If codec names an algorithm from compress.CODECS, the server is
+        asked to compress the frames that are at least threshold bytes
+        long, in both directions.
         """
         self._addr = (hostname, port)
         self._crypt = crypt
+        self._codec = codec
+        self._threshold = threshold
         self._needs_clear = clearit
         self._conn = None
+        self._stats = commstats.CommStats()
 
     def open(self):
         """opens the connection and allows operations"""
         if self._conn:
             raise RuntimeError("already open")
         self._conn = socket.create_connection(self._addr)
-        self._sockfile = self._conn.makefile('rwb')
+        self._conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sockfile = compress.FramedFile(commstats.CountingFile(
+            self._conn.makefile('rwb'), self._stats), self._stats)
+
+        if self._codec:
+            self._sockfile.op = OP_NAMES[COMPRESS]
+            compress.request(self._sockfile, COMPRESS, self._codec, self._threshold)
 
         if self._needs_clear:
+            self._sockfile.op = OP_NAMES[CLEAR]
             self._sockfile.write(CLEAR)
             self._sockfile.flush()
             self._needs_clear = False
@@ -79,33 +160,59 @@ class NwOpeClient:
     def __exit__(self, t,v,r):
         self.close()
 
+    def comm_stats(self, reset=False):
+        """Returns the byte counts for this connection, as a dictionary
+        like commstats.CommStats.snapshot()."""
+        return self._stats.snapshot(reset)
+
+    def stats(self, reset=False):
+        """Fetches the counters from the POPE server.
+
+        Returned is a dictionary with the server's byte counts under
+        'server'. If the back-end supports it, 'tree' holds its
+        Pope.stats(): height, node counts, per-level sorted and buffer
+        sizes, pending unsorted work and the oracle's counters.
+        """
+        with trace.span('nwopec.stats'):
+            # send opcode and reset flag
+            self._sockfile.op = OP_NAMES[STATS]
+            self._sockfile.write(STATS)
+            pickle.dump(reset, self._sockfile)
+            self._sockfile.flush()
+
+            return pickle.load(self._sockfile)
+
     def insert(self, key, value):
-        # send opcode
-        self._sockfile.write(INSERT)
+        with trace.span('nwopec.insert'):
+            # send opcode
+            self._sockfile.op = OP_NAMES[INSERT]
+            self._sockfile.write(INSERT)
 
-        # send key and value
-        pickle.dump(self._crypt.encode(key), self._sockfile)
-        pickle.dump(self._crypt.encode(value), self._sockfile)
+            # send key and value
+            pickle.dump(self._crypt.encode(key), self._sockfile)
+            pickle.dump(self._crypt.encode(value), self._sockfile)
 
-        self._sockfile.flush()
+            self._sockfile.flush()
 
     def lookup(self, key):
-        # send opcode
-        self._sockfile.write(LOOKUP)
+        with trace.span('nwopec.lookup'):
+            # send opcode
+            self._sockfile.op = OP_NAMES[LOOKUP]
+            self._sockfile.write(LOOKUP)
 
-        # send key
-        pickle.dump(self._crypt.encode(key), self._sockfile)
-        self._sockfile.flush()
+            # send key
+            pickle.dump(self._crypt.encode(key), self._sockfile)
+            self._sockfile.flush()
 
-        # receive result
-        encval = pickle.load(self._sockfile)
+            # receive result
+            encval = pickle.load(self._sockfile)
 
-        self._sockfile.flush()
+            self._sockfile.flush()
 
-        if encval is None:
-            return None
-        else:
-            return self._crypt.decode(encval)
+            if encval is None:
+                return None
+            else:
+                return self._crypt.decode(encval)
 
     def stream_until_none(self):
         while True:
@@ -115,82 +222,274 @@ class NwOpeClient:
             yield obj
         self._sockfile.flush()
 
-    def range_search(self, key1, key2):
-        if key2 < key1:
-            return
-        # send opcode
-        self._sockfile.write(RANGE_SEARCH)
+    def range_search(self, key1, key2, limit=None):
+        """Returns all (key,value) pairs in the range.
 
-        # send keys
-        pickle.dump(self._crypt.encode(key1), self._sockfile)
-        pickle.dump(self._crypt.encode(key2), self._sockfile)
-        self._sockfile.flush()
+        If limit is given, returns at most that many results, along with
+        a cursor for range_next() (None if there are no more results).
+        """
+        if limit is not None:
+            return self._range_page(key1, key2, limit)
+        with trace.span('nwopec.range_search'):
+            if key2 < key1:
+                return
+            # send opcode
+            self._sockfile.op = OP_NAMES[RANGE_SEARCH]
+            self._sockfile.write(RANGE_SEARCH)
+
+            # send keys
+            pickle.dump(self._crypt.encode(key1), self._sockfile)
+            pickle.dump(self._crypt.encode(key2), self._sockfile)
+            self._sockfile.flush()
 
-        res = [(self._crypt.decode(enkey), self._crypt.decode(enval))
-                for enkey, enval in self.stream_until_none()]
+            res = [(self._crypt.decode(enkey), self._crypt.decode(enval))
+                    for enkey, enval in self.stream_until_none()]
 
-        self._sockfile.flush()
+            self._sockfile.flush()
         
-        return res
+            return res
+
+    def _range_page(self, key1, key2, limit):
+        with trace.span('nwopec.range_page'):
+            if key2 < key1:
+                return [], None
+            # send opcode
+            self._sockfile.op = OP_NAMES[RANGE_PAGE]
+            self._sockfile.write(RANGE_PAGE)
+
+            # send keys and limit
+            pickle.dump(self._crypt.encode(key1), self._sockfile)
+            pickle.dump(self._crypt.encode(key2), self._sockfile)
+            pickle.dump(limit, self._sockfile)
+            self._sockfile.flush()
 
-    def size(self):
-        # send opcode
-        self._sockfile.write(SIZE)
-        self._sockfile.flush()
+            return self._receive_page()
 
-        res = pickle.load(self._sockfile)
-        self._sockfile.flush()
-        return res
+    def range_next(self, cursor, limit=None):
+        """Fetches the next page of a range search started with a limit.
+        Raises ValueError if the server no longer knows the cursor."""
+        with trace.span('nwopec.range_next'):
+            # send opcode
+            self._sockfile.op = OP_NAMES[RANGE_NEXT]
+            self._sockfile.write(RANGE_NEXT)
 
-    def traverse(self):
-        # send opcode
-        self._sockfile.write(TRAVERSE)
-        self._sockfile.flush()
+            # send cursor and limit
+            pickle.dump(cursor, self._sockfile)
+            pickle.dump(limit, self._sockfile)
+            self._sockfile.flush()
+
+            res, following = self._receive_page()
+            if following is BAD_CURSOR:
+                raise ValueError("unknown or expired cursor", cursor)
+            return res, following
 
+    def _receive_page(self):
         res = [(self._crypt.decode(enkey), self._crypt.decode(enval))
                 for enkey, enval in self.stream_until_none()]
+        cursor = pickle.load(self._sockfile)
+        return res, cursor
+
+    def size(self):
+        with trace.span('nwopec.size'):
+            # send opcode
+            self._sockfile.op = OP_NAMES[SIZE]
+            self._sockfile.write(SIZE)
+            self._sockfile.flush()
+
+            res = pickle.load(self._sockfile)
+            self._sockfile.flush()
+            return res
+
+    def traverse(self):
+        with trace.span('nwopec.traverse'):
+            # send opcode
+            self._sockfile.op = OP_NAMES[TRAVERSE]
+            self._sockfile.write(TRAVERSE)
+            self._sockfile.flush()
+
+            res = [(self._crypt.decode(enkey), self._crypt.decode(enval))
+                    for enkey, enval in self.stream_until_none()]
         
-        self._sockfile.flush()
+            self._sockfile.flush()
         
+            return res
+
+    def _index_request(self, opcode, name):
+        with trace.span('nwopec.' + OP_NAMES[opcode]):
+            # send opcode and index name
+            self._sockfile.op = OP_NAMES[opcode]
+            self._sockfile.write(opcode)
+            pickle.dump(name, self._sockfile)
+            self._sockfile.flush()
+
+            return pickle.load(self._sockfile)
+
+    def create_index(self, name):
+        """Creates a new, empty named index on a multi-index server (see
+        the catalog module). Returns False if it already exists."""
+        return self._index_request(CREATE, name)
+
+    def drop_index(self, name):
+        """Deletes a named index. Returns False if there was none."""
+        return self._index_request(DROP, name)
+
+    def select_index(self, name):
+        """Makes all the following single operations on this connection
+        go to the named index. Returns False if there is none."""
+        return self._index_request(SELECT, name)
+
+    def batch(self, requests):
+        """Runs several operations, on any indexes, in one round trip.
+
+        Each request is a tuple (index name, operation, arguments...),
+        where the operation is 'insert', 'lookup', 'range_search' or
+        'size', with the same arguments as the methods of the same name
+        (but no limit for range_search). Returned is the list of results.
+        """
+        with trace.span('nwopec.batch'):
+            encoded = []
+            for name, op, *args in requests:
+                encoded.append((name, BATCH_OPS[op],
+                                tuple(self._crypt.encode(arg) for arg in args)))
+
+            # send opcode and requests
+            self._sockfile.op = OP_NAMES[BATCH]
+            self._sockfile.write(BATCH)
+            pickle.dump(encoded, self._sockfile)
+            self._sockfile.flush()
+
+            results = pickle.load(self._sockfile)
+
+        res = []
+        for (name, op, *args), out in zip(requests, results):
+            if op == 'lookup':
+                out = None if out is None else self._crypt.decode(out)
+            elif op == 'range_search':
+                out = [(self._crypt.decode(enkey), self._crypt.decode(enval))
+                       for enkey, enval in out]
+            res.append(out)
         return res
 
 class PopeHandler(socketserver.BaseRequestHandler):
     # Note: must have field "serv" added to point to the underlying Pope instance
+    # The field "stats" is a CommStats shared by all connections.
+    # If "lock" is set, requests from different connections take turns.
+    stats = None
+    lock = None
+    # the Popes this connection has unfinished paged searches on, by id
+    paged = None
 
     def handle(self):
-        with self.request.makefile('rwb') as sockfile:
+        if self.stats is None:
+            self.stats = commstats.CommStats()
+        # every request ends in a flush, so don't let replies wait for ACKs
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        raw = self.request.makefile('rwb')
+        counted = commstats.CountingFile(raw, self.stats)
+        with compress.FramedFile(counted, self.stats) as sockfile:
             if DEBUG: print("Connection open")
             while True:
                 # receive opcode
+                sockfile.op = None
                 opcode = sockfile.read(1)
                 if not opcode:
                     if DEBUG: print("Connection closed")
                     return
-                elif opcode == CLEAR:
-                    if DEBUG: print("Received CLEAR request")
-                    self.serv.clear()
-                elif opcode == INSERT:
-                    if DEBUG: print("Received INSERT request")
-                    self.insert(sockfile)
-                elif opcode == LOOKUP:
-                    if DEBUG: print("Received LOOKUP request")
-                    self.lookup(sockfile)
-                elif opcode == RANGE_SEARCH:
-                    if DEBUG: print("Received RANGE_SEARCH request")
-                    self.range_search(sockfile)
-                elif opcode == TRAVERSE:
-                    if DEBUG: print("Received TRAVERSE request")
-                    self.traverse(sockfile)
-                elif opcode == SIZE:
-                    if DEBUG: print("Received SIZE request")
-                    pickle.dump(self.serv.size(), sockfile)
-                    sockfile.flush()
-                else:
-                    raise RuntimeError("POPE SERVER ERROR: invalid opcode", opcode)
+                sockfile.op = OP_NAMES.get(opcode, 'invalid')
+                with trace.span(SERVE_SPANS.get(opcode, 'nwopec.serve')):
+                    self.serve(opcode, sockfile)
                 if DEBUG:
                     print("(finished request)")
                     print()
-    
+
+    def finish(self):
+        # end the paged searches this connection left unfinished, so
+        # their snapshots do not stay pinned
+        if self.paged:
+            for serv in self.paged.values():
+                serv.drop_cursors(self)
+
+    def serve(self, opcode, sockfile):
+        """Handles one request, taking turns with the other connections
+        if there is a lock."""
+        if self.lock and opcode in SNAPSHOT_OPS and hasattr(self.serv, 'snapshot'):
+            self.scan(opcode, sockfile)
+        elif self.lock:
+            with self.lock:
+                self.dispatch(opcode, sockfile)
+        else:
+            self.dispatch(opcode, sockfile)
+
+    def scan(self, opcode, sockfile):
+        """Answers a TRAVERSE or RANGE_SEARCH from a snapshot, so that the
+        other connections only wait for it to be pinned (and for a range
+        search to be split), not for all the results to be sent."""
+        if opcode == RANGE_SEARCH:
+            if DEBUG: print("Received RANGE_SEARCH request (snapshot)")
+            key1 = pickle.load(sockfile)
+            key2 = pickle.load(sockfile)
+            with self.lock:
+                results, snap = self.serv.range_scan(key1, key2)
+            try:
+                self.send_all(sockfile, results)
+            finally:
+                if snap is not None:
+                    snap.release()
+        else:
+            if DEBUG: print("Received TRAVERSE request (snapshot)")
+            with self.lock:
+                snap = self.serv.snapshot()
+            with snap:
+                self.send_all(sockfile, snap.traverse())
+
+    def dispatch(self, opcode, sockfile):
+        """Handles one request with the given opcode."""
+        if opcode == CLEAR:
+            if DEBUG: print("Received CLEAR request")
+            self.serv.clear()
+        elif opcode == INSERT:
+            if DEBUG: print("Received INSERT request")
+            self.insert(sockfile)
+        elif opcode == LOOKUP:
+            if DEBUG: print("Received LOOKUP request")
+            self.lookup(sockfile)
+        elif opcode == RANGE_SEARCH:
+            if DEBUG: print("Received RANGE_SEARCH request")
+            self.range_search(sockfile)
+        elif opcode == RANGE_PAGE:
+            if DEBUG: print("Received RANGE_PAGE request")
+            self.range_page(sockfile)
+        elif opcode == RANGE_NEXT:
+            if DEBUG: print("Received RANGE_NEXT request")
+            self.range_next(sockfile)
+        elif opcode == TRAVERSE:
+            if DEBUG: print("Received TRAVERSE request")
+            self.traverse(sockfile)
+        elif opcode == SIZE:
+            if DEBUG: print("Received SIZE request")
+            pickle.dump(self.serv.size(), sockfile)
+            sockfile.flush()
+        elif opcode == STATS:
+            if DEBUG: print("Received STATS request")
+            self.send_stats(sockfile)
+        elif opcode == COMPRESS:
+            if DEBUG: print("Received COMPRESS request")
+            compress.accept(sockfile)
+        else:
+            raise RuntimeError("POPE SERVER ERROR: invalid opcode", opcode)
+
+    def send_stats(self, sockfile):
+        # read the reset flag
+        reset = pickle.load(sockfile)
+
+        res = {'server': self.stats.snapshot(reset)}
+        if hasattr(self.serv, 'stats'):
+            # tree shape and oracle counters, without a traversal
+            res['tree'] = self.serv.stats(reset)
+
+        pickle.dump(res, sockfile)
+        sockfile.flush()
+
     def insert(self, sockfile):
         # get key and value
         key = pickle.load(sockfile)
@@ -221,6 +520,37 @@ class PopeHandler(socketserver.BaseRequestHandler):
         # send back results
         self.send_all(sockfile, res)
 
+    def range_page(self, sockfile):
+        # get keys and limit
+        key1 = pickle.load(sockfile)
+        key2 = pickle.load(sockfile)
+        limit = pickle.load(sockfile)
+
+        # get one page of results
+        res, cursor = self.serv.range_search(key1, key2, limit, owner=self)
+        if cursor is not None:
+            if self.paged is None:
+                self.paged = {}
+            self.paged[id(self.serv)] = self.serv
+
+        # send back results and the cursor
+        self.send_page(sockfile, res, cursor)
+
+    def range_next(self, sockfile):
+        # get cursor and limit
+        cursor = pickle.load(sockfile)
+        limit = pickle.load(sockfile)
+
+        # get the next page of results, or tell the client the cursor is
+        # no good, and carry on
+        try:
+            res, cursor = self.serv.range_next(cursor, limit, owner=self)
+        except ValueError:
+            res, cursor = [], BAD_CURSOR
+
+        # send back results and the new cursor
+        self.send_page(sockfile, res, cursor)
+
     def traverse(self, sockfile):
         # get result
         res = self.serv.traverse()
@@ -234,8 +564,23 @@ class PopeHandler(socketserver.BaseRequestHandler):
         pickle.dump(None, sockfile)
         sockfile.flush()
 
-def get_pope_server(the_pope, hostname, port):
-    """Creates a socketserver to relay requests to given POPE instance."""
+    def send_page(self, sockfile, L, cursor):
+        for x in L:
+            pickle.dump(x, sockfile)
+        pickle.dump(None, sockfile)
+        pickle.dump(cursor, sockfile)
+        sockfile.flush()
+
+def get_pope_server(the_pope, hostname, port, threaded=False):
+    """Creates a socketserver to relay requests to given POPE instance.
+    If threaded, several connections can be open at once, each in its
+    own thread, but their requests are still handled one at a time."""
     class Handler(PopeHandler):
         serv = the_pope
+        stats = commstats.CommStats()
+        lock = threading.Lock() if threaded else None
+    if threaded:
+        server = socketserver.ThreadingTCPServer((hostname, port), Handler)
+        server.daemon_threads = True
+        return server
     return socketserver.TCPServer((hostname, port), Handler)
@@ -12,68 +12,192 @@ This file contains client and server classes for the backend POPE
 server to connect to a comparison oracle.
 """
 
+import hashlib
+import hmac
 import socket
 import socketserver
+import threading
+import time
 import pickle
 import argparse
 
 from ope import ciphers
 from ope import oracle
+from ope import commstats
+from ope import compress
+from ope import trace
 
 """Single byte op-codes"""
 PARTITION = b'p'
 PARTITION_SORT = b's'
 FIND = b'f'
 MAX_SIZE = b'm'
+STATS = b't'
+COMPRESS = b'z'
+AUTH = b'a'
 
 DEBUG = True
 BUFSIZE = 1024
 
+# span names for each request, as timed by the server
+SERVE_SPANS = {
+    PARTITION: 'nworacle.serve.partition',
+    PARTITION_SORT: 'nworacle.serve.partition_sort',
+    FIND: 'nworacle.serve.find',
+    MAX_SIZE: 'nworacle.serve.max_size',
+    STATS: 'nworacle.serve.stats',
+    COMPRESS: 'nworacle.serve.compress',
+    AUTH: 'nworacle.serve.auth',
+}
+
+# operation names for the communication counters
+OP_NAMES = {
+    PARTITION: 'partition',
+    PARTITION_SORT: 'partition_sort',
+    FIND: 'find',
+    MAX_SIZE: 'max_size',
+    STATS: 'stats',
+    COMPRESS: 'compress',
+    AUTH: 'auth',
+}
+
 # convenience method
 def identity(x):
     return x
 
+def auth_digest(secret, nonce):
+    """The response to an AUTH challenge, from a tenant's shared secret."""
+    if isinstance(secret, str):
+        secret = secret.encode('utf8')
+    return hmac.new(secret, nonce, hashlib.sha256).digest()
+
+class Connection:
+    """One socket to the oracle server, as used by OracleClient."""
+
+    def __init__(self, addr, stats, codec=None, threshold=compress.DEFAULT_THRESHOLD,
+                 tenant=None, secret=None):
+        self.sock = socket.create_connection(addr)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sockfile = compress.FramedFile(
+            commstats.CountingFile(self.sock.makefile('rwb'), stats), stats)
+        self.last_used = time.monotonic()
+        self.suspect = False
+        try:
+            if tenant is not None:
+                self._authenticate(tenant, secret)
+            if codec:
+                self.sockfile.op = OP_NAMES[COMPRESS]
+                compress.request(self.sockfile, COMPRESS, codec, threshold)
+        except:
+            self.close()
+            raise
+
+    def _authenticate(self, tenant, secret):
+        # send opcode and tenant ID, then answer the challenge
+        self.sockfile.op = OP_NAMES[AUTH]
+        self.sockfile.write(AUTH)
+        pickle.dump(tenant, self.sockfile)
+        self.sockfile.flush()
+        nonce = pickle.load(self.sockfile)
+        pickle.dump(auth_digest(secret, nonce), self.sockfile)
+        self.sockfile.flush()
+        if not pickle.load(self.sockfile):
+            raise RuntimeError("oracle server refused tenant", tenant)
+
+    def close(self):
+        try:
+            self.sockfile.flush()
+            self.sockfile.close()
+            self.sock.close()
+        except:
+            pass
+
+
 class OracleClient:
     """Accessed by an OPE back-end server in order to determine the order
     of elements.
+
+    Requests go over a pool of up to pool_size connections, so that
+    several threads (like concurrent splits in different trees) can
+    each use their own. A connection that has been idle for longer than
+    health_interval seconds is checked before it is used again, and a
+    request that fails because its connection broke is retried on a new
+    connection up to retries times, waiting retry_delay seconds and
+    doubling that each time. After a connection breaks, the idle ones
+    are all checked before they are used again.
+
+    If codec names an algorithm from compress.CODECS, each connection
+    asks the server to compress the frames that are at least threshold
+    bytes long, in both directions.
+
+    For a server hosting several tenants (see the tenants module), each
+    connection first authenticates as the given tenant ID, with the
+    tenant's shared secret.
     """
 
-    def __init__(self, hostname, port):
+    def __init__(self, hostname, port, pool_size=1, retries=2,
+                 retry_delay=0.05, health_interval=30.0,
+                 codec=None, threshold=compress.DEFAULT_THRESHOLD,
+                 tenant=None, secret=None):
         """There should be an oracle server running on the specified hostname
-        and port."""
+        and port. With pool_size more than 1, the server must accept
+        several connections at once (see get_oracle_server)."""
+        assert pool_size >= 1 and retries >= 0
         self._addr = (hostname, port)
-        self._conn = None
+        self._codec = codec
+        self._threshold = threshold
+        self._tenant = tenant
+        self._secret = secret
+        self._pool_size = pool_size
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._health_interval = health_interval
+        self._stats = commstats.CommStats()
+        self._cond = threading.Condition()
+        self._idle = []
+        self._conns = 0
+        # connections dropped as broken and not yet replaced
+        self._lost = 0
+        self._open = False
+        self._reset_pool_counts()
+
+    def _reset_pool_counts(self):
+        self._acquires = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+        self._health_checks = 0
+        self._reconnects = 0
+        self._retried = 0
+        self._failures = 0
 
     def open(self):
         """opens the connection and allows operations"""
-        if self._conn:
+        if self._open:
             raise RuntimeError("already open")
-        self._conn = socket.create_connection(self._addr)
-        self._sockfile = self._conn.makefile('rwb')
-
-        # go get the max size
-        # send opcode
-        self._sockfile.write(MAX_SIZE)
-        self._sockfile.flush()
-        self._max_size = pickle.load(self._sockfile)
+        self._open = True
+        self._lost = 0
+        try:
+            # go get the max size
+            self._max_size = self._call(self._get_max_size)
+        except:
+            self.close()
+            raise
 
     def __enter__(self):
         self.open()
         return self
 
     def close(self):
-        """closes the connection"""
-        if not self._conn:
+        """closes all the connections"""
+        if not self._open:
             raise RuntimeError("not open; can't close it")
-        try:
-            self._sockfile.flush()
-            self._sockfile.close()
-            self._conn.close()
-        except:
-            pass
-        del self._sockfile
-        del self._conn
-        self._conn = None
+        with self._cond:
+            self._open = False
+            for conn in self._idle:
+                conn.close()
+            self._conns -= len(self._idle)
+            self._idle = []
 
     def __exit__(self, t,v,r):
         self.close()
@@ -82,118 +206,335 @@ class OracleClient:
     def max_size(self):
         return self._max_size
 
+    def _acquire(self):
+        """Takes an idle connection from the pool, opens a new one if the
+        pool is not full yet, or else waits for one to be released."""
+        start = time.perf_counter()
+        with self._cond:
+            if not self._open:
+                raise RuntimeError("not open")
+            waited = False
+            while not self._idle and self._conns >= self._pool_size:
+                waited = True
+                self._cond.wait()
+            wait = time.perf_counter() - start
+            self._acquires += 1
+            if waited:
+                self._waits += 1
+                self._wait_time += wait
+                self._max_wait = max(self._max_wait, wait)
+            if self._idle:
+                conn = self._idle.pop()
+            else:
+                conn = None
+                self._conns += 1
+                replacing = self._lost > 0
+                if replacing:
+                    self._lost -= 1
+        if conn is None:
+            try:
+                conn = self._connect()
+            except:
+                self._release(None, True)
+                raise
+            if replacing:
+                with self._cond:
+                    self._reconnects += 1
+            return conn
+        if conn.suspect or time.monotonic() - conn.last_used > self._health_interval:
+            with self._cond:
+                self._health_checks += 1
+            try:
+                self._get_max_size(conn.sockfile)
+                conn.suspect = False
+            except (OSError, EOFError, pickle.UnpicklingError):
+                conn.close()
+                try:
+                    conn = self._connect()
+                except:
+                    self._release(None, True)
+                    raise
+                with self._cond:
+                    self._reconnects += 1
+        return conn
+
+    def _connect(self):
+        return Connection(self._addr, self._stats, self._codec, self._threshold,
+                          self._tenant, self._secret)
+
+    def _release(self, conn, broken=False):
+        with self._cond:
+            if broken or not self._open:
+                if conn is not None:
+                    conn.close()
+                self._conns -= 1
+                if broken:
+                    self._lost += 1
+                    # the others may have been cut off too
+                    for other in self._idle:
+                        other.suspect = True
+            else:
+                conn.last_used = time.monotonic()
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def _call(self, request, *args):
+        """Runs request(sockfile, *args) on a pooled connection, retrying
+        on a fresh connection if this one breaks."""
+        attempt = 0
+        while True:
+            conn = None
+            try:
+                conn = self._acquire()
+                res = request(conn.sockfile, *args)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                if conn is not None:
+                    self._release(conn, True)
+                if attempt >= self._retries:
+                    with self._cond:
+                        self._failures += 1
+                    raise
+                time.sleep(self._retry_delay * 2**attempt)
+                attempt += 1
+                with self._cond:
+                    self._retried += 1
+                continue
+            except:
+                # the connection is in an unknown state
+                if conn is not None:
+                    self._release(conn, True)
+                raise
+            self._release(conn)
+            return res
+
+    def pool_stats(self, reset=False):
+        """Returns a dictionary with the pool size, the connections open
+        and idle, how many requests took a connection and how many of
+        them had to wait (with the total and longest wait in seconds),
+        and the counts of health checks, reconnects (new connections
+        replacing broken ones), retried requests and requests that
+        failed after all retries."""
+        with self._cond:
+            res = {
+                'pool_size': self._pool_size,
+                'open': self._conns,
+                'idle': len(self._idle),
+                'acquires': self._acquires,
+                'waits': self._waits,
+                'wait_seconds': self._wait_time,
+                'max_wait_seconds': self._max_wait,
+                'health_checks': self._health_checks,
+                'reconnects': self._reconnects,
+                'retries': self._retried,
+                'failures': self._failures,
+            }
+            if reset:
+                self._reset_pool_counts()
+        return res
+
+    def comm_stats(self, reset=False):
+        """Returns the byte counts for all connections, as a dictionary
+        like commstats.CommStats.snapshot()."""
+        return self._stats.snapshot(reset)
+
+    def _get_max_size(self, sockfile):
+        sockfile.op = OP_NAMES[MAX_SIZE]
+        sockfile.write(MAX_SIZE)
+        sockfile.flush()
+        return pickle.load(sockfile)
+
+    def stats(self, reset=False):
+        """Fetches the counters from the oracle server.
+
+        Returned is a dictionary with the server's byte counts under
+        'server' and the oracle's own counts (see oracle.Oracle.stats)
+        under 'oracle'. The local pool_stats() are added under 'pool'.
+        """
+        with trace.span('nworacle.stats'):
+            res = self._call(self._stats_request, reset)
+        res['pool'] = self.pool_stats(reset)
+        return res
+
+    def _stats_request(self, sockfile, reset):
+        # send opcode and reset flag
+        sockfile.op = OP_NAMES[STATS]
+        sockfile.write(STATS)
+        pickle.dump(reset, sockfile)
+        sockfile.flush()
+
+        return pickle.load(sockfile)
+
     def partition(self, needles, haystack, nkey=identity, haykey=identity):
         """Just like partition() in oracle.Oracle."""
+        with trace.span('nworacle.partition'):
+            # keep the needles in case the request must be retried
+            return self._call(self._partition, list(needles), haystack, nkey, haykey)
+
+    def _partition(self, sockfile, needles, haystack, nkey, haykey):
         # send opcode
-        self._sockfile.write(PARTITION)
+        sockfile.op = OP_NAMES[PARTITION]
+        sockfile.write(PARTITION)
 
         # send haystack and haykey
-        pickle.dump(haystack, self._sockfile)
-        pickle.dump(haykey, self._sockfile)
+        pickle.dump(haystack, sockfile)
+        pickle.dump(haykey, sockfile)
 
         # send nkey
-        pickle.dump(nkey, self._sockfile)
+        pickle.dump(nkey, sockfile)
 
         # do partition
-        res = self._send_rec_stream(needles)
-
-        return res
+        return self._send_rec_stream(sockfile, needles)
 
     def partition_sort(self, needles, haystack, nkey=identity, haykey=identity):
         """Just like partition_sort() in oracle.Oracle."""
+        with trace.span('nworacle.partition_sort'):
+            return self._call(self._partition_sort, list(needles), haystack, nkey, haykey)
+
+    def _partition_sort(self, sockfile, needles, haystack, nkey, haykey):
         # send opcode
-        self._sockfile.write(PARTITION_SORT)
+        sockfile.op = OP_NAMES[PARTITION_SORT]
+        sockfile.write(PARTITION_SORT)
 
         # send haystack and haykey
-        pickle.dump(haystack, self._sockfile)
-        pickle.dump(haykey, self._sockfile)
-        self._sockfile.flush()
+        pickle.dump(haystack, sockfile)
+        pickle.dump(haykey, sockfile)
+        sockfile.flush()
 
         # receive sorted haystack
-        shay = pickle.load(self._sockfile)
+        with trace.span('nworacle.receive_sorted'):
+            shay = pickle.load(sockfile)
 
         # send nkey
-        pickle.dump(nkey, self._sockfile)
+        pickle.dump(nkey, sockfile)
 
         # do the partition
-        res = self._send_rec_stream(needles)
+        res = self._send_rec_stream(sockfile, needles)
 
         return shay, res
 
-    def _send_rec_stream(self, outvals):
+    def _send_rec_stream(self, sockfile, outvals):
         """Convenience method to send and receive a stream of the same length,
         buffered according to global variable BUFSIZE."""
+        with trace.span('nworacle.stream'):
+            return self._send_rec_buffered(sockfile, outvals)
+
+    def _send_rec_buffered(self, sockfile, outvals):
         res = []
         
         count = 0
         for x in outvals:
-            pickle.dump(x, self._sockfile)
+            pickle.dump(x, sockfile)
             count += 1
             
             # stop sending and receive some results
             if count == BUFSIZE:
-                self._sockfile.flush()
-                res.extend(pickle.load(self._sockfile) for _ in range(BUFSIZE))
+                sockfile.flush()
+                res.extend(pickle.load(sockfile) for _ in range(BUFSIZE))
                 count = 0
 
         # indicate end
-        pickle.dump(None, self._sockfile)
-        self._sockfile.flush()
+        pickle.dump(None, sockfile)
+        sockfile.flush()
 
         # receive any remaining results
-        res.extend(pickle.load(self._sockfile) for _ in range(count))
+        res.extend(pickle.load(sockfile) for _ in range(count))
 
         return res
 
     def find(self, needles, haystack, nkey=identity, haykey=identity):
         """Just like find() in oracle.Oracle."""
+        with trace.span('nworacle.find'):
+            return self._call(self._find, list(needles), haystack, nkey, haykey)
+
+    def _find(self, sockfile, needles, haystack, nkey, haykey):
         # send opcode
-        self._sockfile.write(FIND)
+        sockfile.op = OP_NAMES[FIND]
+        sockfile.write(FIND)
 
         # send haystack and haykey
-        pickle.dump(haystack, self._sockfile)
-        pickle.dump(haykey, self._sockfile)
+        pickle.dump(haystack, sockfile)
+        pickle.dump(haykey, sockfile)
 
         # send nkey
-        pickle.dump(nkey, self._sockfile)
+        pickle.dump(nkey, sockfile)
 
         # find everything
-        res = self._send_rec_stream(needles)
-
-        return res
+        return self._send_rec_stream(sockfile, needles)
 
 
 class OracleHandler(socketserver.BaseRequestHandler):
     # Note: must have field "orc" added to point to the underlying Oracle instance
+    # The field "stats" is a CommStats shared by all connections.
+    # If "lock" is set, requests from different connections take turns.
+    stats = None
+    lock = None
 
     def handle(self):
-        with self.request.makefile('rwb') as sockfile:
+        if self.stats is None:
+            self.stats = commstats.CommStats()
+        # every request ends in a flush, so don't let replies wait for ACKs
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        raw = self.request.makefile('rwb')
+        counted = commstats.CountingFile(raw, self.stats)
+        with compress.FramedFile(counted, self.stats) as sockfile:
             if DEBUG: print("Connection open")
             while True:
                 # receive opcode
+                sockfile.op = None
                 opcode = sockfile.read(1)
                 if not opcode:
                     if DEBUG: print("Connection closed")
                     return
-                elif opcode == PARTITION:
-                    if DEBUG: print("Received PARTITION request")
-                    self.partition(sockfile)
-                elif opcode == PARTITION_SORT:
-                    if DEBUG: print("Received PARTITION_SORT request")
-                    self.partition_sort(sockfile)
-                elif opcode == FIND:
-                    if DEBUG: print("Received FIND request")
-                    self.find(sockfile)
-                elif opcode == MAX_SIZE:
-                    if DEBUG: print("Received MAX_SIZE request")
-                    pickle.dump(self.orc.max_size, sockfile)
-                    sockfile.flush()
-                else:
-                    raise RuntimeError("ORACLE ERROR: invalid opcode", opcode)
+                sockfile.op = OP_NAMES.get(opcode, 'invalid')
+                with trace.span(SERVE_SPANS.get(opcode, 'nworacle.serve')):
+                    self.serve(opcode, sockfile)
                 if DEBUG:
                     print("(finished request)")
                     print()
 
+    def serve(self, opcode, sockfile):
+        """Handles one request, taking turns with the other connections
+        if there is a lock."""
+        if self.lock:
+            with self.lock:
+                self.dispatch(opcode, sockfile)
+        else:
+            self.dispatch(opcode, sockfile)
+
+    def dispatch(self, opcode, sockfile):
+        """Handles one request with the given opcode."""
+        if opcode == PARTITION:
+            if DEBUG: print("Received PARTITION request")
+            self.partition(sockfile)
+        elif opcode == PARTITION_SORT:
+            if DEBUG: print("Received PARTITION_SORT request")
+            self.partition_sort(sockfile)
+        elif opcode == FIND:
+            if DEBUG: print("Received FIND request")
+            self.find(sockfile)
+        elif opcode == MAX_SIZE:
+            if DEBUG: print("Received MAX_SIZE request")
+            pickle.dump(self.orc.max_size, sockfile)
+            sockfile.flush()
+        elif opcode == STATS:
+            if DEBUG: print("Received STATS request")
+            self.send_stats(sockfile)
+        elif opcode == COMPRESS:
+            if DEBUG: print("Received COMPRESS request")
+            compress.accept(sockfile)
+        else:
+            raise RuntimeError("ORACLE ERROR: invalid opcode", opcode)
+
+    def send_stats(self, sockfile):
+        # read the reset flag
+        reset = pickle.load(sockfile)
+
+        pickle.dump({
+            'server': self.stats.snapshot(reset),
+            'oracle': self.orc.stats(reset),
+        }, sockfile)
+        sockfile.flush()
+
     def stream_until_none(self, sockfile):
         while True:
             obj = pickle.load(sockfile)
@@ -264,8 +605,17 @@ class OracleHandler(socketserver.BaseRequestHandler):
 
         sockfile.flush()
 
-def get_oracle_server(the_oracle, hostname, port):
-    """Creates a socketserver to relay requests to given oracle."""
+def get_oracle_server(the_oracle, hostname, port, threaded=True):
+    """Creates a socketserver to relay requests to given oracle.
+    If threaded, several connections can be open at once, each in its
+    own thread, but their requests are still handled one at a time.
+    Otherwise only one connection is served, so pooled clients hang."""
     class Handler(OracleHandler):
         orc = the_oracle
+        stats = commstats.CommStats()
+        lock = threading.Lock() if threaded else None
+    if threaded:
+        server = socketserver.ThreadingTCPServer((hostname, port), Handler)
+        server.daemon_threads = True
+        return server
     return socketserver.TCPServer((hostname, port), Handler)
@@ -61,6 +61,13 @@ class OpeClient:
     def size(self):
         return self._serv.size()
 
+    def stats(self, reset=False):
+        """Returns the server's stats() under 'tree', if it has any, like
+        nwopec.NwOpeClient.stats()."""
+        if hasattr(self._serv, 'stats'):
+            return {'tree': self._serv.stats(reset)}
+        return {}
+
     def traverse(self):
         for (k,v) in self._serv.traverse():
             yield self._crypt.decode(k), self._crypt.decode(v)
@@ -11,6 +11,10 @@ mutable OPE schemes.
 """
 
 import bisect
+import pickle
+
+from ope import commstats
+from ope import trace
 
 def identity(x):
     """Convienient definition of the identity function."""
@@ -20,22 +24,30 @@ class Oracle:
     """Accessed by an OPE back-end server in order to determine the order
     of elements.
 
-    Also includes bookkeeping information on communication sizes.
+    Also includes bookkeeping information on communication sizes, as
+    rounds and item counts, and optionally as the number of bytes the
+    same requests would take when pickled over the network (see
+    nworacle).
     """
 
-    def __init__(self, crypt, size):
+    def __init__(self, crypt, size, count_bytes=False):
         """Create a new comparison oracle.
 
         crypt is the encryption algorithm which should provide encode()
         and decode() functions.
 
         size is the maximum size of local (non-streaming) storage.
+
+        If count_bytes is true, the byte counts are kept too. That means
+        pickling everything, which makes every call much slower.
         """
         self.crypt = crypt
+        self.count_bytes = count_bytes
         self._data_in = 0
         self._data_out = 0
         self._rounds = 0
         self._tsize = size
+        self._stats = commstats.CommStats()
 
     @property
     def max_size(self):
@@ -55,18 +67,28 @@ class Oracle:
         If nkey or haykey or given, they are key functions to extract the
         comparison ciphertext from the given objects.
         """
-        self._data_in += len(haystack)
-        self._rounds += 1
-        assert len(haystack) <= self.max_size
-        # check the haystack is actually sorted
-        sdhay = sorted(self.crypt.decode(haykey(x)) for x in haystack)
-        assert all(sdhay[i] <= sdhay[i+1]
-            for i in range(len(haystack)-1))
+        self._count_request('partition', haystack)
+        self._count_round(haystack)
+        return self._partition(needles, haystack, nkey, haykey, 'partition')
+
+    def _partition(self, needles, haystack, nkey, haykey, op):
+        with trace.span('oracle.partition'):
+            # check the haystack is actually sorted
+            sdhay = sorted(self.crypt.decode(haykey(x)) for x in haystack)
+            assert all(sdhay[i] <= sdhay[i+1]
+                for i in range(len(haystack)-1))
+        # the needles may stream in over the network as the answers go
+        # out, so each one is answered in a span of its own, closed
+        # before the answer is yielded
         for needle in needles:
-            self._data_in += 1
-            self._data_out += 1
-            dk = self.crypt.decode(nkey(needle))
-            yield (needle, bisect.bisect_left(sdhay, dk))
+            with trace.span('oracle.answer'):
+                self._data_in += 1
+                self._data_out += 1
+                dk = self.crypt.decode(nkey(needle))
+                res = (needle, bisect.bisect_left(sdhay, dk))
+                if self.count_bytes:
+                    self._count_result(op, needle, res)
+            yield res
 
     def partition_sort(self, needles, haystack, nkey=identity, haykey=identity):
         """First sorts the haystack, then performs partition on that
@@ -74,13 +96,23 @@ class Oracle:
 
         Returns the sorted haystack, and then the result of partition.
         """
-        shay = self.sort(haystack, haykey)
-        return shay, self.partition(needles, shay, nkey, haykey)
+        shay = self._sort(haystack, haykey, 'partition_sort')
+        # streaming the needles is a second round trip
+        self._stats.add_round_trip()
+        self._count_round(shay)
+        return shay, self._partition(needles, shay, nkey, haykey, 'partition_sort')
 
     def sort(self, haystack, haykey):
-        shay = sorted(haystack,
-            key=lambda x: (self.crypt.decode(haykey(x))))
+        return self._sort(haystack, haykey, 'sort')
+
+    def _sort(self, haystack, haykey, op):
+        self._count_request(op, haystack)
+        with trace.span('oracle.sort'):
+            shay = sorted(haystack,
+                key=lambda x: (self.crypt.decode(haykey(x))))
         self._data_out += len(shay)
+        if self.count_bytes:
+            self._stats.add_bytes(op, commstats.SENT, _pickled_size(shay))
         return shay
 
     def find(self, needles, haystack, nkey=identity, haykey=identity):
@@ -89,20 +121,47 @@ class Oracle:
         Returned is a iteration of (needle, index) pairs, where 
         a negative index indicates the needle was not found.
         """
+        self._count_request('find', haystack)
+        self._count_round(haystack)
+        return self._find(needles, haystack, nkey, haykey)
+
+    def _find(self, needles, haystack, nkey, haykey):
+        with trace.span('oracle.find'):
+            sdhay = sorted((self.crypt.decode(haykey(x)), ind)
+                for (ind,x) in enumerate(haystack))
+        for needle in needles:
+            with trace.span('oracle.answer'):
+                self._data_in += 1
+                self._data_out += 1
+                dk = self.crypt.decode(nkey(needle))
+                found = bisect.bisect_left(sdhay, (dk, 0))
+                if found < len(sdhay) and sdhay[found][0] == dk:
+                    res = (needle, sdhay[found][1])
+                else:
+                    res = (needle, -1 - found)
+                if self.count_bytes:
+                    self._count_result('find', needle, res)
+            yield res
+
+    def _count_request(self, op, haystack):
+        """Counts one round trip that sends the given haystack."""
+        self._stats.add_request(op)
+        self._stats.add_round_trip()
+        if self.count_bytes:
+            self._stats.add_bytes(op, commstats.RECEIVED, _pickled_size(haystack))
+
+    def _count_round(self, haystack):
+        """Counts the round and haystack items of a partition or find,
+        when it is asked for rather than when its answers are read, just
+        like _count_request()."""
+        assert len(haystack) <= self.max_size
         self._data_in += len(haystack)
         self._rounds += 1
-        assert len(haystack) <= self.max_size
-        sdhay = sorted((self.crypt.decode(haykey(x)), ind)
-            for (ind,x) in enumerate(haystack))
-        for needle in needles:
-            self._data_in += 1
-            self._data_out += 1
-            dk = self.crypt.decode(nkey(needle))
-            found = bisect.bisect_left(sdhay, (dk, 0))
-            if found < len(sdhay) and sdhay[found][0] == dk:
-                yield (needle, sdhay[found][1])
-            else:
-                yield (needle, -1 - found)
+
+    def _count_result(self, op, needle, result):
+        """Counts the bytes for one needle in and one result out."""
+        self._stats.add_bytes(op, commstats.RECEIVED, _pickled_size(needle))
+        self._stats.add_bytes(op, commstats.SENT, _pickled_size(result))
 
     def comm_in(self, reset=False):
         """Returns the total communication size so far."""
@@ -133,8 +192,26 @@ class Oracle:
             self.max_size,
         ]
 
+    def stats(self, reset=False):
+        """Returns a dictionary with the byte counts per operation and
+        direction (as in commstats.CommStats.snapshot, all zero unless
+        count_bytes is on), plus the item counts items_in, items_out,
+        rounds and max_size."""
+        res = self._stats.snapshot(reset)
+        res['items_in'], res['items_out'], res['rounds'], res['max_size'] = (
+            self.counts(reset))
+        return res
+
     def counts_summary(self, reset=False):
-        """Prints counts data nicely."""
+        """Prints counts data nicely.
+
+        For timings as well, install a trace.HistogramTracer instead.
+        """
         ci, co, cr, ms = self.counts(reset)
         print("Over {} rounds, transferred {} to Cmp and {} from Cmp. Max size {}."
             .format(cr,ci,co,ms))
+
+
+def _pickled_size(obj):
+    """The number of bytes obj takes when pickled on its own."""
+    return len(pickle.dumps(obj))
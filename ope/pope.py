@@ -12,78 +12,434 @@ to the the server. The data structure itself is based on buffer
 trees, and comparisons are only performed on search operations.
 The performance is best when the number of insertions vastly outnumbers
 the number of range queries.
+
+A reader can pin a consistent Snapshot of the tree with snapshot(), and
+scan it while writers keep changing the tree. Nodes are copied on
+write: the first change to a node that a pinned snapshot can still see
+moves its lists aside for the snapshot, and releasing the snapshot
+frees the old versions that no other snapshot needs.
 """
 
+import bisect
 import random
 import itertools
+import collections
+import secrets
+import threading
+import time
+
+from ope import rangecache
+from ope import trace
+from ope import validate
 
 class Pope:
     """Abstraction for the cloud database server. Can perform lookups,
     insertions, and range searches on encrypted keys, provided an
     oracle to partition and sort ciphertexts."""
 
-    def __init__(self, oracle):
+    max_cursors = 1000 # how many unfinished paged range searches to keep
+    cursor_ttl = 300 # seconds an unused cursor is kept
+
+    def __init__(self, oracle, cache_size=0, validation=None):
         """Creates a new, initially empty, storage backend, relying
         on the given comparison oracle.
+
+        If cache_size is positive, range search results are cached,
+        holding at most that many (key,value) pairs in total.
+
+        validation is a level from the validate module, or a Validator.
         """
         self._cmp = oracle
+        self._valid = validate.get_validator(validation, oracle)
         self._tsize = self._cmp.max_size
+        # changes are made in _epoch; each snapshot pins an earlier one.
+        # _pins lists the pinned epochs in order, and _held maps each one
+        # to the (node, version) pairs it is the newest pin to see.
+        self._epoch = 0
+        self._pins = []
+        self._newest_pin = -1
+        self._pin_lock = threading.Lock()
+        self._held = {}
+        self._copied = 0
+        self._reclaimed = 0
+        # _levels[h] holds [# nodes, total sorted, total buffers]
+        # for the nodes at height h, so leaves are at _levels[0].
+        self._levels = []
         self._root = LeafNode(self, None)
+        self._inserted = 0
+        self._cache = rangecache.RangeCache(cache_size) if cache_size > 0 else None
+        # cursor -> (results, limit, snapshot, owner, last used), from
+        # least to most recently used
+        self._cursors = collections.OrderedDict()
+        self._cursor_lock = threading.Lock()
+        self._watchers = []
 
     def clear(self):
+        """Removes everything. Snapshots pinned before this keep seeing
+        the old tree until they are released."""
+        self._valid.reset()
+        self._levels = []
         self._root = LeafNode(self, None)
+        self._expire_cursors(lambda entry: True)
+        if self._cache is not None:
+            self._cache.clear()
+
+    def snapshot(self):
+        """Pins the current state of the tree, and returns a Snapshot
+        to read it from until its release().
+
+        Must not be called while another thread is changing the tree.
+        """
+        with self._pin_lock:
+            epoch = self._epoch
+            self._epoch += 1
+            self._pins.append(epoch)
+            self._newest_pin = epoch
+            self._held[epoch] = []
+        return Snapshot(self, epoch, self._root, self.size())
+
+    def _unpin(self, epoch):
+        """Releases the snapshot of the given epoch. The old versions it
+        was the newest pin to see go to the next older pin that sees
+        them, or are dropped if there is none."""
+        with self._pin_lock:
+            del self._pins[bisect.bisect_left(self._pins, epoch)]
+            self._newest_pin = self._pins[-1] if self._pins else -1
+            for node, version in self._held.pop(epoch):
+                # the pins that see a version are those from its stamp on
+                ind = bisect.bisect_left(self._pins, epoch) - 1
+                if ind >= 0 and self._pins[ind] >= version[0]:
+                    self._held[self._pins[ind]].append((node, version))
+                else:
+                    node.history = [old for old in node.history if old is not version]
+                    self._reclaimed += 1
+
+    def _cow(self, node):
+        """Called before node is changed in place. If a pinned snapshot
+        can still see the node as it is, its lists are kept in its
+        history for the snapshot, and it carries on with copies."""
+        if node.stamp == self._epoch:
+            return
+        if self._newest_pin < node.stamp:
+            node.stamp = self._epoch
+            return
+        with self._pin_lock:
+            if self._newest_pin < node.stamp:
+                # released in the meantime
+                node.stamp = self._epoch
+                return
+            version = (node.stamp, node.state())
+            node.history = node.history + [version]
+            self._held[self._pins[-1]].append((node, version))
+            self._copied += 1
+            node.stamp = self._epoch
+        # readers take the lists before checking the stamp, so only
+        # replace them now
+        node.fresh()
+
+    def watch(self, callback):
+        """Registers callback to be called with the list of keys that a
+        leaf split promotes into the internal nodes, in sorted order,
+        every time that happens. Those are exactly the keys whose order
+        is revealed to the server."""
+        self._watchers.append(callback)
+
+    def _promoted(self, keys):
+        for callback in self._watchers:
+            callback(keys)
 
     def insert(self, key, val):
         assert val is not None
+        if self._cursors:
+            # abandoned cursors make every insert copy nodes for them
+            self._expire_stale_cursors()
         self._root.insert(key, val)
+        self._inserted += 1
+        if self._cache is not None and isinstance(self._root, LeafNode):
+            self._cache.landed_leaf(self._root)
+        self._valid.done(self)
 
     def split(self, keys):
         """Prepares to search for any of the keys in the given list.
 
-        The keys must be sorted in plaintext order.
+        The keys should be sorted in plaintext order; if not, the
+        results come back grouped by leaf instead of in the keys' order.
         After this, a lookup or range search for any of those keys will
         only cost O(height).
         Returns a list of (label, leaf node) tuples.
         """
         # can only deal in size-L chunks.
         assert len(keys) <= self._tsize
-        splits = list(self._root.split(keys))
-        for _, leaf in splits:
-            if leaf.parent:
-                leaf.parent.rebalance()
+        with trace.span('pope.split'):
+            splits = list(self._root.split(keys))
+        with trace.span('pope.rebalance'):
+            for _, leaf in splits:
+                if leaf.parent:
+                    leaf.parent.rebalance()
+        self._valid.done(self)
         return splits
 
     def lookup(self, key):
         """Returns the corresponding value, or None if not found."""
-        [(_, leaf)] = self.split([key])
-        return leaf.lookup(key)
+        with trace.span('pope.lookup'):
+            [(_, leaf)] = self.split([key])
+            return leaf.lookup(key)
     
-    def range_search(self, key1, key2):
-        [(_1, node1), (_2, node2)] = self.split([key1,key2])
-        # left_ind and right_ind are the actual keys at the leaf level.
-        # at higher levels, they are child nodes.
-        left_ind, right_ind = key1, key2
-        result = []
-        while node1 != node2:
-            assert node1 is not None and node2 is not None
-            result.extend(node1.range_right(key1))
-            result.extend(node2.range_left(key2))
-            key1, key2 = node1, node2
-            node1, node2 = node1.parent, node2.parent
-        result.extend(node1.range_search(key1, key2))
-        return result
+    def search_many(self, queries):
+        """Answers many lookups and range searches at once, sharing the
+        oracle rounds of their splits.
+
+        queries is a list of ('lookup', key) and ('range_search', key1,
+        key2) tuples, which need not be in any order. All their keys are
+        split together, L at a time, and the results are returned in a
+        list in the same order as the queries. The range cache is not
+        used.
+        """
+        with trace.span('pope.search_many'):
+            keys = list(dict.fromkeys(
+                itertools.chain.from_iterable(query[1:] for query in queries)))
+            leaves = {}
+            for i in range(0, len(keys), self._tsize):
+                # leaves found by earlier chunks are not split again,
+                # since nothing new was inserted in between
+                leaves.update(self.split(keys[i:i+self._tsize]))
+            results = []
+            for query in queries:
+                if query[0] == 'lookup':
+                    results.append(leaves[query[1]].lookup(query[1]))
+                elif query[0] == 'range_search':
+                    _, key1, key2 = query
+                    results.append(list(self._iter_range(
+                        key1, key2, leaves[key1], leaves[key2])))
+                else:
+                    raise ValueError("unknown query", query[0])
+            return results
+
+    def range_search(self, key1, key2, limit=None, owner=None):
+        """Returns all (key,value) pairs with key1 < key <= key2.
+
+        If limit is given, returns a list of at most that many pairs,
+        along with a cursor to pass to range_next() for the rest
+        (or None if there are no more). All the pages come from the tree
+        as it was when the search started. Only the same owner (such as
+        the connection that asked) can continue the search, and
+        drop_cursors(owner) ends all of its searches.
+        """
+        with trace.span('pope.range_search'):
+            if self._cache is not None:
+                cached = self._cache.fresh(key1, key2, self._inserted)
+                if cached is not None:
+                    return cached if limit is None else self._page(
+                        iter(cached), limit, None, owner)
+            [(_1, node1), (_2, node2)] = self.split([key1,key2])
+            if self._cache is not None:
+                cached = self._cache.get(key1, key2, node1, node2, self._inserted)
+                if cached is not None:
+                    return cached if limit is None else self._page(
+                        iter(cached), limit, None, owner)
+            if limit is not None:
+                # later pages are read from the tree as it is now
+                snap = self.snapshot()
+                return self._page(self._iter_range(key1, key2, node1, node2, snap),
+                                  limit, snap, owner)
+            result = list(self._iter_range(key1, key2, node1, node2))
+            if self._cache is not None:
+                self._cache.put(key1, key2, node1, node2, result, self._inserted)
+            return result
+
+    def range_scan(self, key1, key2):
+        """Starts a range search whose results can be read after other
+        changes to the tree, for a server that sends them without
+        holding up the writers.
+
+        Returns an iterator over the same pairs as range_search(), and
+        the Snapshot it reads from, which the caller must release once
+        done (None if the results came from, or went into, the range
+        cache). Only the split and the two end leaves use the oracle.
+        """
+        with trace.span('pope.range_scan'):
+            if self._cache is not None:
+                return iter(self.range_search(key1, key2)), None
+            [(_1, node1), (_2, node2)] = self.split([key1,key2])
+            snap = self.snapshot()
+            return self._iter_range(key1, key2, node1, node2, snap), snap
+
+    def range_next(self, cursor, limit=None, owner=None):
+        """Continues a range search from where the given cursor left off,
+        without splitting again. owner must be the one that started it.
+
+        Returns the next page and a new cursor, just like range_search().
+        The page size defaults to the limit of the original search.
+        """
+        with self._cursor_lock:
+            entry = self._cursors.get(cursor)
+            if entry is None or entry[3] is not owner:
+                raise ValueError("unknown or expired cursor", cursor)
+            del self._cursors[cursor]
+        results, deflimit, snap, _, __ = entry
+        return self._page(results, deflimit if limit is None else limit, snap, owner)
+
+    def drop_cursors(self, owner):
+        """Ends all the unfinished paged range searches of owner, for
+        instance when its connection closes. Can be called from any
+        thread."""
+        self._expire_cursors(lambda entry: entry[3] is owner)
+
+    def _page(self, results, limit, snap=None, owner=None):
+        """Takes one page of at most limit items from the results iterator,
+        and saves the rest under a new cursor, along with the Snapshot
+        they are read from, if any, which is released once they run out
+        or the cursor expires."""
+        assert limit >= 1
+        page = list(itertools.islice(results, limit+1))
+        if len(page) <= limit:
+            if snap is not None:
+                snap.release()
+            return page, None
+        # hard to guess, so one owner cannot stumble on another's
+        cursor = secrets.token_hex(8)
+        with self._cursor_lock:
+            self._cursors[cursor] = (itertools.chain([page.pop()], results),
+                                     limit, snap, owner, time.monotonic())
+        self._expire_stale_cursors()
+        return page, cursor
+
+    def _expire_stale_cursors(self):
+        """Expires the cursors unused for cursor_ttl seconds, and the
+        least recently used ones beyond max_cursors."""
+        cutoff = time.monotonic() - self.cursor_ttl
+        snaps = []
+        with self._cursor_lock:
+            while self._cursors:
+                cursor, entry = next(iter(self._cursors.items()))
+                if len(self._cursors) <= self.max_cursors and entry[4] >= cutoff:
+                    break
+                del self._cursors[cursor]
+                snaps.append(entry[2])
+        for snap in snaps:
+            if snap is not None:
+                snap.release()
+
+    def _expire_cursors(self, which):
+        """Expires the cursors whose entries which() is true for."""
+        with self._cursor_lock:
+            doomed = [cursor for cursor, entry in self._cursors.items() if which(entry)]
+            snaps = [self._cursors.pop(cursor)[2] for cursor in doomed]
+        for snap in snaps:
+            if snap is not None:
+                snap.release()
+
+    def _iter_range(self, key1, key2, node1, node2, snap=None):
+        """Iterates through the results of a range search in left-to-right
+        order, after the keys have been split down to leaves node1 and node2.
+
+        The two end leaves are searched right away. The subtrees in
+        between are only visited as the iteration reaches them, as they
+        are in snap if one is given (which must be pinned right after
+        the split), or else as they are by then.
+        """
+        if node1 is node2:
+            return iter(list(node1.range_search(key1, key2)))
+        # climb up both paths until they meet, collecting the subtrees
+        # that lie in between.
+        left, right = [], []
+        child1, child2 = node1, node2
+        par1, par2 = node1.parent, node2.parent
+        while par1 is not par2:
+            assert par1 is not None and par2 is not None
+            left.extend(par1.children[par1.children.index(child1)+1:])
+            right.append(par2.children[:par2.children.index(child2)])
+            child1, child2 = par1, par2
+            par1, par2 = par1.parent, par2.parent
+        middle = par1.children[
+            par1.children.index(child1)+1 : par1.children.index(child2)]
+        subtrees = left + middle + list(itertools.chain.from_iterable(reversed(right)))
+        visit = snap._subtree if snap is not None else (lambda sub: sub.traverse())
+        return itertools.chain(
+            list(node1.range_right(key1)),
+            itertools.chain.from_iterable(visit(sub) for sub in subtrees),
+            list(node2.range_left(key2)))
 
     def size(self):
-        return self._root.size()
+        return sum(items for _, __, items in self._levels)
 
     def height(self):
-        return self._root.height()
+        return len(self._levels) - 1
     
     def num_nodes(self):
-        return self._root.num_nodes()
+        return sum(nodes for nodes, _, __ in self._levels)
+
+    def _count(self, level, nodes=0, keys=0, items=0):
+        """Updates the per-level totals of nodes, sorted keys and
+        buffered items."""
+        if level == len(self._levels):
+            self._levels.append([0,0,0])
+        counts = self._levels[level]
+        counts[0] += nodes
+        counts[1] += keys
+        counts[2] += items
+
+    def stats(self, reset=False):
+        """Returns a snapshot of the shape of the tree and the counters,
+        without traversing the tree.
+
+        levels lists the nodes, sorted keys and buffered items at each
+        level from the root down. pending is the number of items still
+        waiting in internal node buffers to be pushed down.
+        """
+        levels = [{'nodes': nodes, 'sorted': keys, 'buffered': items}
+                  for nodes, keys, items in reversed(self._levels)]
+        res = {
+            'size': self.size(),
+            'height': self.height(),
+            'nodes': self.num_nodes(),
+            'levels': levels,
+            'pending': sum(items for _, __, items in self._levels[1:]),
+            'inserted': self._inserted,
+            'cursors': len(self._cursors),
+            'cache': self.cache_counts(reset),
+            'max_size': self._tsize,
+            'snapshots': self.snapshot_counts(reset),
+        }
+        if hasattr(self._cmp, 'stats'):
+            res['oracle'] = self._cmp.stats(reset)
+        return res
 
     def traverse(self):
-        return self._root.traverse()
+        """Iterates through all (key,value) pairs, a node at a time. Each
+        node's span only times finding its items, not their consumer."""
+        stack = [self._root]
+        while stack:
+            with trace.span('pope.traverse_node'):
+                node = stack.pop()
+                items = node.buffer
+                if isinstance(node, InternalNode):
+                    stack.extend(reversed(node.children))
+            yield from items
+
+    def snapshot_counts(self, reset=False):
+        """Returns a dictionary with the number of snapshots pinned, the
+        nodes and old versions kept for them, and the versions copied on
+        write and reclaimed so far."""
+        with self._pin_lock:
+            held = [pair for pairs in self._held.values() for pair in pairs]
+            res = {
+                'pinned': len(self._pins),
+                'nodes': len(set(id(node) for node, _ in held)),
+                'versions': len(held),
+                'copied': self._copied,
+                'reclaimed': self._reclaimed,
+            }
+            if reset:
+                self._copied = self._reclaimed = 0
+        return res
+
+    def cache_counts(self, reset=False):
+        """Returns (hits, misses, evictions, entries, items) for the
+        range search cache, or None if caching is off."""
+        if self._cache is None:
+            return None
+        return self._cache.counts(reset)
 
     def check(self, full=False, info=False):
         """For debugging. Check structure is valid.
@@ -92,21 +448,130 @@ class Pope:
         """
         sizes = [[0,0,0] for _ in range(self._root.height()+1)]
         self._root.check(sizes, 0, full)
+        assert sizes == self._levels[::-1]
         if info:
             for (i,(nodes, ss, bs)) in enumerate(sizes):
                 print("level {}: {} nodes, {} sorted, {} buffers".format(i,nodes,ss,bs))
             tn,ts,bs = (sum(L) for L in zip(*sizes))
             print("TOTAL: {} nodes, {} sorted, {} buffers".format(tn,ts,bs))
 
+    def check_node(self, node, full=False):
+        """Checks a single node and its links to its parent and children.
+        If full==True, also checks that its keys are in order and within
+        the bounds set by the parent. Used by validate.Validator.
+        """
+        node.check_local()
+        if node.parent is None:
+            assert self._root is node
+        else:
+            assert node.level + 1 == node.parent.level
+        if full:
+            decode = self._cmp.crypt.decode
+            if isinstance(node, InternalNode):
+                su = [decode(k) for k in node.sorted]
+                assert su == sorted(su)
+            if node.parent is not None:
+                ind = node.parent.children.index(node)
+                psorted = node.parent.sorted
+                lo = decode(psorted[ind-1]) if ind > 0 else None
+                hi = decode(psorted[ind]) if ind < len(psorted) else None
+                for k in node.keys():
+                    u = decode(k)
+                    assert (lo is None or lo < u) and (hi is None or u <= hi)
+
+class Snapshot:
+    """A read-only view of a Pope tree as it was when snapshot() was
+    called. Scans of it never change the tree or use the oracle, and are
+    not affected by changes to the tree, so they can run while other
+    threads keep inserting and searching. Use as a context manager, or
+    call release().
+    """
+
+    def __init__(self, serv, epoch, root, size):
+        self.serv = serv
+        self.epoch = epoch
+        self._root = root
+        self._size = size
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.serv._unpin(self.epoch)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, v, r):
+        self.release()
+
+    def size(self):
+        return self._size
+
+    def _state(self, node):
+        """The node's lists as of this snapshot: (buffer,) for a leaf,
+        (buffer, sorted, children) for an internal node."""
+        assert not self._released
+        state = node.state()
+        if node.stamp <= self.epoch:
+            return state
+        for stamp, old in reversed(node.history):
+            if stamp <= self.epoch:
+                return old
+        raise RuntimeError("node version already reclaimed")
+
+    def traverse(self):
+        """Iterates through all (key,value) pairs, a node at a time, like
+        Pope.traverse()."""
+        stack = [self._root]
+        while stack:
+            with trace.span('pope.snapshot_traverse_node'):
+                state = self._state(stack.pop())
+                if len(state) > 1:
+                    stack.extend(reversed(state[2]))
+            yield from state[0]
+
+    def _subtree(self, node):
+        """Iterates through the pairs under node, as of this snapshot."""
+        state = self._state(node)
+        yield from state[0]
+        if len(state) > 1:
+            for child in state[2]:
+                yield from self._subtree(child)
+
+
 class LeafNode:
     """Leaf node of the B tree. Contains the values as well as the keys."""
 
+    level = 0
+    # True when the buffer is larger than L after a split, which can
+    # only happen when every item in it has the same key.
+    repeated = False
+    # how many items at the start of the buffer are known to share a key
+    same = 0
+
     def __init__(self, serv, parent, buffer_list=None):
-        """serv is the Pope object that contains this node."""
+        """serv is the Pope object that contains this node.
+
+        Items in buffer_list are not counted as new in serv, since they
+        always come from splitting another leaf.
+        """
         self.serv = serv
         self.parent = parent
         self.buffer = buffer_list if buffer_list else []
+        self.stamp = serv._epoch
+        self.history = []
+        serv._count(0, nodes=1)
+        serv._valid.touch(self)
         
+    def state(self):
+        """The lists a Snapshot reads."""
+        return (self.buffer,)
+
+    def fresh(self):
+        """Replaces the lists with copies, after state() was saved."""
+        self.buffer = list(self.buffer)
+
     def size(self):
         return len(self.buffer)
 
@@ -119,29 +584,35 @@ class LeafNode:
     def insert(self, key, val):
         """Inserts the given (key,value) pair into the buffer."""
         assert val is not None
+        self.serv._cow(self)
         self.buffer.append((key,val))
+        self.repeated = False
+        self.serv._count(0, items=1)
+        self.serv._valid.touch(self)
 
     def lookup(self, key):
         """Returns the corresponding value, or None if not found."""
-        assert len(self.buffer) <= self.serv._tsize
-        [(_, ind)] = self.serv._cmp.find([key], self.buffer, haykey=first)
+        assert len(self.buffer) <= self.serv._tsize or self.repeated
+        # all the keys are the same in a repeated leaf, so one will do
+        hay = self.buffer[:1] if self.repeated else self.buffer
+        [(_, ind)] = self.serv._cmp.find([key], hay, haykey=first)
         return self.buffer[ind][1] if ind >= 0 else None
 
     def range_search(self, key1, key2):
         """Iterates through all (key,value) pairs in the range key1 <= key <= key2."""
-        assert len(self.buffer) <= self.serv._tsize
+        assert len(self.buffer) <= self.serv._tsize or self.repeated
         for item, ind in self.serv._cmp.partition(self.buffer, [key1, key2], nkey=first):
             if ind == 1: yield item
             
     def range_right(self, key1):
         """Iterates through all (key,value) pairs satisfying key >= key1."""
-        assert len(self.buffer) <= self.serv._tsize
+        assert len(self.buffer) <= self.serv._tsize or self.repeated
         for item, ind in self.serv._cmp.partition(self.buffer, [key1], nkey=first):
             if ind == 1: yield item
         
     def range_left(self, key2):
         """Iterates through all (key,value) pairs satisfying key <= key2."""
-        assert len(self.buffer) <= self.serv._tsize
+        assert len(self.buffer) <= self.serv._tsize or self.repeated
         for item, ind in self.serv._cmp.partition(self.buffer, [key2], nkey=first):
             if ind == 0: yield item
 
@@ -157,34 +628,71 @@ class LeafNode:
         """
         assert len(keys) <= self.serv._tsize
         result = []
+        pivots = None
         while keys and self.size() > self.serv._tsize:
             # do an L-way split
             # select L random keys to promote, sort them,
             # and partition everything according to those keys
-            promoted, partitions = self.serv._cmp.partition_sort(
-                itertools.chain(self.buffer, ((k,None) for k in keys)),
-                [k for k,v in random.sample(self.buffer, self.serv._tsize)],
-                nkey=first
-            )
-            # bucket[i] holds the key/value pairs for that new node.
-            buckets = [[] for _ in range(len(promoted)+1)]
-            key_buckets = [[] for _ in range(len(promoted)+1)]
-            for (k,v), ind in partitions:
-                if v is None:
-                    # k is a search key
-                    key_buckets[ind].append(k)
+            if pivots is None:
+                pivots = [k for k,v in random.sample(self.buffer, self.serv._tsize)]
+            with trace.span('pope.leaf_split'):
+                promoted, partitions = self.serv._cmp.partition_sort(
+                    itertools.chain(self.buffer, ((k,None) for k in keys)),
+                    pivots, nkey=first
+                )
+                pivots = None
+                top = promoted[-1]
+                # bucket[i] holds the key/value pairs for that new node.
+                buckets = [[] for _ in range(len(promoted)+1)]
+                key_buckets = [[] for _ in range(len(promoted)+1)]
+                for (k,v), ind in partitions:
+                    if v is None:
+                        # k is a search key
+                        key_buckets[ind].append(k)
+                    else:
+                        # (k,v) was in the buffer
+                        buckets[ind].append((k,v))
+            # eliminate empty nodes, which come from the last promoted
+            # value being the last key in order, or from duplicate keys
+            # being promoted more than once.
+            for i in reversed(range(len(buckets))):
+                if buckets[i]:
+                    continue
+                if i == len(buckets) - 1:
+                    key_buckets[i-1].extend(key_buckets[i])
+                    del promoted[i-1]
                 else:
-                    # (k,v) was in the buffer
-                    buckets[ind].append((k,v))
-            # eliminate empty nodes at the end
-            while not buckets[-1]:
-                # the last promoted value was the last key in order.
-                del buckets[-1]
-                key_buckets[-2].extend(key_buckets[-1])
-                del key_buckets[-1]
-                del promoted[-1]
+                    key_buckets[i+1][:0] = key_buckets[i]
+                    del promoted[i]
+                del buckets[i]
+                del key_buckets[i]
             assert all(bucket for bucket in buckets)
             assert len(buckets) == len(key_buckets) == len(promoted)+1
+            if len(buckets) == 1:
+                # every pivot had the same key, top, and nothing is
+                # larger. If every item has that key too, splitting
+                # cannot help; otherwise the sample missed the smaller
+                # keys, so pick the next pivots from those.
+                self.serv._cow(self)
+                self.buffer = buckets[0]
+                keys = key_buckets[0]
+                known = max(1, self.same)
+                checked = list(self.serv._cmp.find(
+                    self.buffer[:1] + self.buffer[known:], [top], nkey=first))
+                smaller = [item for item, ind in checked if ind < 0]
+                if checked[0][1] < 0:
+                    smaller.extend(self.buffer[1:known])
+                if not smaller:
+                    self.repeated = True
+                    self.same = len(self.buffer)
+                    break
+                pivots = [k for k,v in random.sample(
+                    smaller, min(len(smaller), max(1, self.serv._tsize - 1)))]
+                if len(pivots) < self.serv._tsize:
+                    pivots.append(top)
+                continue
+            if self.serv._watchers:
+                self.serv._promoted(list(promoted))
             # Grow a new root node if necessary
             if self.parent is None:
                 assert self.serv._root == self
@@ -196,13 +704,26 @@ class LeafNode:
                 if bkeys:
                     result.extend(newnode.split(bkeys))
             # this node will be from the final bucket.
+            self.serv._cow(self)
             self.buffer = buckets[-1]
+            self.same = 0
+            self.serv._valid.touch(self)
             keys = key_buckets[-1]
         if keys:
-            assert len(self.buffer) <= self.serv._tsize
+            assert len(self.buffer) <= self.serv._tsize or self.repeated
             result.extend((k,self) for k in keys)
         return result
 
+    def keys(self):
+        """The keys of all (key,value) pairs stored in this node."""
+        return [k for k,v in self.buffer]
+
+    def check_local(self):
+        """Checks the parts of the structure that only involve this node."""
+        if self.parent is not None:
+            assert self.buffer
+            assert self in self.parent.children
+
     def check(self, sizes, depth, full):
         """For debugging. Check structure is valid.
         sizes is a list of (# nodes, total sorted, total buffers) for each depth.
@@ -255,6 +776,8 @@ class InternalNode:
         self.serv = serv
         self.parent = parent
         self.buffer = []
+        self.stamp = serv._epoch
+        self.history = []
         if child is None:
             assert len(children_list) == len(sorted_list) + 1
             self.sorted = sorted_list
@@ -265,6 +788,19 @@ class InternalNode:
             assert sorted_list is None and children_list is None
             self.sorted = []
             self.children = [child]
+        self.level = self.children[0].level + 1
+        serv._count(self.level, nodes=1, keys=len(self.sorted))
+        serv._valid.touch(self)
+
+    def state(self):
+        """The lists a Snapshot reads."""
+        return (self.buffer, self.sorted, self.children)
+
+    def fresh(self):
+        """Replaces the lists with copies, after state() was saved."""
+        self.buffer = list(self.buffer)
+        self.sorted = list(self.sorted)
+        self.children = list(self.children)
 
     def size(self):
         return len(self.buffer) + sum(child.size() for child in self.children)
@@ -280,7 +816,10 @@ class InternalNode:
     def insert(self, key, val):
         """Inserts the (key,value) pair into the buffer."""
         assert val is not None
+        self.serv._cow(self)
         self.buffer.append((key,val))
+        self.serv._count(self.level, items=1)
+        self.serv._valid.touch(self)
 
     def range_search(self, child1, child2):
         """Iterates through all (key,value) pairs stored between
@@ -340,16 +879,24 @@ class InternalNode:
             # loading the entire sorted list onto the client
             # key_buckets[i] holds the keys that go to child i
             key_buckets = [[] for _ in range(len(self.sorted)+1)]
-            for (k,v), ind in self.serv._cmp.partition(
-                    itertools.chain(self.buffer, ((k,None) for k in keys)),
-                    self.sorted, nkey=first):
-                if v is None:
-                    # k is a search key
-                    key_buckets[ind].append(k)
-                else:
-                    # (k,v) was in the buffer
-                    self.children[ind].insert(k,v)
+            landed = set()
+            with trace.span('pope.internal_split'):
+                for (k,v), ind in self.serv._cmp.partition(
+                        itertools.chain(self.buffer, ((k,None) for k in keys)),
+                        self.sorted, nkey=first):
+                    if v is None:
+                        # k is a search key
+                        key_buckets[ind].append(k)
+                    else:
+                        # (k,v) was in the buffer
+                        self.children[ind].insert(k,v)
+                        landed.add(ind)
+            self.serv._count(self.level, items=-len(self.buffer))
+            self.serv._cow(self)
             del self.buffer[:]
+            self.serv._valid.touch(self)
+            if landed and self.serv._cache is not None:
+                self.serv._cache.landed(self, landed)
             # recurse on the children that have some of the keys
             assert len(key_buckets) == len(self.children)
             workon = []
@@ -367,8 +914,11 @@ class InternalNode:
             ind = self.children.index(curnode)
         except ValueError:
             raise ValueError("curnode not found under this node")
+        self.serv._cow(self)
         self.sorted.insert(ind, split_key)
         self.children.insert(ind, newnode)
+        self.serv._count(self.level, keys=1)
+        self.serv._valid.touch(self)
 
     def rebalance(self):
         """Ensures that len(self.sorted) <= L, by splitting if necessary.
@@ -395,10 +945,28 @@ class InternalNode:
                                sorted_list=self.sorted[:n],
                                children_list=self.children[:n+1])
         split_key = self.sorted[n]
+        self.serv._cow(self)
         del self.sorted[:n+1]
         del self.children[:n+1]
+        self.serv._count(self.level, keys=-(n+1))
+        self.serv._valid.touch(self)
         self.parent.insert_child_left(newnode, split_key, self)
 
+    def keys(self):
+        """The sorted keys and the keys in the buffer of this node."""
+        return self.sorted + [k for k,v in self.buffer]
+
+    def check_local(self):
+        """Checks the parts of the structure that only involve this node."""
+        assert len(self.children) == len(self.sorted) + 1
+        assert 1 <= len(self.sorted) <= self.serv._tsize
+        if self.parent is not None:
+            assert len(self.sorted) >= self.serv._tsize // 2
+            assert self in self.parent.children
+        for child in self.children:
+            assert child.parent is self
+            assert child.level + 1 == self.level
+
     def check(self, sizes, depth, full):
         """For debugging. Check structure is valid.
         sizes is a list of (# nodes, total sorted, total buffers) for each depth.
@@ -0,0 +1,137 @@
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+A server-side cache of range search results for the POPE tree.
+
+Each cached result remembers the two leaves that the endpoints of the
+query were split down to. New items can only enter that span when they
+are pushed out of the buffer of an ancestor of one of those two leaves,
+so the tree reports every such push-down and only the entries whose
+span actually received new items are evicted.
+"""
+
+import collections
+
+class RangeCache:
+    """LRU cache of range search results, limited by the total number
+    of (key,value) pairs stored."""
+
+    def __init__(self, max_items):
+        self.max_items = max_items
+        # (key1,key2) -> [leaf1, leaf2, result list, insert stamp]
+        self._entries = collections.OrderedDict()
+        self._items = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def clear(self):
+        self._entries.clear()
+        self._items = 0
+
+    def fresh(self, key1, key2, stamp):
+        """Returns the cached result if nothing at all was inserted
+        since it was computed, or None otherwise.
+
+        A None return does not count as a miss, since the caller is
+        expected to split and then try get().
+        """
+        entry = self._entries.get((key1,key2))
+        if entry is None or entry[3] != stamp:
+            return None
+        self._hits += 1
+        self._entries.move_to_end((key1,key2))
+        return list(entry[2])
+
+    def get(self, key1, key2, leaf1, leaf2, stamp):
+        """Returns the cached result if the keys were split down to the
+        same leaves as before, and no new items landed in between.
+        Otherwise returns None."""
+        entry = self._entries.get((key1,key2))
+        if entry is None or entry[0] is not leaf1 or entry[1] is not leaf2:
+            self._misses += 1
+            return None
+        self._hits += 1
+        entry[3] = stamp
+        self._entries.move_to_end((key1,key2))
+        return list(entry[2])
+
+    def put(self, key1, key2, leaf1, leaf2, result, stamp):
+        """Stores a freshly computed result."""
+        self._drop((key1,key2))
+        if len(result) > self.max_items:
+            return
+        self._entries[key1,key2] = [leaf1, leaf2, list(result), stamp]
+        self._items += len(result)
+        while self._items > self.max_items:
+            self._drop(next(iter(self._entries)))
+
+    def landed_leaf(self, leaf):
+        """Called when new items are put directly into the given leaf."""
+        for ekey in [ekey for ekey, (a, b, _, __) in self._entries.items()
+                     if a is leaf or b is leaf]:
+            self._evict(ekey)
+
+    def landed(self, parent, inds):
+        """Called when new items are pushed from the buffer of parent into
+        the children of parent with the given indices."""
+        if not self._entries:
+            return
+        position = {id(child): i for i, child in enumerate(parent.children)}
+        doomed = []
+        for ekey, (a, b, _, __) in self._entries.items():
+            ca, cb = _child_under(a, parent), _child_under(b, parent)
+            if ca is None and cb is None:
+                # parent is not on either path, so anything moving
+                # below it was already inside or outside the span.
+                continue
+            ia = -1 if ca is None else position[id(ca)]
+            ib = len(parent.children) if cb is None else position[id(cb)]
+            if any(ia < i < ib or (i == ia and ca is a) or (i == ib and cb is b)
+                   for i in inds):
+                doomed.append(ekey)
+        for ekey in doomed:
+            self._evict(ekey)
+
+    def counts(self, reset=False):
+        """Returns (hits, misses, evictions, entries, items)."""
+        res = [self._hits, self._misses, self._evictions,
+               len(self._entries), self._items]
+        if reset:
+            self._hits = self._misses = self._evictions = 0
+        return res
+
+    def hit_rate(self):
+        """Returns the fraction of cache lookups that were hits."""
+        total = self._hits + self._misses
+        return self._hits / total if total else 0.0
+
+    def counts_summary(self, reset=False):
+        """Prints counts data nicely."""
+        rate = self.hit_rate()
+        hi, mi, ev, ne, ni = self.counts(reset)
+        print("Range cache: {} hits, {} misses ({:.1%} hit rate), {} evictions; holding {} results with {} items."
+            .format(hi, mi, rate, ev, ne, ni))
+
+    def _evict(self, ekey):
+        self._drop(ekey)
+        self._evictions += 1
+
+    def _drop(self, ekey):
+        entry = self._entries.pop(ekey, None)
+        if entry is not None:
+            self._items -= len(entry[2])
+
+
+def _child_under(node, ancestor):
+    """Returns the child of ancestor that is on the path down to node,
+    or None if node is not a proper descendant of ancestor."""
+    prev = None
+    while node is not None and node is not ancestor:
+        prev, node = node, node.parent
+    return prev if node is not None else None
@@ -0,0 +1,448 @@
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+Read replicas for POPE, by shipping the primary's log to followers.
+
+A Primary is a Pope that writes every change to its tree into a
+ReplicationLog: each insert, and each split along with the answers the
+oracle gave during it (the sorted pivots, and the partition and find
+indices). A
+Follower keeps its own copy of the tree by applying the same log: it
+replays each split through a ReplayOracle that hands back the recorded
+answers, so the follower's tree goes through exactly the same changes
+without any oracle rounds.
+
+A follower never restructures its tree on its own, since that would
+make it diverge from the log. Its range searches and lookups instead
+scan the buffers along the two search paths (see scan_range), which
+takes a few oracle rounds per level but changes nothing.
+
+Over the network, a primary's nwopec server answers the REPLICATE
+opcode by streaming the log from a given position, and a follower
+serves read-only requests with get_follower_server():
+
+    prim = Primary(orc)
+    serv = get_primary_server(prim, 'localhost', 0)
+    ...
+    fol = Follower(OracleClient(...))
+    fol.follow(serv.server_address)
+    fserv = get_follower_server(fol, 'localhost', 0)
+"""
+
+import pickle
+import socket
+import socketserver
+import threading
+import time
+
+from ope import commstats
+from ope import nwopec
+from ope import nworacle
+from ope import pope
+from ope import trace
+from ope.oracle import identity
+
+# kinds of log entries
+INSERT = 'i'
+SPLIT = 's'
+CLEAR = 'c'
+
+HEARTBEAT = 1.0 # seconds between empty batches on an idle REPLICATE stream
+
+class ReplicationLog:
+    """Append-only list of (time, kind, args...) entries, which any
+    number of readers can wait on. Positions count from the first entry
+    ever appended, even after trim()."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._entries = []
+        self._base = 0
+
+    def append(self, kind, *args):
+        with self._cond:
+            self._entries.append((time.time(), kind) + args)
+            self._cond.notify_all()
+
+    def end(self):
+        """The position after the last entry."""
+        with self._cond:
+            return self._base + len(self._entries)
+
+    def read(self, start, timeout=None):
+        """Returns the entries from position start on, waiting up to
+        timeout seconds for there to be at least one."""
+        with self._cond:
+            if start < self._base:
+                raise ValueError("log position already trimmed", start)
+            self._cond.wait_for(
+                lambda: self._base + len(self._entries) > start, timeout)
+            return self._entries[start - self._base:]
+
+    def trim(self, upto):
+        """Forgets the entries before position upto, once every follower
+        has them."""
+        with self._cond:
+            drop = max(0, min(upto - self._base, len(self._entries)))
+            del self._entries[:drop]
+            self._base += drop
+
+
+class RecordingOracle:
+    """Wraps an oracle to remember the answers of partition,
+    partition_sort and find while recording is on, in the order they
+    were asked for."""
+
+    def __init__(self, orc):
+        self.orc = orc
+        self._record = None
+
+    def __getattr__(self, name):
+        return getattr(self.orc, name)
+
+    def start(self):
+        self._record = []
+
+    def stop(self):
+        res, self._record = self._record, None
+        return res
+
+    def _indices(self, results, record):
+        for needle, ind in results:
+            record.append(ind)
+            yield needle, ind
+
+    def _recorded(self, op, results, shay=None):
+        if self._record is None:
+            return results
+        record = []
+        self._record.append((op, shay, record))
+        return self._indices(results, record)
+
+    def partition(self, needles, haystack, nkey=identity, haykey=identity):
+        results = self.orc.partition(needles, haystack, nkey, haykey)
+        return self._recorded('partition', results)
+
+    def partition_sort(self, needles, haystack, nkey=identity, haykey=identity):
+        shay, results = self.orc.partition_sort(needles, haystack, nkey, haykey)
+        return shay, self._recorded('partition_sort', results, list(shay))
+
+    def find(self, needles, haystack, nkey=identity, haykey=identity):
+        results = self.orc.find(needles, haystack, nkey, haykey)
+        return self._recorded('find', results)
+
+
+class ReplayOracle:
+    """Wraps an oracle to answer partition, partition_sort and find from
+    recorded answers while there are any loaded, and passes everything
+    else to the real oracle."""
+
+    def __init__(self, orc):
+        self.orc = orc
+        self._answers = None
+        self.replayed = 0
+
+    def __getattr__(self, name):
+        return getattr(self.orc, name)
+
+    def load(self, answers):
+        self._answers = list(reversed(answers))
+
+    def done(self):
+        assert not self._answers, "recorded answers left over"
+        self._answers = None
+
+    def _next(self, op):
+        recorded, shay, indices = self._answers.pop()
+        assert recorded == op, "replay out of step with the log"
+        self.replayed += 1
+        return shay, indices
+
+    def partition(self, needles, haystack, nkey=identity, haykey=identity):
+        if self._answers is None:
+            return self.orc.partition(needles, haystack, nkey, haykey)
+        _, indices = self._next('partition')
+        return zip(needles, indices)
+
+    def partition_sort(self, needles, haystack, nkey=identity, haykey=identity):
+        if self._answers is None:
+            return self.orc.partition_sort(needles, haystack, nkey, haykey)
+        shay, indices = self._next('partition_sort')
+        return list(shay), zip(needles, indices)
+
+    def find(self, needles, haystack, nkey=identity, haykey=identity):
+        if self._answers is None:
+            return self.orc.find(needles, haystack, nkey, haykey)
+        _, indices = self._next('find')
+        return zip(needles, indices)
+
+
+class Primary(pope.Pope):
+    """A Pope that writes all changes to its tree into self.log."""
+
+    def __init__(self, oracle, cache_size=0, validation=None, log=None):
+        self.log = ReplicationLog() if log is None else log
+        super().__init__(RecordingOracle(oracle), cache_size, validation)
+
+    def clear(self):
+        super().clear()
+        self.log.append(CLEAR)
+
+    def insert(self, key, val):
+        super().insert(key, val)
+        self.log.append(INSERT, key, val)
+
+    def split(self, keys):
+        self._cmp.start()
+        try:
+            res = super().split(keys)
+        finally:
+            answers = self._cmp.stop()
+        self.log.append(SPLIT, list(keys), answers)
+        return res
+
+    def stats(self, reset=False):
+        """Pope.stats(), with the position at the end of the log under 'log'."""
+        res = super().stats(reset)
+        res['log'] = self.log.end()
+        return res
+
+
+def scan_range(serv, key1, key2):
+    """Iterates over the (key,value) pairs with key1 < key <= key2 in
+    the Pope serv, without splitting or moving anything.
+
+    At each node on the paths to key1 and key2, the buffer is
+    partitioned around the two keys, and the keys are partitioned
+    around the node's sorted keys to find the children to visit. The
+    children between the two paths are traversed whole.
+    """
+    orc = serv._cmp
+    def visit(node):
+        if node.buffer:
+            for item, ind in orc.partition(node.buffer, [key1, key2], nkey=pope.first):
+                if ind == 1:
+                    yield item
+        if isinstance(node, pope.LeafNode):
+            return
+        [(_, ind1), (_, ind2)] = orc.partition([key1, key2], node.sorted)
+        yield from visit(node.children[ind1])
+        for child in node.children[ind1+1:ind2]:
+            yield from child.traverse()
+        if ind2 > ind1:
+            yield from visit(node.children[ind2])
+    return visit(serv._root)
+
+def scan_lookup(serv, key):
+    """Returns a value stored under key in the Pope serv, or None,
+    without splitting or moving anything."""
+    orc = serv._cmp
+    node = serv._root
+    while True:
+        if node.buffer:
+            for (k, v), ind in orc.find(node.buffer, [key], nkey=pope.first):
+                if ind >= 0:
+                    return v
+        if isinstance(node, pope.LeafNode):
+            return None
+        [(_, ind)] = orc.partition([key], node.sorted)
+        node = node.children[ind]
+
+
+class Follower:
+    """A read-only copy of a Primary's tree, kept up to date from its log.
+
+    oracle is only used for the follower's own queries, and must have
+    the same local size L as the primary's; applying the log takes no
+    oracle rounds. Queries and log entries take turns.
+    """
+
+    def __init__(self, oracle):
+        self._replay = ReplayOracle(oracle)
+        self._serv = pope.Pope(self._replay)
+        self.lock = threading.Lock()
+        self.applied = 0
+        self.primary_end = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._stream = None
+        self._thread = None
+
+    def apply(self, entries):
+        """Applies log entries, which must follow the ones already applied."""
+        with self.lock:
+            for stamp, kind, *args in entries:
+                if kind == INSERT:
+                    self._serv.insert(*args)
+                elif kind == SPLIT:
+                    keys, answers = args
+                    self._replay.load(answers)
+                    self._serv.split(keys)
+                    self._replay.done()
+                elif kind == CLEAR:
+                    self._serv.clear()
+                else:
+                    raise ValueError("unknown log entry", kind)
+                self.applied += 1
+                self.last_lag = time.time() - stamp
+                self.max_lag = max(self.max_lag, self.last_lag)
+            self.primary_end = max(self.primary_end, self.applied)
+
+    def follow_log(self, log, stop=None):
+        """Applies entries from a local ReplicationLog until stop (a
+        threading.Event) is set."""
+        while stop is None or not stop.is_set():
+            entries = log.read(self.applied, HEARTBEAT)
+            self.primary_end = max(self.primary_end, log.end())
+            self.apply(entries)
+
+    def follow(self, address):
+        """Starts a thread that streams the log from the primary server
+        at address and applies it, until close() is called."""
+        self._stream = socket.create_connection(address)
+        self._stream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sockfile = self._stream.makefile('rwb')
+        sockfile.write(nwopec.REPLICATE)
+        pickle.dump(self.applied, sockfile)
+        sockfile.flush()
+        def run():
+            try:
+                while True:
+                    end, entries = pickle.load(sockfile)
+                    self.primary_end = end
+                    self.apply(entries)
+            except (OSError, EOFError):
+                pass
+            finally:
+                sockfile.close()
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stops following the primary server, if follow() was called."""
+        if self._stream is not None:
+            try:
+                self._stream.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._stream.close()
+            self._thread.join()
+            self._stream = None
+
+    def lag(self):
+        """Returns a dictionary with the log entries applied, how many the
+        primary had written when last heard from, the difference, and
+        the delay in seconds between the primary writing an entry and
+        this follower applying it (for the last entry and the worst)."""
+        return {
+            'applied': self.applied,
+            'primary': self.primary_end,
+            'behind': self.primary_end - self.applied,
+            'last_seconds': self.last_lag,
+            'max_seconds': self.max_lag,
+        }
+
+    def insert(self, key, val):
+        raise RuntimeError("followers are read-only")
+
+    def clear(self):
+        raise RuntimeError("followers are read-only")
+
+    def range_search(self, key1, key2, limit=None, owner=None):
+        assert limit is None, "followers do not page"
+        with trace.span('replica.range_search'), self.lock:
+            return list(scan_range(self._serv, key1, key2))
+
+    def lookup(self, key):
+        with trace.span('replica.lookup'), self.lock:
+            return scan_lookup(self._serv, key)
+
+    def size(self):
+        with self.lock:
+            return self._serv.size()
+
+    def traverse(self):
+        with self.lock:
+            return list(self._serv.traverse())
+
+    def stats(self, reset=False):
+        """The tree's Pope.stats(), with the number of oracle answers
+        replayed instead of asked for under 'replayed' and the lag()
+        under 'lag'."""
+        with self.lock:
+            res = self._serv.stats(reset)
+        res['replayed'] = self._replay.replayed
+        res['lag'] = self.lag()
+        if reset:
+            self._replay.replayed = 0
+            self.max_lag = 0.0
+        return res
+
+
+class PrimaryHandler(nwopec.PopeHandler):
+    """Serves a Primary, plus REPLICATE streams of its log."""
+
+    def serve(self, opcode, sockfile):
+        if opcode == nwopec.REPLICATE:
+            # streams until the follower goes away, so no lock
+            if nwopec.DEBUG: print("Received REPLICATE request")
+            self.replicate(sockfile)
+        else:
+            super().serve(opcode, sockfile)
+
+    def replicate(self, sockfile):
+        # get the starting position
+        pos = pickle.load(sockfile)
+
+        log = self.serv.log
+        try:
+            while True:
+                entries = log.read(pos, HEARTBEAT)
+                pos += len(entries)
+                pickle.dump((log.end(), entries), sockfile)
+                sockfile.flush()
+        except OSError:
+            if nwopec.DEBUG: print("Follower went away")
+
+def get_primary_server(the_primary, hostname, port):
+    """Creates a threaded socketserver for the given Primary, which
+    followers can replicate from."""
+    class Handler(PrimaryHandler):
+        serv = the_primary
+        stats = commstats.CommStats()
+        lock = threading.Lock()
+    server = socketserver.ThreadingTCPServer((hostname, port), Handler)
+    server.daemon_threads = True
+    return server
+
+def primary_server(oracle_address):
+    """For cluster.ThreadComponent or ProcessComponent: returns a Primary
+    server, connected to the oracle, and the things to close after it."""
+    orc = nworacle.OracleClient(*oracle_address)
+    orc.open()
+    return get_primary_server(Primary(orc), 'localhost', 0), [orc]
+
+def follower_server(oracle_address, primary_address):
+    """For cluster.ThreadComponent or ProcessComponent: returns a server
+    for a Follower of the primary server at primary_address, and the
+    things to close after it."""
+    orc = nworacle.OracleClient(*oracle_address)
+    orc.open()
+    fol = Follower(orc)
+    fol.follow(primary_address)
+    return get_follower_server(fol, 'localhost', 0), [fol, orc]
+
+def get_follower_server(the_follower, hostname, port):
+    """Creates a threaded socketserver for read-only requests to the
+    given Follower."""
+    class Handler(nwopec.PopeHandler):
+        serv = the_follower
+        stats = commstats.CommStats()
+    server = socketserver.ThreadingTCPServer((hostname, port), Handler)
+    server.daemon_threads = True
+    return server
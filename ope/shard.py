@@ -0,0 +1,201 @@
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+A sharding layer over several OPE servers.
+
+ShardedClient looks like one OpeClient or NwOpeClient, but spreads the
+data over many of them, usually NwOpeClients to POPE servers in
+different processes or machines (see cluster.Cluster). The servers do
+not know the plaintext order, so each insert goes to a shard picked by
+a load-balancing policy, and every query is sent to all the shards at
+once, from one thread per shard. Range results from the shards are
+sorted and merged by plaintext key as they are read.
+
+For testing, local_shards() makes stand-in shards that each run a Pope
+tree and oracle in this process.
+"""
+
+import concurrent.futures
+import heapq
+import operator
+import random
+import zlib
+
+from ope import ciphers
+from ope import commstats
+from ope import opec
+from ope import oracle
+from ope import pope
+
+class RoundRobin:
+    """Sends each insert to the next shard in turn."""
+
+    def __init__(self, shards):
+        self.shards = shards
+        self._next = 0
+
+    def choose(self, key):
+        res = self._next
+        self._next = (res + 1) % self.shards
+        return res
+
+    def placed(self, shard):
+        pass
+
+class LeastLoaded:
+    """Sends each insert to the shard holding the fewest items, as known
+    from the starting sizes and the inserts since."""
+
+    def __init__(self, shards, sizes=None):
+        self.loads = list(sizes) if sizes else [0] * shards
+
+    def choose(self, key):
+        return min(range(len(self.loads)), key=self.loads.__getitem__)
+
+    def placed(self, shard):
+        self.loads[shard] += 1
+
+class RandomShard:
+    """Sends each insert to a random shard."""
+
+    def __init__(self, shards, seed=None):
+        self.shards = shards
+        self._rand = random.Random(seed)
+
+    def choose(self, key):
+        return self._rand.randrange(self.shards)
+
+    def placed(self, shard):
+        pass
+
+class HashShard:
+    """Sends each insert to a shard chosen by a hash of the key, so that
+    lookups only need to ask that one shard."""
+
+    def __init__(self, shards):
+        self.shards = shards
+
+    def choose(self, key):
+        return zlib.crc32(str(key).encode('utf8')) % self.shards
+
+    def placed(self, shard):
+        pass
+
+POLICIES = {
+    'round_robin': RoundRobin,
+    'least_loaded': LeastLoaded,
+    'random': RandomShard,
+    'hash': HashShard,
+}
+
+
+class ShardedClient:
+    """Scatter-gather front end over a list of shard clients.
+
+    Each shard client needs insert, lookup, range_search and size
+    methods, like opec.OpeClient or nwopec.NwOpeClient, and is only
+    used by one thread at a time.
+    """
+
+    def __init__(self, shards, policy='round_robin'):
+        """policy is a name from POLICIES or a policy instance, with
+        choose(key) to pick a shard and placed(shard) to hear about it."""
+        assert shards
+        self.shards = list(shards)
+        if isinstance(policy, str):
+            policy = POLICIES[policy](len(self.shards))
+        self.policy = policy
+        self.placed = [0] * len(self.shards)
+        self._pool = concurrent.futures.ThreadPoolExecutor(len(self.shards))
+
+    def close(self):
+        """Stops the fan-out threads. The shard clients are left open."""
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, v, r):
+        self.close()
+
+    def _scatter(self, call):
+        """Runs call(shard client) on every shard at once, and returns the
+        results in shard order."""
+        futures = [self._pool.submit(call, client) for client in self.shards]
+        return [future.result() for future in futures]
+
+    def insert(self, key, value):
+        shard = self.policy.choose(key)
+        self.shards[shard].insert(key, value)
+        self.policy.placed(shard)
+        self.placed[shard] += 1
+
+    def lookup(self, key):
+        """Returns the value from the first shard that has the key."""
+        if isinstance(self.policy, HashShard):
+            return self.shards[self.policy.choose(key)].lookup(key)
+        for res in self._scatter(lambda client: client.lookup(key)):
+            if res is not None:
+                return res
+        return None
+
+    def range_iter(self, key1, key2):
+        """Iterates over the (key,value) pairs in the range from every
+        shard, in plaintext key order."""
+        parts = self._scatter(
+            lambda client: sorted(client.range_search(key1, key2) or (),
+                                  key=operator.itemgetter(0)))
+        return heapq.merge(*parts, key=operator.itemgetter(0))
+
+    def range_search(self, key1, key2):
+        """Returns all (key,value) pairs in the range, sorted by key."""
+        return list(self.range_iter(key1, key2))
+
+    def size(self):
+        return sum(self._scatter(lambda client: client.size()))
+
+    def traverse(self):
+        parts = self._scatter(lambda client: sorted(client.traverse(),
+                                                    key=operator.itemgetter(0)))
+        return heapq.merge(*parts, key=operator.itemgetter(0))
+
+    def stats(self, reset=False):
+        """Gathers the stats() of every shard, as a list under 'shards',
+        and adds them up under 'total': items, nodes, pending work,
+        oracle rounds, the greatest height, and the shard servers' byte
+        counts (as in commstats.CommStats.snapshot) where there are any.
+        The inserts sent to each shard are under 'placed'."""
+        shards = self._scatter(lambda client: client.stats(reset))
+        comm = commstats.CommStats()
+        total = {'size': 0, 'nodes': 0, 'pending': 0, 'rounds': 0, 'height': 0}
+        for res in shards:
+            if 'server' in res:
+                comm.merge(res['server'])
+            tree = res.get('tree')
+            if tree:
+                for name in ('size', 'nodes', 'pending'):
+                    total[name] += tree[name]
+                total['height'] = max(total['height'], tree['height'])
+                orc = tree.get('oracle', {})
+                # an nworacle.OracleClient has the oracle's counts one level down
+                total['rounds'] += orc.get('rounds', orc.get('oracle', {}).get('rounds', 0))
+        total['server'] = comm.snapshot()
+        placed = list(self.placed)
+        if reset:
+            self.placed = [0] * len(self.shards)
+        return {'shards': shards, 'total': total, 'placed': placed}
+
+
+def local_shards(count, crypt=None, local_size=100, ServerClass=pope.Pope):
+    """Returns count stand-in shard clients, each an opec.OpeClient on
+    its own ServerClass and oracle in this process, all with the same
+    cipher."""
+    if crypt is None:
+        crypt = ciphers.AES()
+    return [opec.OpeClient(ServerClass(oracle.Oracle(crypt, local_size)), crypt)
+            for _ in range(count)]
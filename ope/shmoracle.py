@@ -0,0 +1,456 @@
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+A local transport for the comparison oracle, for when the oracle and
+the POPE server run in different processes on the same host.
+
+Instead of pickling everything over TCP, the client creates two
+shared memory rings, one for each direction, and the two sides only
+signal each other over a Unix domain socket with small fixed-size
+control messages (opcode, kind, count, width, offset). Ciphertexts are
+passed as fixed-width blocks: an array of 16-bit lengths followed by
+count slots of width bytes each, copied straight into and out of the
+shared memory. Results come back as an array of 32-bit ints. Only the
+ciphertexts are sent, since the key functions are applied by the
+client, and the client puts the original objects back together with
+the results.
+
+ShmOracleClient has the same interface as nworacle.OracleClient, and
+get_shm_oracle_server() is the counterpart of get_oracle_server().
+"""
+
+import array
+import os
+import pickle
+import socket
+import socketserver
+import struct
+import threading
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+
+from ope import commstats
+from ope import trace
+from ope.nworacle import PARTITION, PARTITION_SORT, FIND, MAX_SIZE, STATS, OP_NAMES
+
+"""Single byte op-codes, besides the ones from nworacle"""
+HELLO = b'h'
+NEEDLES = b'n'
+DONE = b'd'
+RESULT = b'r'
+
+"""Kinds of payload in the ring"""
+BYTES = 0   # ciphertexts that are bytes
+STR = 1     # ciphertexts that are str, sent as utf-8
+INTS = 2    # 32-bit signed results
+PICKLE = 3  # anything else, count is the number of bytes
+
+# opcode, kind, count, width, offset
+CTRL = struct.Struct('<cBIII')
+
+DEBUG = False
+RING_SIZE = 1 << 23
+
+def identity(x):
+    return x
+
+def tracker_pid():
+    """The process id of the multiprocessing resource tracker that this
+    process uses for shared memory, which a forked child shares with
+    its parent."""
+    resource_tracker.ensure_running()
+    return getattr(resource_tracker._resource_tracker, '_pid', None)
+
+def recv_exact(sock, n):
+    """Reads exactly n bytes from sock, or returns b'' at end of file."""
+    data = b''
+    while len(data) < n:
+        more = sock.recv(n - len(data))
+        if not more:
+            return b''
+        data += more
+    return data
+
+
+def encode_keys(keys):
+    """Returns the kind of the ciphertexts and the list of them as bytes."""
+    if keys and isinstance(keys[0], str):
+        return STR, [k.encode() for k in keys]
+    return BYTES, keys
+
+
+class Ring:
+    """Space in one shared memory segment for messages in one direction.
+
+    Messages are placed one after the other, wrapping around to the
+    start when one does not fit at the end. The writer calls reset()
+    whenever the other side is known to have read everything, which
+    is the case after every reply, so unread messages are never
+    overwritten.
+    """
+
+    def __init__(self, shm):
+        self.shm = shm
+        self.buf = shm.buf
+        self.size = shm.size
+        self._pos = 0
+
+    def reset(self):
+        self._pos = 0
+
+    def free(self):
+        """The number of bytes left before wrapping around."""
+        return self.size - self._pos
+
+    def alloc(self, nbytes):
+        """Returns the offset for a new message of nbytes."""
+        if nbytes > self.size:
+            raise ValueError("message of {} bytes does not fit in a ring of {}"
+                             .format(nbytes, self.size))
+        if self._pos + nbytes > self.size:
+            self._pos = 0
+        off = self._pos
+        self._pos += nbytes
+        return off
+
+    def write_keys(self, kind, keys):
+        """Writes ciphertexts, as bytes, in a fixed-width block.
+        Returns (kind, count, width, offset, nbytes)."""
+        lens = array.array('H', map(len, keys))
+        width = max(lens, default=0)
+        nbytes = 2 * len(keys) + width * len(keys)
+        off = self.alloc(nbytes)
+        buf = self.buf
+        buf[off:off+2*len(keys)] = lens.tobytes()
+        pos = off + 2*len(keys)
+        for k, n in zip(keys, lens):
+            buf[pos:pos+n] = k
+            pos += width
+        return kind, len(keys), width, off, nbytes
+
+    def read_keys(self, kind, count, width, off):
+        lens = array.array('H')
+        lens.frombytes(self.buf[off:off+2*count])
+        pos = off + 2*count
+        buf = self.buf
+        keys = []
+        for n in lens:
+            keys.append(bytes(buf[pos:pos+n]))
+            pos += width
+        if kind == STR:
+            keys = [k.decode() for k in keys]
+        return keys
+
+    def write_ints(self, values):
+        """Returns (offset, nbytes)."""
+        data = array.array('i', values).tobytes()
+        off = self.alloc(len(data))
+        self.buf[off:off+len(data)] = data
+        return off, len(data)
+
+    def read_ints(self, count, off):
+        res = array.array('i')
+        res.frombytes(self.buf[off:off+4*count])
+        return res
+
+    def write_bytes(self, data):
+        off = self.alloc(len(data))
+        self.buf[off:off+len(data)] = data
+        return off
+
+    def read_bytes(self, count, off):
+        return bytes(self.buf[off:off+count])
+
+
+class ShmOracleClient:
+    """Same interface as nworacle.OracleClient, for an oracle server from
+    get_shm_oracle_server() listening on a Unix domain socket."""
+
+    def __init__(self, path, ring_size=RING_SIZE):
+        """path is the server's Unix socket. Each of the two rings gets
+        ring_size bytes of shared memory, which must hold the largest
+        haystack or batch of results."""
+        self._path = path
+        self._ring_size = ring_size
+        self._sock = None
+        self._stats = commstats.CommStats()
+
+    def open(self):
+        """opens the connection and allows operations"""
+        if self._sock:
+            raise RuntimeError("already open")
+        self._out = Ring(shared_memory.SharedMemory(create=True, size=self._ring_size))
+        self._in = Ring(shared_memory.SharedMemory(create=True, size=self._ring_size))
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(self._path)
+        hello = pickle.dumps((tracker_pid(), self._out.shm.name, self._in.shm.name))
+        self._sock.sendall(CTRL.pack(HELLO, PICKLE, len(hello), 0, 0) + hello)
+
+        self._stats.add_request(OP_NAMES[MAX_SIZE])
+        _, __, ___, self._max_size, ____ = self._request(OP_NAMES[MAX_SIZE], MAX_SIZE)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def close(self):
+        """closes the connection and frees the shared memory"""
+        if not self._sock:
+            raise RuntimeError("not open; can't close it")
+        self._sock.close()
+        self._sock = None
+        for ring in (self._out, self._in):
+            ring.buf = None
+            ring.shm.close()
+            ring.shm.unlink()
+
+    def __exit__(self, t,v,r):
+        self.close()
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    def comm_stats(self, reset=False):
+        """Returns the byte counts for this connection, as a dictionary
+        like commstats.CommStats.snapshot(). Bytes in shared memory are
+        counted just like bytes on the socket."""
+        return self._stats.snapshot(reset)
+
+    def _send(self, op, opcode, kind=0, count=0, width=0, off=0, nbytes=0):
+        self._sock.sendall(CTRL.pack(opcode, kind, count, width, off))
+        self._stats.add_bytes(op, commstats.SENT, CTRL.size + nbytes)
+
+    def _request(self, op, opcode, kind=0, count=0, width=0, off=0, nbytes=0):
+        """Sends one control message and returns the reply."""
+        self._send(op, opcode, kind, count, width, off, nbytes)
+        self._stats.add_round_trip()
+        reply = recv_exact(self._sock, CTRL.size)
+        if not reply:
+            raise RuntimeError("shared memory oracle closed the connection")
+        reply = CTRL.unpack(reply)
+        if reply[0] != RESULT:
+            raise RuntimeError("SHM ORACLE ERROR: unexpected reply", reply[0])
+        nbytes = reply[2] if reply[1] == PICKLE else 4 * reply[2]
+        self._stats.add_bytes(op, commstats.RECEIVED, CTRL.size + nbytes)
+        return reply
+
+    def stats(self, reset=False):
+        """Fetches the counters from the oracle server, like
+        nworacle.OracleClient.stats()."""
+        op = OP_NAMES[STATS]
+        self._stats.add_request(op)
+        _, __, count, ___, off = self._request(op, STATS, int(reset))
+        return pickle.loads(self._in.read_bytes(count, off))
+
+    def _haystack(self, op, opcode, haystack, haykey):
+        """Writes the haystack at the start of the ring and sends it.
+        Only partition_sort gets a reply to this."""
+        self._stats.add_request(op)
+        self._out.reset()
+        kind, keys = encode_keys([haykey(x) for x in haystack])
+        ctrl = self._out.write_keys(kind, keys)
+        if opcode == PARTITION_SORT:
+            return self._request(op, opcode, *ctrl)
+        self._send(op, opcode, *ctrl)
+
+    def _stream(self, op, needles, nkey):
+        """Sends the needles in as few batches as fit in the ring, and
+        returns the list of (needle, result) pairs."""
+        needles = list(needles)
+        kind, keys = encode_keys([nkey(x) for x in needles])
+        results = []
+        start = 0
+        while start < len(keys):
+            room = self._out.free()
+            stop, width = start, 0
+            while stop < len(keys):
+                width = max(width, len(keys[stop]))
+                if (stop - start + 1) * (width + 2) > room:
+                    break
+                stop += 1
+            if stop == start:
+                raise ValueError("ciphertext too large for the ring")
+            ctrl = self._out.write_keys(kind, keys[start:stop])
+            _, __, rcount, ___, roff = self._request(op, NEEDLES, *ctrl)
+            results.extend(self._in.read_ints(rcount, roff))
+            # everything sent so far has been read
+            self._out.reset()
+            start = stop
+        self._send(op, DONE)
+        return list(zip(needles, results))
+
+    def partition(self, needles, haystack, nkey=identity, haykey=identity):
+        """Just like partition() in oracle.Oracle."""
+        with trace.span('shmoracle.partition'):
+            op = OP_NAMES[PARTITION]
+            self._haystack(op, PARTITION, haystack, haykey)
+            return self._stream(op, needles, nkey)
+
+    def partition_sort(self, needles, haystack, nkey=identity, haykey=identity):
+        """Just like partition_sort() in oracle.Oracle."""
+        with trace.span('shmoracle.partition_sort'):
+            op = OP_NAMES[PARTITION_SORT]
+            haystack = list(haystack)
+            _, __, count, ___, off = self._haystack(op, PARTITION_SORT, haystack, haykey)
+            shay = [haystack[i] for i in self._in.read_ints(count, off)]
+            return shay, self._stream(op, needles, nkey)
+
+    def find(self, needles, haystack, nkey=identity, haykey=identity):
+        """Just like find() in oracle.Oracle."""
+        with trace.span('shmoracle.find'):
+            op = OP_NAMES[FIND]
+            self._haystack(op, FIND, haystack, haykey)
+            return self._stream(op, needles, nkey)
+
+
+class ShmOracleHandler(socketserver.BaseRequestHandler):
+    # Note: must have field "orc" added to point to the underlying Oracle instance
+    # The field "stats" is a CommStats shared by all connections.
+    # If "lock" is set, requests from different connections take turns.
+    stats = None
+    lock = None
+
+    def handle(self):
+        if self.stats is None:
+            self.stats = commstats.CommStats()
+        opcode, kind, count, _, __ = self.receive()
+        assert opcode == HELLO and kind == PICKLE
+        tracker, inname, outname = pickle.loads(recv_exact(self.request, count))
+        self._in = Ring(self.attach(inname, tracker))
+        self._out = Ring(self.attach(outname, tracker))
+        if DEBUG: print("Connection open")
+        try:
+            while True:
+                ctrl = self.receive()
+                if ctrl is None:
+                    if DEBUG: print("Connection closed")
+                    return
+                op = OP_NAMES.get(ctrl[0], 'invalid')
+                self.stats.add_request(op)
+                with trace.span('shmoracle.serve.' + op):
+                    if self.lock:
+                        with self.lock:
+                            self.dispatch(op, *ctrl)
+                    else:
+                        self.dispatch(op, *ctrl)
+        finally:
+            for ring in (self._in, self._out):
+                ring.buf = None
+                ring.shm.close()
+
+    def attach(self, name, tracker):
+        shm = shared_memory.SharedMemory(name=name)
+        if tracker != tracker_pid():
+            # the client owns it, so our own resource tracker must not
+            # unlink it when this process exits
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+    def receive(self):
+        data = recv_exact(self.request, CTRL.size)
+        if not data:
+            return None
+        return CTRL.unpack(data)
+
+    def reply(self, op, kind, count, off, nbytes):
+        # the client reads each reply before sending anything else
+        self._out.reset()
+        self.request.sendall(CTRL.pack(RESULT, kind, count, 0, off))
+        self.stats.add_bytes(op, commstats.SENT, CTRL.size + nbytes)
+
+    def reply_ints(self, op, values):
+        off, nbytes = self._out.write_ints(values)
+        self.reply(op, INTS, len(values), off, nbytes)
+
+    def dispatch(self, op, opcode, kind, count, width, off):
+        """Handles one request with the given control message."""
+        self.stats.add_bytes(op, commstats.RECEIVED, CTRL.size)
+        if opcode == MAX_SIZE:
+            if DEBUG: print("Received MAX_SIZE request")
+            self.request.sendall(CTRL.pack(RESULT, INTS, 0, self.orc.max_size, 0))
+            self.stats.add_bytes(op, commstats.SENT, CTRL.size)
+        elif opcode == STATS:
+            if DEBUG: print("Received STATS request")
+            data = pickle.dumps({
+                'server': self.stats.snapshot(bool(kind)),
+                'oracle': self.orc.stats(bool(kind)),
+            })
+            self.reply(op, PICKLE, len(data), self._out.write_bytes(data), len(data))
+        elif opcode in (PARTITION, PARTITION_SORT, FIND):
+            if DEBUG: print("Received", op, "request")
+            haystack = self._in.read_keys(kind, count, width, off)
+            self.stats.add_bytes(op, commstats.RECEIVED, (width + 2) * count)
+            if opcode == PARTITION:
+                results = self.orc.partition(self.needles(op), haystack)
+            elif opcode == FIND:
+                results = self.orc.find(self.needles(op), haystack)
+            else:
+                shay = self.orc.sort(haystack, identity)
+                # send back where each sorted ciphertext came from
+                places = {}
+                for i, k in enumerate(haystack):
+                    places.setdefault(k, []).append(i)
+                for lst in places.values():
+                    lst.reverse()
+                self.reply_ints(op, [places[k].pop() for k in shay])
+                results = self.orc.partition(self.needles(op), shay)
+            self.stream_back(op, results)
+        else:
+            raise RuntimeError("SHM ORACLE ERROR: invalid opcode", opcode)
+
+    def needles(self, op):
+        """Yields the needles from each NEEDLES message until DONE."""
+        while True:
+            ctrl = self.receive()
+            if ctrl is None or ctrl[0] == DONE:
+                self.stats.add_bytes(op, commstats.RECEIVED, CTRL.size)
+                return
+            opcode, kind, count, width, off = ctrl
+            assert opcode == NEEDLES
+            self.stats.add_bytes(op, commstats.RECEIVED, CTRL.size + (width + 2) * count)
+            self._batch = count
+            yield from self._in.read_keys(kind, count, width, off)
+
+    def stream_back(self, op, results):
+        """Replies to every batch of needles once all of its results are in."""
+        self._batch = None
+        out = []
+        for _, res in results:
+            out.append(res)
+            if len(out) == self._batch:
+                self.reply_ints(op, out)
+                out = []
+
+
+class ShmOracleServer(socketserver.UnixStreamServer):
+    """Removes its socket file when closed."""
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+class ThreadingShmOracleServer(socketserver.ThreadingMixIn, ShmOracleServer):
+    daemon_threads = True
+
+
+def get_shm_oracle_server(the_oracle, path, threaded=False):
+    """Creates a server on the Unix socket path to relay requests from
+    ShmOracleClients to the given oracle. If threaded, several
+    connections can be open at once, each in its own thread, but their
+    requests are still handled one at a time."""
+    class Handler(ShmOracleHandler):
+        orc = the_oracle
+        stats = commstats.CommStats()
+        lock = threading.Lock() if threaded else None
+    if threaded:
+        return ThreadingShmOracleServer(path, Handler)
+    return ShmOracleServer(path, Handler)
@@ -0,0 +1,292 @@
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+One comparison oracle server for many tenants.
+
+Each tenant has its own cipher, local storage size L, decryption cache
+and counters, in its own oracle.Oracle. A connection starts with the
+AUTH opcode of the nworacle protocol: the client names its tenant, the
+server sends a random challenge, and the client answers with an HMAC
+of it under the tenant's shared secret. Every request after that goes
+to that tenant's oracle.
+
+Requests take turns through a FairScheduler, which hands the next turn
+to the waiting tenant that has been served the least time so far
+(weighted), so a busy tenant cannot starve the others.
+
+The tenants can be listed in a JSON file for load_tenants():
+
+    {"tenants": [
+        {"id": "acme", "secret": "s3cret", "passphrase": "key1",
+         "local_size": 100, "weight": 2, "max_connections": 8},
+        {"id": "initech", "secret": "hunter2", "passphrase": "key2"}
+    ]}
+"""
+
+import collections
+import contextlib
+import hmac
+import itertools
+import json
+import os
+import pickle
+import socketserver
+import threading
+import time
+
+from ope import ciphers
+from ope import commstats
+from ope import nworacle
+from ope.oracle import Oracle
+
+DEFAULT_CACHE = 10000
+
+class DecryptCache:
+    """Wraps a cipher to remember the most recent decryptions.
+
+    The oracle decrypts the same haystack every time a node is
+    partitioned, so most of its decryptions are repeats.
+    """
+
+    def __init__(self, crypt, size=DEFAULT_CACHE):
+        self.crypt = crypt
+        self.size = size
+        self._cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, s):
+        return self.crypt.encode(s)
+
+    def decode(self, ctext):
+        try:
+            res = self._cache[ctext]
+        except KeyError:
+            self.misses += 1
+            res = self._cache[ctext] = self.crypt.decode(ctext)
+            if len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+            return res
+        self.hits += 1
+        self._cache.move_to_end(ctext)
+        return res
+
+    def stats(self, reset=False):
+        res = {'hits': self.hits, 'misses': self.misses, 'entries': len(self._cache)}
+        if reset:
+            self.hits = self.misses = 0
+        return res
+
+
+class Tenant:
+    """The oracle and counters for one tenant."""
+
+    def __init__(self, tenant_id, secret, crypt, size, weight=1,
+                 max_connections=None, cache_size=DEFAULT_CACHE):
+        """secret is the shared secret for AUTH, crypt the tenant's
+        cipher and size its oracle's local storage size. weight is the
+        tenant's share of the server relative to the others, and
+        max_connections the most connections it may have open at once
+        (None for no limit). A cache_size of 0 turns off the cache."""
+        assert weight > 0
+        self.id = tenant_id
+        self.secret = secret
+        self.weight = weight
+        self.max_connections = max_connections
+        self.cache = DecryptCache(crypt, cache_size) if cache_size else None
+        self.orc = Oracle(self.cache or crypt, size)
+        self.comm = commstats.CommStats()
+        self.connections = 0
+        self._lock = threading.Lock()
+        # scheduler state and counters, guarded by the scheduler
+        self.vtime = 0.0
+        self._reset_counts()
+
+    def connect(self):
+        """Counts one more open connection, if the limit allows it."""
+        with self._lock:
+            if (self.max_connections is not None and
+                    self.connections >= self.max_connections):
+                self.refused += 1
+                return False
+            self.connections += 1
+            return True
+
+    def disconnect(self):
+        with self._lock:
+            self.connections -= 1
+
+    def _reset_counts(self):
+        self.requests = 0
+        self.refused = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.busy_time = 0.0
+
+    def stats(self, reset=False):
+        """Returns a dictionary with the tenant's byte counts under
+        'server', its oracle's stats under 'oracle', and the scheduling,
+        connection and cache counters under 'tenant'."""
+        res = {
+            'server': self.comm.snapshot(reset),
+            'oracle': self.orc.stats(reset),
+            'tenant': {
+                'id': self.id,
+                'weight': self.weight,
+                'connections': self.connections,
+                'refused': self.refused,
+                'requests': self.requests,
+                'wait_seconds': self.wait_time,
+                'max_wait_seconds': self.max_wait,
+                'busy_seconds': self.busy_time,
+                'cache': self.cache.stats(reset) if self.cache else None,
+            },
+        }
+        if reset:
+            self._reset_counts()
+        return res
+
+
+class FairScheduler:
+    """Decides which request runs next, across tenants.
+
+    At most slots requests run at once, and at most one per tenant,
+    since each tenant's oracle serves one request at a time. When a
+    turn comes up, it goes to the waiting tenant with the least service
+    time divided by its weight, with ties broken by arrival order. A
+    tenant that was idle starts from the current virtual time, so it
+    cannot save up turns while it is not using them.
+    """
+
+    def __init__(self, slots=1):
+        assert slots >= 1
+        self.slots = slots
+        self._cond = threading.Condition()
+        self._running = set()
+        self._waiting = []
+        self._seq = itertools.count()
+        self._clock = 0.0
+
+    def _next(self):
+        ready = [entry for entry in self._waiting if entry[1] not in self._running]
+        return min(ready, key=lambda entry: (entry[1].vtime, entry[0]), default=None)
+
+    @contextlib.contextmanager
+    def turn(self, tenant):
+        """Waits for the tenant's turn, and runs the body of the with."""
+        start = time.perf_counter()
+        with self._cond:
+            if (tenant not in self._running and
+                    not any(t is tenant for _, t in self._waiting)):
+                tenant.vtime = max(tenant.vtime, self._clock)
+            entry = (next(self._seq), tenant)
+            self._waiting.append(entry)
+            while len(self._running) >= self.slots or self._next() is not entry:
+                self._cond.wait()
+            self._waiting.remove(entry)
+            self._running.add(tenant)
+            self._clock = tenant.vtime
+            began = time.perf_counter()
+            tenant.requests += 1
+            tenant.wait_time += began - start
+            tenant.max_wait = max(tenant.max_wait, began - start)
+        try:
+            yield
+        finally:
+            busy = time.perf_counter() - began
+            with self._cond:
+                self._running.discard(tenant)
+                tenant.vtime += busy / tenant.weight
+                tenant.busy_time += busy
+                self._cond.notify_all()
+
+
+class TenantHandler(nworacle.OracleHandler):
+    # Note: must have fields "tenants", a dictionary from tenant ID to
+    # Tenant, and "scheduler", a FairScheduler.
+    # The field "stats" counts the traffic before authentication.
+    tenants = None
+    scheduler = None
+
+    def setup(self):
+        self.tenant = None
+
+    def serve(self, opcode, sockfile):
+        if opcode == nworacle.AUTH:
+            if nworacle.DEBUG: print("Received AUTH request")
+            self.authenticate(sockfile)
+        elif self.tenant is None:
+            raise RuntimeError("ORACLE ERROR: not authenticated", opcode)
+        else:
+            with self.scheduler.turn(self.tenant):
+                self.dispatch(opcode, sockfile)
+
+    def authenticate(self, sockfile):
+        # read tenant ID, send the challenge and check the answer
+        tenant_id = pickle.load(sockfile)
+        nonce = os.urandom(16)
+        pickle.dump(nonce, sockfile)
+        sockfile.flush()
+        digest = pickle.load(sockfile)
+
+        tenant = self.tenants.get(tenant_id)
+        ok = False
+        if self.tenant is None and tenant is not None:
+            if hmac.compare_digest(digest, nworacle.auth_digest(tenant.secret, nonce)):
+                ok = tenant.connect()
+            else:
+                with tenant._lock:
+                    tenant.refused += 1
+        pickle.dump(ok, sockfile)
+        sockfile.flush()
+
+        if ok:
+            self.tenant = tenant
+            self.orc = tenant.orc
+            # count everything from now on as the tenant's
+            sockfile.stats = sockfile.inner.stats = tenant.comm
+
+    def send_stats(self, sockfile):
+        # read the reset flag
+        reset = pickle.load(sockfile)
+
+        pickle.dump(self.tenant.stats(reset), sockfile)
+        sockfile.flush()
+
+    def finish(self):
+        if self.tenant is not None:
+            self.tenant.disconnect()
+
+
+def load_tenants(fname, make_cipher=ciphers.AES):
+    """Reads the tenants from a JSON file, as in the module docstring,
+    with make_cipher(passphrase) for each tenant's cipher. local_size
+    defaults to 100."""
+    with open(fname) as fin:
+        config = json.load(fin)
+    res = []
+    for entry in config['tenants']:
+        res.append(Tenant(entry['id'], entry['secret'],
+                          make_cipher(entry['passphrase']),
+                          entry.get('local_size', 100),
+                          entry.get('weight', 1),
+                          entry.get('max_connections'),
+                          entry.get('cache_size', DEFAULT_CACHE)))
+    return res
+
+def get_tenant_server(tenants, hostname, port, slots=1):
+    """Creates a threaded socketserver for the given Tenant instances,
+    running at most slots requests at once."""
+    class Handler(TenantHandler):
+        stats = commstats.CommStats()
+        scheduler = FairScheduler(slots)
+    Handler.tenants = {tenant.id: tenant for tenant in tenants}
+    assert len(Handler.tenants) == len(tenants), "duplicate tenant IDs"
+    server = socketserver.ThreadingTCPServer((hostname, port), Handler)
+    server.daemon_threads = True
+    return server
@@ -0,0 +1,162 @@
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+A userspace TCP proxy that emulates a slow network link.
+
+This does the same job as test/nwspeed.sh, but needs no root access,
+iptables or tc. The proxy listens on a local port and forwards every
+connection to a target server, delaying the bytes in each direction
+by half of the round-trip time (plus random jitter), and limiting each
+direction to the given bandwidth. Point any OracleClient or NwOpeClient
+at the proxy's address instead of the real server.
+"""
+
+import queue
+import random
+import socket
+import socketserver
+import threading
+import time
+
+BUFSIZE = 65536
+
+class Link:
+    """One direction of the emulated link, shared by all connections."""
+
+    def __init__(self, delay, bandwidth, jitter, rand):
+        """delay and jitter are in seconds, bandwidth in bits per second
+        (or None for unlimited)."""
+        self.delay = delay
+        self.bandwidth = bandwidth
+        self.jitter = jitter
+        self._rand = rand
+        self._free = 0.
+        self._lock = threading.Lock()
+        self.bytes = 0
+
+    def schedule(self, nbytes, last):
+        """Returns the time when nbytes just read should be delivered,
+        never before last so that the stream stays in order."""
+        now = time.monotonic()
+        with self._lock:
+            self.bytes += nbytes
+            if self.bandwidth:
+                self._free = max(now, self._free) + nbytes * 8 / self.bandwidth
+                now = self._free
+            wobble = self._rand.uniform(-self.jitter, self.jitter) if self.jitter else 0.
+        return max(last, now + max(0., self.delay + wobble))
+
+
+def pump(src, dst, link):
+    """Forwards everything from socket src to socket dst through link,
+    until src is closed. Uses one extra thread to do the delayed sends."""
+    pending = queue.Queue()
+
+    def deliver():
+        try:
+            while True:
+                when, data = pending.get()
+                wait = when - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                if not data:
+                    break
+                dst.sendall(data)
+        except OSError:
+            pass
+        finally:
+            try:
+                dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    sender = threading.Thread(target=deliver, daemon=True)
+    sender.start()
+    last = 0.
+    try:
+        while True:
+            data = src.recv(BUFSIZE)
+            last = link.schedule(len(data), last)
+            pending.put((last, data))
+            if not data:
+                break
+    except OSError:
+        pending.put((last, b''))
+    sender.join()
+
+
+class ThrottleHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        proxy = self.server.proxy
+        upstream = socket.create_connection(proxy.target)
+        for sock in (self.request, upstream):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        back = threading.Thread(target=pump, daemon=True,
+                                args=(upstream, self.request, proxy.down))
+        back.start()
+        try:
+            pump(self.request, upstream, proxy.up)
+            back.join()
+        finally:
+            upstream.close()
+
+
+class ProxyServer(socketserver.ThreadingTCPServer):
+    """The proxy's listening server, which can rebind its port right
+    after a previous proxy on it was stopped."""
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class ThrottleProxy:
+    """Forwards connections on a local port to a target server over an
+    emulated link. Use as a context manager, or call start() and stop().
+
+    rtt and jitter are in milliseconds, bandwidth in kbits per second
+    (the same units as nwspeed.sh). Each direction gets half the rtt,
+    plus a uniform random amount in [-jitter, jitter], and its own
+    bandwidth limit shared by all connections through the proxy.
+    """
+
+    def __init__(self, target_host, target_port, rtt=0, bandwidth=None,
+                 jitter=0, host='localhost', port=0, seed=None):
+        self.target = (target_host, target_port)
+        rand = random.Random(seed)
+        bps = bandwidth * 1000 if bandwidth else None
+        self.up = Link(rtt / 2000, bps, jitter / 1000, rand)
+        self.down = Link(rtt / 2000, bps, jitter / 1000, rand)
+        self._serv = ProxyServer((host, port), ThrottleHandler)
+        self._serv.proxy = self
+        self._thread = None
+
+    @property
+    def address(self):
+        """The (hostname, port) that clients should connect to."""
+        return self._serv.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serv.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread:
+            self._serv.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._serv.server_close()
+
+    def counts(self):
+        """Returns the number of bytes sent (to the target, from the target)."""
+        return (self.up.bytes, self.down.bytes)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
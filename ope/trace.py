@@ -0,0 +1,221 @@
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+Lightweight instrumentation of where the time goes in OPE operations.
+
+The oracle, the POPE tree and the network layers wrap their expensive
+steps in named spans:
+
+    with trace.span('oracle.partition'):
+        ...
+
+A span must not stay open across a yield, or it would also time
+whatever the consumer does in between: generators compute their
+results inside the span and yield them after it, or, if they must
+stream, give each result a short span of its own.
+
+By default nothing is recorded and a span costs one function call.
+Calling set_tracer() with one of the tracers below turns recording on,
+for every span in the process.
+"""
+
+import time
+import json
+import math
+import sys
+import threading
+
+class Tracer:
+    """Base class for tracers, which get a start() and end() call for
+    every span. This one does nothing."""
+
+    def start(self, name):
+        """Called when a span starts. The return value is passed to end()."""
+        return None
+
+    def end(self, token):
+        """Called when the span for the given start() token finishes."""
+        pass
+
+
+class JsonLinesTracer(Tracer):
+    """Writes one JSON object per finished span to the given file.
+
+    Each record holds the span name, a unique id, the id of the enclosing
+    span in the same thread (or null), the thread id, and the start time
+    and duration in seconds.
+    """
+
+    def __init__(self, dest=sys.stderr):
+        self.dest = dest
+        self._ids = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._epoch = time.perf_counter()
+
+    def start(self, name):
+        stack = self._stack()
+        with self._lock:
+            self._ids += 1
+            sid = self._ids
+        parent = stack[-1] if stack else None
+        stack.append(sid)
+        return (name, sid, parent, time.perf_counter())
+
+    def end(self, token):
+        finish = time.perf_counter()
+        name, sid, parent, begin = token
+        stack = self._stack()
+        if stack and stack[-1] == sid:
+            stack.pop()
+        record = {
+            'span': name,
+            'id': sid,
+            'parent': parent,
+            'thread': threading.get_ident(),
+            'start': begin - self._epoch,
+            'duration': finish - begin,
+        }
+        line = json.dumps(record, sort_keys=True)
+        with self._lock:
+            print(line, file=self.dest)
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+
+class HistogramTracer(Tracer):
+    """Keeps a latency histogram for every span name.
+
+    Bucket i counts the spans that took less than 2**i microseconds
+    (and at least half that).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hists = {}
+
+    def start(self, name):
+        return (name, time.perf_counter())
+
+    def end(self, token):
+        elapsed = time.perf_counter() - token[1]
+        micros = elapsed * 1e6
+        bucket = 0 if micros < 1 else int(math.log2(micros)) + 1
+        with self._lock:
+            hist = self._hists.get(token[0])
+            if hist is None:
+                hist = self._hists[token[0]] = [0, 0.0, elapsed, elapsed, []]
+            hist[0] += 1
+            hist[1] += elapsed
+            hist[2] = min(hist[2], elapsed)
+            hist[3] = max(hist[3], elapsed)
+            buckets = hist[4]
+            if bucket >= len(buckets):
+                buckets.extend([0] * (bucket + 1 - len(buckets)))
+            buckets[bucket] += 1
+
+    def histograms(self, reset=False):
+        """Returns a dictionary mapping each span name to a dictionary
+        with its count, total/min/max seconds and bucket counts."""
+        with self._lock:
+            res = {name: {'count': c, 'total': t, 'min': lo, 'max': hi,
+                          'buckets': list(b)}
+                   for name, (c, t, lo, hi, b) in self._hists.items()}
+            if reset:
+                self._hists = {}
+        return res
+
+    def summary(self, reset=False, dest=sys.stdout):
+        """Prints a table of latencies per span name."""
+        hists = self.histograms(reset)
+        print("{:<28} {:>8} {:>11} {:>10} {:>10} {:>10} {:>10}".format(
+            'span', 'count', 'total ms', 'mean us', 'p50 us', 'p99 us', 'max us'),
+            file=dest)
+        for name in sorted(hists):
+            h = hists[name]
+            print("{:<28} {:>8} {:>11.2f} {:>10.1f} {:>10} {:>10} {:>10.1f}".format(
+                name, h['count'], h['total'] * 1e3, h['total'] / h['count'] * 1e6,
+                _percentile(h, .5), _percentile(h, .99), h['max'] * 1e6),
+                file=dest)
+
+
+class MultiTracer(Tracer):
+    """Passes every span on to several tracers."""
+
+    def __init__(self, *tracers):
+        self.tracers = tracers
+
+    def start(self, name):
+        return [t.start(name) for t in self.tracers]
+
+    def end(self, token):
+        for t, tok in zip(reversed(self.tracers), reversed(token)):
+            t.end(tok)
+
+
+def _percentile(hist, frac):
+    """Upper bound (in microseconds) of the bucket holding the given
+    fraction of the spans, as a string."""
+    target = frac * hist['count']
+    seen = 0
+    for i, n in enumerate(hist['buckets']):
+        seen += n
+        if seen >= target:
+            return "<{}".format(2**i)
+    return "?"
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, v, r):
+        return False
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'token')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.token = self.tracer.start(self.name)
+        return self
+
+    def __exit__(self, t, v, r):
+        self.tracer.end(self.token)
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+_tracer = None
+
+def set_tracer(tracer):
+    """Installs the given tracer for all spans, or turns tracing off
+    if tracer is None. Returns the previous tracer."""
+    global _tracer
+    prev = _tracer
+    _tracer = tracer
+    return prev
+
+def get_tracer():
+    """Returns the current tracer, or None if tracing is off."""
+    return _tracer
+
+def span(name):
+    """Returns a context manager that times the enclosed block."""
+    if _tracer is None:
+        return _NULL_SPAN
+    return _Span(_tracer, name)
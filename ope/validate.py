@@ -0,0 +1,95 @@
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+Opt-in checking of the invariants of the OPE back-ends.
+
+Pope, Mope and Cheater each take a validation argument, which is one of
+the levels below or a Validator. After every operation, the back-end
+calls done(), and depending on the level either nothing happens, only
+the nodes touched by that operation are checked, the whole structure is
+checked once in a while, or the whole structure is checked every time.
+
+The default is OFF, where a touch() or done() call costs almost nothing.
+"""
+
+import random
+
+OFF = 'off'
+INCREMENTAL = 'incremental'
+SAMPLED = 'sampled'
+FULL = 'full'
+
+LEVELS = (OFF, INCREMENTAL, SAMPLED, FULL)
+
+class Validator:
+    """Decides what to check after each operation of one back-end.
+
+    The back-end must provide check(full) for the whole structure, and
+    check_node(node, full) for a single node it touched. Checks with
+    full=True also decrypt keys to verify their order.
+    """
+
+    def __init__(self, level=OFF, rate=0.01, seed=None, full=False):
+        """rate is the fraction of operations checked at the SAMPLED
+        level; seed seeds the private PRNG used to pick them.
+        full says whether checks should decrypt and compare keys, which
+        needs an oracle with the crypt (not a network client).
+        """
+        assert level in LEVELS
+        self.level = level
+        self.rate = rate
+        self.full = full
+        self.incremental = (level == INCREMENTAL)
+        self._rand = random.Random(seed)
+        self._touched = {}
+        self._ops = 0
+        self._checks = 0
+        self._nodes = 0
+
+    def touch(self, node):
+        """Marks a node as changed by the current operation."""
+        if self.incremental:
+            self._touched[id(node)] = node
+
+    def done(self, owner):
+        """Called by the back-end owner at the end of every operation."""
+        if self.level == OFF:
+            return
+        self._ops += 1
+        if self.level == INCREMENTAL:
+            touched = list(self._touched.values())
+            self._touched.clear()
+            for node in touched:
+                owner.check_node(node, self.full)
+            self._nodes += len(touched)
+        elif self.level == FULL or self._rand.random() < self.rate:
+            owner.check(self.full)
+            self._checks += 1
+
+    def reset(self):
+        """Forgets touched nodes, like after the structure is cleared."""
+        self._touched.clear()
+
+    def counts(self, reset=False):
+        """Returns (operations, full structure checks, nodes checked)."""
+        res = [self._ops, self._checks, self._nodes]
+        if reset:
+            self._ops = self._checks = self._nodes = 0
+        return res
+
+
+def get_validator(validation, oracle=None):
+    """Turns the validation argument of a back-end (None, a level name,
+    or a Validator) into a Validator. A level name gets full checks if
+    the back-end's oracle has the crypt to decrypt keys with."""
+    if validation is None:
+        return Validator(OFF)
+    elif isinstance(validation, Validator):
+        return validation
+    else:
+        return Validator(validation, full=hasattr(oracle, 'crypt'))
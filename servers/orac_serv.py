@@ -9,6 +9,10 @@
 
 """
 A simple script to start up a comparison oracle server
+
+With --tenants, one server hosts every tenant listed in the given
+JSON file (see ope/tenants.py), and the passphrase and local size
+are not needed.
 """
 
 import argparse
@@ -16,22 +20,37 @@ import argparse
 from ope import ciphers
 from ope import oracle
 from ope import nworacle
+from ope import tenants
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Start the Oracle server')
     parser.add_argument('oracle_hostname')
     parser.add_argument('oracle_port', type=int)
-    parser.add_argument('passphrase')
-    parser.add_argument('local_size', type=int)
+    parser.add_argument('passphrase', nargs='?')
+    parser.add_argument('local_size', type=int, nargs='?')
+    parser.add_argument('--tenants', metavar='CONFIG',
+            help="Host all the tenants in this JSON file")
+    parser.add_argument('--slots', type=int, default=1,
+            help="Tenant requests to run at once (default 1)")
+    parser.add_argument('-s', '--single', action='store_false', dest='threaded',
+            help="Serve one connection at a time (clients with a --pool "
+                 "or --multi POPE server then hang)")
     parser.add_argument('-d', '--debug', action='store_true', default=False)
     args = parser.parse_args()
 
     nworacle.DEBUG = args.debug
 
-    crypt = ciphers.AES(args.passphrase)
-    orc = oracle.Oracle(crypt, args.local_size)
+    if args.tenants:
+        serv = tenants.get_tenant_server(tenants.load_tenants(args.tenants),
+                args.oracle_hostname, args.oracle_port, args.slots)
+    else:
+        if args.passphrase is None or args.local_size is None:
+            parser.error("passphrase and local_size are required without --tenants")
+        crypt = ciphers.AES(args.passphrase)
+        orc = oracle.Oracle(crypt, args.local_size)
 
-    serv = nworacle.get_oracle_server(orc, args.oracle_hostname, args.oracle_port)
+        serv = nworacle.get_oracle_server(orc, args.oracle_hostname, args.oracle_port,
+                                         threaded=args.threaded)
 
     print("The comparison oracle server is listening on", args.oracle_hostname, "port", args.oracle_port)
     print("Press CTL-C to stop")
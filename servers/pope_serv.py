@@ -9,13 +9,25 @@
 
 """
 An executable script to start up a POPE server
+
+With --multi, the server hosts any number of named indexes (see
+ope/catalog.py), all sharing the connections to the oracle.
+
+With --coalesce, concurrent lookups and range searches are run together
+in batches gathered over the given window (see ope/coalesce.py).
+
+With --cache-size, every index caches range search results, holding up
+to that many (key,value) pairs in total (see ope/rangecache.py).
 """
 
 import argparse
 
 from ope import pope
+from ope import catalog
+from ope import coalesce
 from ope import nworacle
 from ope import nwopec
+from ope import compress
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Start the POPE server')
@@ -23,15 +35,38 @@ if __name__ == '__main__':
     parser.add_argument('oracle_port', type=int)
     parser.add_argument('pope_hostname')
     parser.add_argument('pope_port', type=int)
+    parser.add_argument('-p', '--pool', type=int, default=1,
+            help="Number of connections to the oracle server (default 1)")
+    parser.add_argument('-z', '--compress', choices=sorted(compress.CODECS),
+            help="Compress the traffic to the oracle with this algorithm")
+    parser.add_argument('-m', '--multi', action='store_true', default=False,
+            help="Host many named indexes, each request in its own thread")
+    parser.add_argument('-c', '--coalesce', type=float, metavar='SECONDS',
+            help="Run concurrent queries in batches gathered over this window")
+    parser.add_argument('--cache-size', type=int, default=0, metavar='N',
+            help="Cache range search results, up to N (key,value) pairs (default 0, no cache)")
     parser.add_argument('-d', '--debug', action='store_true', default=False)
     args = parser.parse_args()
+    if args.multi and args.coalesce is not None:
+        parser.error("--multi and --coalesce cannot be used together")
 
     nwopec.DEBUG = args.debug
 
-    with nworacle.OracleClient(args.oracle_hostname, args.oracle_port) as orc:
-        popeinst = pope.Pope(orc)
+    with nworacle.OracleClient(args.oracle_hostname, args.oracle_port,
+                               pool_size=args.pool, codec=args.compress) as orc:
+        if args.multi:
+            cat = catalog.Catalog(lambda name: pope.Pope(orc, args.cache_size))
+            serv = catalog.get_catalog_server(cat, args.pope_hostname, args.pope_port,
+                                              threaded=True)
+        elif args.coalesce is not None:
+            popeinst = pope.Pope(orc, args.cache_size)
+
+            serv = coalesce.get_coalescing_server(popeinst, args.pope_hostname,
+                                                  args.pope_port, args.coalesce)
+        else:
+            popeinst = pope.Pope(orc, args.cache_size)
 
-        serv = nwopec.get_pope_server(popeinst, args.pope_hostname, args.pope_port)
+            serv = nwopec.get_pope_server(popeinst, args.pope_hostname, args.pope_port)
 
         print("The POPE server is listening on", args.pope_hostname, "port", args.pope_port)
         print("Press CTL-C to stop")
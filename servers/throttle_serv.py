@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+A script to start up a throttling proxy in front of another server,
+for example between the POPE server and the comparison oracle.
+"""
+
+import argparse
+import time
+
+from ope.throttle import ThrottleProxy
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Start a throttling proxy')
+    parser.add_argument('target_hostname')
+    parser.add_argument('target_port', type=int)
+    parser.add_argument('proxy_hostname')
+    parser.add_argument('proxy_port', type=int)
+    parser.add_argument('--rtt', type=float, default=0,
+            help="Round-trip time in ms")
+    parser.add_argument('--bandwidth', type=float,
+            help="Bandwidth in kbits/sec (default unlimited)")
+    parser.add_argument('--jitter', type=float, default=0,
+            help="Random jitter in ms")
+    args = parser.parse_args()
+
+    proxy = ThrottleProxy(args.target_hostname, args.target_port,
+                          args.rtt, args.bandwidth, args.jitter,
+                          args.proxy_hostname, args.proxy_port)
+
+    print("The throttling proxy is listening on", args.proxy_hostname, "port", args.proxy_port)
+    print("Press CTL-C to stop")
+
+    try:
+        proxy.start()
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print("Goodbye!")
+    finally:
+        proxy.stop()
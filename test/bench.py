@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+Benchmarks every OPE engine on synthetic workloads from the workload
+module, locally and over the network.
+
+Every combination of the given engines, modes, sizes, oracle sizes L,
+key distributions, insert/query ratios and range widths is run once,
+and one JSON object per run is written to the output, holding the
+parameters along with wall time, oracle rounds and items, bytes
+and peak memory (as seen by tracemalloc). Bytes to and from a local
+oracle are not counted (null), since that would slow it down.
+
+The networked mode runs the oracle server and the POPE/mOPE server in
+threads of this process, on ephemeral localhost ports. The cheater
+engine needs the decryption key on the server, so it only runs locally.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import workload
+
+from ope import ciphers
+from ope.cluster import Cluster
+from ope.opec import OpeClient
+from ope.oracle import Oracle
+from ope.pope import Pope
+from ope.mope import Mope
+from ope.cheater import Cheater
+
+ENGINES = {'pope': Pope, 'mope': Mope, 'cheater': Cheater}
+MODES = ('local', 'net')
+
+
+class LocalRun:
+    """An engine with a local oracle, accessed through an OpeClient."""
+
+    def __init__(self, engine, crypt, L):
+        self.crypt = crypt
+        self.orc = Oracle(crypt, L)
+        self.serv = ENGINES[engine](self.orc)
+        self.client = OpeClient(self.serv, crypt)
+
+    def insert_many(self, pairs):
+        """Inserts plaintext pairs at once, if the engine can."""
+        if hasattr(self.serv, 'insert_many'):
+            self.serv.insert_many([(self.crypt.encode(k), self.crypt.encode(v))
+                                   for k, v in pairs])
+        else:
+            for k, v in pairs:
+                self.client.insert(k, v)
+
+    def results(self):
+        ostats = self.orc.stats()
+        return {
+            'rounds': ostats['rounds'],
+            'items_in': ostats['items_in'],
+            'items_out': ostats['items_out'],
+            'oracle_bytes': ostats['sent'] + ostats['received'] if self.orc.count_bytes else None,
+            'client_bytes': 0,
+        }
+
+    def close(self):
+        pass
+
+
+class NetRun:
+    """An engine behind a POPE server, with its oracle behind an oracle
+    server, both in threads of this process, started by a Cluster."""
+
+    def __init__(self, engine, crypt, L):
+        self.crypt = crypt
+        self.cluster = Cluster(crypt, L, [engine]).start()
+        self.client = self.cluster.clients[0]
+
+    def insert_many(self, pairs):
+        for k, v in pairs:
+            self.client.insert(k, v)
+
+    def results(self):
+        stats = self.cluster.stats()
+        ostats = stats['oracle']['oracle']
+        # as seen by the oracle server, leaving out our STATS request
+        oserver = stats['oracle']['server']
+        ostats_req = oserver['bytes'].get('stats', {})
+        ccomm = stats['clients'][0]
+        return {
+            'rounds': ostats['rounds'],
+            'items_in': ostats['items_in'],
+            'items_out': ostats['items_out'],
+            'oracle_bytes': oserver['sent'] + oserver['received']
+                            - sum(ostats_req.values()),
+            'client_bytes': ccomm['sent'] + ccomm['received'],
+        }
+
+    def close(self):
+        self.cluster.stop()
+
+
+def run(ops, engine, mode, crypt, L, batch=0, memory=True):
+    """Runs the operations on a fresh engine and returns the measurements."""
+    if memory:
+        tracemalloc.start()
+    runner = (LocalRun if mode == 'local' else NetRun)(engine, crypt, L)
+    client = runner.client
+    returned = 0
+    pending = []
+    try:
+        elapsed = -time.perf_counter()
+        for op in ops:
+            if op[0] == 'insert':
+                if batch > 1:
+                    pending.append(op[1:])
+                    if len(pending) < batch:
+                        continue
+                    runner.insert_many(pending)
+                    pending = []
+                else:
+                    client.insert(op[1], op[2])
+                continue
+            if pending:
+                runner.insert_many(pending)
+                pending = []
+            if op[0] == 'lookup':
+                client.lookup(op[1])
+            else:
+                returned += sum(1 for _ in client.range_search(op[1], op[2]))
+        if pending:
+            runner.insert_many(pending)
+        # inserts get no reply over the network, so wait for the last one
+        client.size()
+        elapsed += time.perf_counter()
+        res = runner.results()
+    finally:
+        runner.close()
+        if memory:
+            res_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    res['wall'] = elapsed
+    res['ops_per_sec'] = len(ops) / elapsed if elapsed > 0 else None
+    res['returned'] = returned
+    res['peak_bytes'] = res_peak if memory else None
+    return res
+
+PARAMS = ('engine', 'mode', 'size', 'L', 'dist', 'ratio', 'width',
+          'lookups', 'seed', 'batch', 'cipher')
+
+# measurements that are the same in every run with the same parameters,
+# so any increase at all is a regression (None where not measured)
+EXACT = ('rounds', 'items_in', 'items_out', 'oracle_bytes', 'client_bytes')
+# measurements that must not change at all. Each record is compared with
+# the baseline record for the same engine, since Pope's ranges are
+# (k1, k2] while mOPE's and the cheater's are [k1, k2)
+SAME = ('returned',)
+
+def scenarios(args):
+    """Returns the parameter dictionaries for every run asked for."""
+    res = []
+    for size, dist, ratio, width, engine, mode, L in itertools.product(
+            args.sizes, args.dists, args.ratios, args.widths,
+            args.engines, args.modes, args.L):
+        if engine == 'cheater' and mode != 'local':
+            continue
+        res.append({
+            'engine': engine, 'mode': mode, 'size': size, 'L': L,
+            'dist': dist, 'ratio': ratio, 'width': width,
+            'lookups': args.lookups, 'seed': args.seed,
+            'batch': args.batch if mode == 'local' else 0,
+            'cipher': 'dumb' if args.dumb else 'aes',
+        })
+    return res
+
+def run_all(params_list, memory, dest=None):
+    """Runs every scenario, writing each record to dest as it finishes.
+    Returns the list of records."""
+    records = []
+    workloads = {}
+    for params in params_list:
+        wkey = tuple(params[k] for k in ('size', 'ratio', 'dist', 'width', 'lookups', 'seed'))
+        if wkey not in workloads:
+            workloads.clear()
+            workloads[wkey] = workload.generate(*wkey)
+        ops = workloads[wkey]
+        crypt = ciphers.DumbCipher('key') if params['cipher'] == 'dumb' else ciphers.AES()
+        # POPE picks its split points at random
+        random.seed(params['seed'])
+        record = dict(params)
+        record['ops'] = workload.counts(ops)
+        record.update(run(ops, params['engine'], params['mode'], crypt,
+                          params['L'], params['batch'], memory))
+        records.append(record)
+        if dest is not None:
+            print(json.dumps(record, sort_keys=True), file=dest)
+            dest.flush()
+        print("{engine:>8} {mode:>5} n={size} L={L} {dist} r={ratio} w={width}: "
+              "{wall:.3f}s, {rounds} rounds".format(**record), file=sys.stderr)
+    return records
+
+def compare(baseline, records, tolerance, mem_tolerance=None):
+    """Compares records with the baseline records for the same parameters.
+
+    The exact measurements may not go up at all, and the SAME ones may
+    not change at all. Throughput may drop by
+    at most the fraction tolerance, and peak memory may grow by at most
+    mem_tolerance (if given). Returns a list of lines describing every
+    regression, which is empty if there are none.
+    """
+    problems = []
+    for old, new in zip(baseline, records):
+        name = "{engine} {mode} n={size} L={L} {dist} r={ratio} w={width}".format(**old)
+        for field in EXACT:
+            if new[field] is None or old[field] is None:
+                continue
+            if new[field] > old[field]:
+                problems.append("{}: {} went from {} to {} (+{})".format(
+                    name, field, old[field], new[field], new[field] - old[field]))
+        for field in SAME:
+            if new[field] != old[field]:
+                problems.append("{}: {} changed from {} to {}".format(
+                    name, field, old[field], new[field]))
+        if new['ops_per_sec'] < old['ops_per_sec'] * (1 - tolerance):
+            problems.append("{}: throughput went from {:.1f} to {:.1f} ops/sec ({:+.1%}, tolerance {:.0%})".format(
+                name, old['ops_per_sec'], new['ops_per_sec'],
+                new['ops_per_sec'] / old['ops_per_sec'] - 1, tolerance))
+        if (mem_tolerance is not None and old.get('peak_bytes') and new.get('peak_bytes')
+                and new['peak_bytes'] > old['peak_bytes'] * (1 + mem_tolerance)):
+            problems.append("{}: peak memory went from {} to {} bytes ({:+.1%}, tolerance {:.0%})".format(
+                name, old['peak_bytes'], new['peak_bytes'],
+                new['peak_bytes'] / old['peak_bytes'] - 1, mem_tolerance))
+    return problems
+
+def improvements(baseline, records):
+    """Returns lines describing the exact measurements that went down."""
+    res = []
+    for old, new in zip(baseline, records):
+        for field in EXACT:
+            if new[field] is None or old[field] is None:
+                continue
+            if new[field] < old[field]:
+                res.append("{engine} {mode} n={size} L={L} {dist}: ".format(**old)
+                    + "{} went from {} to {}".format(field, old[field], new[field]))
+    return res
+
+def main(args, dest):
+    if args.compare:
+        with open(args.compare) as fin:
+            baseline = json.load(fin)['runs']
+        params_list = [{k: rec[k] for k in PARAMS} for rec in baseline]
+        records = run_all(params_list, 'peak_bytes' in baseline[0]
+                          and baseline[0]['peak_bytes'] is not None, dest)
+        for line in improvements(baseline, records):
+            print("improved:", line, file=sys.stderr)
+        problems = compare(baseline, records, args.tolerance, args.mem_tolerance)
+        if problems:
+            print("REGRESSION against", args.compare, file=sys.stderr)
+            for line in problems:
+                print("   ", line, file=sys.stderr)
+            return 1
+        print("No regressions against", args.compare, file=sys.stderr)
+        return 0
+
+    records = run_all(scenarios(args), not args.no_memory, dest)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as fout:
+            json.dump({'runs': records}, fout, indent=1, sort_keys=True)
+            print(file=fout)
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="OPE benchmark suite")
+    parser.add_argument('-e', '--engines', nargs='+', choices=sorted(ENGINES),
+            default=['pope', 'mope', 'cheater'])
+    parser.add_argument('-m', '--modes', nargs='+', choices=MODES, default=['local'])
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', default=[10000],
+            help="Numbers of inserts (default 10000)")
+    parser.add_argument('-L', type=int, nargs='+', default=[100],
+            help="Oracle sizes (default 100)")
+    parser.add_argument('-k', '--dists', nargs='+', choices=workload.DISTRIBUTIONS,
+            default=['uniform'], help="Key distributions")
+    parser.add_argument('-r', '--ratios', type=float, nargs='+', default=[10],
+            help="Average inserts per query (default 10)")
+    parser.add_argument('-w', '--widths', type=float, nargs='+', default=[0.001],
+            help="Range widths, as fractions of the key domain")
+    parser.add_argument('-l', '--lookups', type=float, default=0.0,
+            help="Fraction of queries that are lookups instead of ranges")
+    parser.add_argument('-b', '--batch', type=int, default=0,
+            help="Insert this many at a time with insert_many, where supported")
+    parser.add_argument('-s', '--seed', type=int, default=1984)
+    parser.add_argument('-d', '--dumb', action='store_true',
+            help="Use the (insecure, but faster) dummy cipher")
+    parser.add_argument('--no-memory', action='store_true',
+            help="Do not trace memory, which slows everything down")
+    parser.add_argument('-o', '--output', help="File for the JSON lines (default stdout)")
+    parser.add_argument('--save-baseline', metavar='FILE',
+            help="Also store all the results as a baseline in FILE")
+    parser.add_argument('-c', '--compare', metavar='FILE',
+            help="Rerun the runs in baseline FILE (ignoring the parameters above) "
+                 "and exit with status 1 if anything got worse")
+    parser.add_argument('-t', '--tolerance', type=float, default=0.5,
+            help="Fraction that throughput may drop before it counts as "
+                 "a regression with --compare (default 0.5)")
+    parser.add_argument('--mem-tolerance', type=float,
+            help="Fraction that peak memory may grow with --compare "
+                 "(default: not checked)")
+    args = parser.parse_args()
+
+    if args.output:
+        with open(args.output, 'w') as dest:
+            status = main(args, dest)
+    else:
+        status = main(args, open(os.devnull, 'w') if args.compare else sys.stdout)
+    sys.exit(status)
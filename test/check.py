@@ -10,6 +10,8 @@ from ope.pope import Pope
 from ope.cheater import Cheater
 from ope.mope import Mope
 from ope.oracle import Oracle
+from ope import trace
+from ope import validate
 
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1].startswith('-'):
@@ -23,6 +25,9 @@ if __name__ == '__main__':
     random.seed(seed)
     print("seed is", seed)
 
+    timings = trace.HistogramTracer()
+    trace.set_tracer(timings)
+
     for algo in (Cheater, Pope, Mope):
         print("Checking {}...".format(algo.__name__))
 
@@ -47,7 +52,7 @@ if __name__ == '__main__':
 
         #cl = client.Client(mem=5, key='e', cipher=EC)
         crypt = DumbCipher('enkey')
-        cl = OpeClient(algo(Oracle(crypt, 5)), crypt)
+        cl = OpeClient(algo(Oracle(crypt, 5), validation=validate.INCREMENTAL), crypt)
 
         for s in ins:
             cl.insert(s, s+'v')
@@ -91,7 +96,7 @@ if __name__ == '__main__':
 
         # initialize the database and insert the key,value pairs
         crypt = AES()
-        cl = OpeClient(algo(Oracle(crypt, 5)), crypt)
+        cl = OpeClient(algo(Oracle(crypt, 5), validation=validate.INCREMENTAL), crypt)
         checker = {}
         for (k,v) in pairs:
             cl.insert(k,v)
@@ -99,7 +104,7 @@ if __name__ == '__main__':
 
         assert cl.size() == N
         # print("Finished inserting {} items".format(N))
-        cl._serv._cmp.counts_summary(True)
+        timings.summary(reset=True)
         # print("Tree structure:")
         cl._serv.check(info=True)
         # print()
@@ -112,7 +117,7 @@ if __name__ == '__main__':
                 assert cl.lookup(w) is None
 
         # print("Finished checking {} random lookups".format(nlook))
-        cl._serv._cmp.counts_summary(True)
+        timings.summary(reset=True)
         # print("Tree structure:")
         cl._serv.check(info=True)
         # print()
@@ -124,7 +129,7 @@ if __name__ == '__main__':
             assert res == checkset
 
         # print("Finished checking {} ranges".format(len(ranges)))
-        cl._serv._cmp.counts_summary(True)
+        timings.summary(reset=True)
         # print("Tree structure:")
         cl._serv.check(info=True)
         # print()
@@ -133,7 +138,7 @@ if __name__ == '__main__':
             assert cl.lookup(w) == checker[w]
 
         # print("Finished checking {} successful lookups".format(N))
-        cl._serv._cmp.counts_summary(True)
+        timings.summary(reset=True)
         # print("Tree structure:")
         cl._serv.check(info=True)
         # print()
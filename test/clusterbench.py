@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+Runs a networked OPE benchmark with a single command.
+
+An in-process cluster (see ope.cluster) brings up the oracle server and
+one POPE or mOPE server per engine given, on ephemeral localhost ports,
+in threads or in child processes. Each back-end gets its own client,
+and all the clients run the same synthetic workload at the same time,
+each from its own thread. At the end the stats of every component are
+printed as one JSON object, and everything is shut down.
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+
+import workload
+
+from ope import ciphers
+from ope import compress
+from ope.cluster import Cluster, ENGINES
+
+
+def play(client, ops):
+    """Runs the operations through one client and returns
+    (seconds, items returned)."""
+    returned = 0
+    start = time.perf_counter()
+    for op in ops:
+        if op[0] == 'insert':
+            client.insert(op[1], op[2])
+        elif op[0] == 'lookup':
+            client.lookup(op[1])
+        else:
+            returned += sum(1 for _ in client.range_search(op[1], op[2]))
+    # inserts get no reply, so wait for the last one
+    client.size()
+    return time.perf_counter() - start, returned
+
+def scenario(ops):
+    """Returns a scenario for Cluster.run that plays ops on every client
+    in parallel."""
+    def go(clients):
+        results = [None] * len(clients)
+        def worker(i):
+            results[i] = play(clients[i], ops)
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(clients))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+    return go
+
+def main(args):
+    ops = workload.generate(args.size, args.ratio, args.dist, args.width,
+                            args.lookups, args.seed)
+    crypt = ciphers.DumbCipher('key') if args.dumb else ciphers.AES()
+
+    start = time.perf_counter()
+    with Cluster(crypt, args.L, args.engines, args.processes, args.debug,
+                 args.compress, args.threshold) as clu:
+        results, stats = clu.run(scenario(ops))
+    total = time.perf_counter() - start
+
+    stats['ops'] = workload.counts(ops)
+    stats['total_seconds'] = total
+    for bstats, (elapsed, returned) in zip(stats['backends'], results):
+        bstats['wall'] = elapsed
+        bstats['ops_per_sec'] = len(ops) / elapsed if elapsed > 0 else None
+        bstats['returned'] = returned
+    json.dump(stats, sys.stdout, indent=1, sort_keys=True, default=repr)
+    print()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Networked OPE benchmark on one machine")
+    parser.add_argument('size', nargs='?', type=int, default=2000,
+            help="Number of inserts per client (default 2000)")
+    parser.add_argument('-e', '--engines', nargs='+', choices=sorted(ENGINES),
+            default=['pope'], help="One back-end server per entry (default pope)")
+    parser.add_argument('-L', type=int, default=100, help="Oracle size (default 100)")
+    parser.add_argument('-p', '--processes', action='store_true',
+            help="Run each server in a child process instead of a thread")
+    parser.add_argument('-k', '--dist', choices=workload.DISTRIBUTIONS, default='uniform')
+    parser.add_argument('-r', '--ratio', type=float, default=10,
+            help="Average inserts per query (default 10)")
+    parser.add_argument('-w', '--width', type=float, default=0.001,
+            help="Range width as a fraction of the key domain")
+    parser.add_argument('-l', '--lookups', type=float, default=0.0,
+            help="Fraction of queries that are lookups")
+    parser.add_argument('-s', '--seed', type=int, default=1984)
+    parser.add_argument('-d', '--dumb', action='store_true',
+            help="Use the (insecure, but faster) dummy cipher")
+    parser.add_argument('-z', '--compress', choices=sorted(compress.CODECS),
+            help="Compress every connection with this algorithm")
+    parser.add_argument('--threshold', type=int, default=compress.DEFAULT_THRESHOLD,
+            help="Smallest frame to compress, in bytes (default {})".format(
+                compress.DEFAULT_THRESHOLD))
+    parser.add_argument('--debug', action='store_true',
+            help="Let the servers print every request")
+    args = parser.parse_args()
+
+    main(args)
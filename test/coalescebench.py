@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+
+"""
+Measures query coalescing in the POPE server (see ope/coalesce.py).
+
+Loads a synthetic workload's inserts into a POPE server, then has many
+client threads send its queries at once, first to a plain threaded
+server and then to coalescing servers with different windows. For each,
+prints the time, the oracle rounds the queries took and the rounds
+saved against the plain server, with the coalescer's batches and the
+mean and worst time queries waited for their batch.
+
+The oracle and POPE servers run in child processes on localhost.
+"""
+
+import argparse
+import sys
+import threading
+import time
+
+import workload
+
+from ope import ciphers
+from ope import coalesce
+from ope import nworacle
+from ope import nwopec
+from ope import pope
+from ope.cluster import ProcessComponent, oracle_server, remote_stats
+
+def pope_server(oracle_address, window):
+    """A threaded POPE server, coalescing with the given window unless
+    it is None, and the things to close after it."""
+    orc = nworacle.OracleClient(*oracle_address)
+    orc.open()
+    serv = pope.Pope(orc)
+    if window is None:
+        return nwopec.get_pope_server(serv, 'localhost', 0, threaded=True), [orc]
+    return coalesce.get_coalescing_server(serv, 'localhost', 0, window), [orc]
+
+def client(address, crypt, queries):
+    with nwopec.NwOpeClient(*address, crypt, clearit=False) as conn:
+        for op in queries:
+            if op[0] == 'lookup':
+                conn.lookup(op[1])
+            else:
+                conn.range_search(op[1], op[2])
+
+def run(crypt, L, ops, clients, window):
+    """Returns (seconds, oracle rounds, coalescer stats or None) for
+    the queries in ops, after loading the inserts."""
+    orc = ProcessComponent(oracle_server, crypt, L)
+    try:
+        serv = ProcessComponent(pope_server, orc.address, window)
+        try:
+            with nwopec.NwOpeClient(*serv.address, crypt, clearit=False) as loader:
+                for op in ops:
+                    if op[0] == 'insert':
+                        loader.insert(op[1], op[2])
+                loader.size()
+                loader.stats(reset=True)
+            remote_stats(orc.address, nworacle.STATS, reset=True)
+            queries = [op for op in ops if op[0] != 'insert']
+            threads = [threading.Thread(target=client,
+                                        args=(serv.address, crypt, queries[i::clients]))
+                       for i in range(clients)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+            rounds = remote_stats(orc.address, nworacle.STATS)['oracle']['rounds']
+            res = remote_stats(serv.address, nwopec.STATS)
+            return elapsed, rounds, res.get('coalesce')
+        finally:
+            serv.stop()
+    finally:
+        orc.stop()
+
+def main(args):
+    nworacle.DEBUG = nwopec.DEBUG = False
+    crypt = ciphers.DumbCipher('key') if args.dumb else ciphers.AES()
+    ops = workload.generate(args.size, args.ratio, args.dist, args.width,
+                            args.lookups, args.seed)
+    print("{:>8} {:>8} {:>8} {:>8} {:>8} {:>10} {:>10}".format(
+        'window', 'seconds', 'rounds', 'saved', 'batches', 'mean wait', 'max wait'))
+    base = None
+    for window in [None] + args.windows:
+        elapsed, rounds, co = run(crypt, args.L, ops, args.clients, window)
+        if base is None:
+            base = rounds
+        print("{:>8} {:>8.3f} {:>8} {:>8} {:>8} {:>10} {:>10}".format(
+            '-' if window is None else window, elapsed, rounds, base - rounds,
+            co['batches'] if co else '-',
+            '{:.4f}'.format(co['mean_wait_seconds']) if co else '-',
+            '{:.4f}'.format(co['max_wait_seconds']) if co else '-'))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="POPE query coalescing benchmark")
+    parser.add_argument('size', nargs='?', type=int, default=20000,
+            help="Number of inserts (default 20000)")
+    parser.add_argument('-c', '--clients', type=int, default=16,
+            help="Number of concurrent query clients (default 16)")
+    parser.add_argument('-W', '--windows', type=float, nargs='+', default=[0, 0.001, 0.005],
+            help="Coalescing windows to try, in seconds (default 0 0.001 0.005)")
+    parser.add_argument('-L', type=int, default=100, help="Oracle size (default 100)")
+    parser.add_argument('-k', '--dist', choices=workload.DISTRIBUTIONS, default='uniform')
+    parser.add_argument('-r', '--ratio', type=float, default=4,
+            help="Average inserts per query (default 4)")
+    parser.add_argument('-w', '--width', type=float, default=0.001,
+            help="Range width as a fraction of the key domain")
+    parser.add_argument('-l', '--lookups', type=float, default=0.5,
+            help="Fraction of queries that are lookups (default 0.5)")
+    parser.add_argument('-s', '--seed', type=int, default=1984)
+    parser.add_argument('-d', '--dumb', action='store_true',
+            help="Use the (insecure, but faster) dummy cipher")
+    args = parser.parse_args()
+
+    main(args)
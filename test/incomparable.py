@@ -12,49 +12,123 @@ import random
 import sys
 import os
 import bisect
+import math
+import salary
 from PIL import Image # requires pil
 
 from ope.opec import create_ope_client
 from ope.ciphers import DumbCipher
 from ope.pope import Pope
 
+class IntervalSet:
+    """A set of integers, stored as sorted, disjoint half-open intervals."""
+
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return zip(self._starts, self._ends)
+
+    def __contains__(self, x):
+        i = bisect.bisect_right(self._starts, x) - 1
+        return i >= 0 and x < self._ends[i]
+
+    def add(self, lo, hi):
+        """Adds every integer in [lo, hi) and returns the list of
+        intervals that were not already there."""
+        i = bisect.bisect_left(self._ends, lo)
+        j = bisect.bisect_right(self._starts, hi)
+        new = []
+        cur = lo
+        for start, end in zip(self._starts[i:j], self._ends[i:j]):
+            if start > cur:
+                new.append((cur, start))
+            cur = max(cur, end)
+        if cur < hi:
+            new.append((cur, hi))
+        if i < j:
+            lo = min(lo, self._starts[i])
+            hi = max(hi, self._ends[j-1])
+        self._starts[i:j] = [lo]
+        self._ends[i:j] = [hi]
+        self._len += sum(end - start for start, end in new)
+        return new
+
+    def neighbors(self, x):
+        """Returns the largest member below x and the smallest one above
+        x, either of which may be None. x itself may be a member."""
+        i = bisect.bisect_right(self._starts, x)
+        below = above = None
+        if i > 0 and self._starts[i-1] < x:
+            below = min(x, self._ends[i-1]) - 1
+        elif i > 1:
+            # x starts its interval, so the one before holds the answer
+            below = self._ends[i-2] - 1
+        if i > 0 and self._ends[i-1] > x + 1:
+            above = x + 1
+        elif i < len(self._starts):
+            above = self._starts[i]
+        return below, above
+
+
 class RevealedKeys:
-    def __init__(self, allkeys):
+    """Tracks which ranks in the sorted order of all keys are revealed,
+    meaning that their order relative to each other is known.
+
+    Revealing one copy of a repeated key reveals every copy of it lying
+    between that one and the copies revealed before. The shade of each
+    column of the experiment's big image is kept up to date as ranks
+    are revealed, so drawing a row costs only one copy.
+    """
+
+    def __init__(self, allkeys, width):
         self.allkeys = allkeys
-        self.keyind = {}
-        for ind, (k, ck) in enumerate(self.allkeys):
-            self.keyind[ck] = ind
-        self.revind = []
+        self.keyind = {ck: ind for ind, (k, ck) in enumerate(allkeys)}
+        self.revealed = IntervalSet()
         self.revkeys = {}
-        self.revck = set()
+        self.width = width
+        # in units of 1/(n*width), rank i covers [i*width, (i+1)*width)
+        # and column c covers [c*n, (c+1)*n)
+        self._cover = [0] * width
+        self.shade = bytearray(b'\xff' * width)
 
     def add(self, ck):
-        if ck in self.revck:
-            return
-        self.revck.add(ck)
         ind = self.keyind[ck]
-        k, ck2 = self.allkeys[ind]
-        assert ck == ck2
+        if ind in self.revealed:
+            return
+        k = self.allkeys[ind][0]
         if k in self.revkeys:
             a, b = self.revkeys[k]
             if ind < a:
-                for other in range(ind+1, a):
-                    self.addind(other)
-                    self.revck.add(self.allkeys[other][1])
                 self.revkeys[k] = ind, b
-            elif ind > b:
-                for other in range(b+1, ind):
-                    self.addind(other)
-                    self.revck.add(self.allkeys[other][1])
+                self._reveal(ind, a)
+            else:
                 self.revkeys[k] = a, ind
+                self._reveal(b+1, ind+1)
         else:
             self.revkeys[k] = (ind, ind)
-        self.addind(ind)
+            self._reveal(ind, ind+1)
 
-    def addind(self, ind):
-        assert ind not in self.revind
-        bisect.insort_left(self.revind, ind)
+    def _reveal(self, lo, hi):
+        n, width = len(self.allkeys), self.width
+        for start, end in self.revealed.add(lo, hi):
+            start, end = start * width, end * width
+            for col in range(start // n, min(width, (end - 1) // n + 1)):
+                self._cover[col] += min(end, (col+1)*n) - max(start, col*n)
+                self.shade[col] = 255 - 255 * self._cover[col] // n
 
+    def watcher(self, crypt):
+        """Returns a callback for Pope.watch() that reveals the keys
+        promoted by the server, decrypting them with crypt."""
+        def promoted(keys):
+            for ct in keys:
+                self.add(crypt.decode(ct))
+        return promoted
 
 
 def convkey(x, left=False, right=False):
@@ -76,51 +150,52 @@ def random_query(allkeys, revealed):
     revealed.add(bc)
     return a, b + 0.01
 
-def update_revealed(popenode, revealed, client, rct):
-    if popenode.height() >= 1:
-        # only look at internal nodes
-        for ct in popenode.sorted:
-            if ct not in rct:
-                rct.add(ct)
-                revealed.add(client._crypt.decode(ct))
-        assert not popenode.buffer
-        for child in popenode.children:
-            update_revealed(child, revealed, client, rct)
-
-def update_bigimage(row, img, allkeys, revealed):
-    """Adds one more row to the image based on what's currently revealed."""
-    rimg = Image.new('L', (len(allkeys), 1), 255)
-    for col in revealed.revind:
-        rimg.putpixel((col,0), 0)
-    rimg = rimg.resize((img.size[0], 1), Image.BILINEAR)
-    img.paste(rimg, (0,row))
-
 def make_sqimage(dim, allkeys, revealed):
-    """Makes a square image to show what's comparable and not."""
+    """Makes a square image to show what's comparable and not.
+
+    Row i (for the i'th smallest key) is white for the keys it is known
+    to be larger than, gray for the ones it is incomparable with, and
+    black for the rest. Each row of the image is drawn at once from
+    those three spans, for the key at the middle of the row.
+    """
     n = len(allkeys)
-    img = Image.new('L', (dim, n), 128)
-    rimg = Image.new('L', (n-1, 1), 0)
-    row = 0
-    prevind = 0
-    for ind in revealed.revind:
-        for col in range(prevind, ind):
-            rimg.putpixel((col,0), 127)
-        rcomp = rimg.resize((dim,1), Image.BILINEAR)
-        while row < ind:
-            img.paste(rcomp, (0,row))
-            row += 1
-        for col in range(prevind, ind):
-            rimg.putpixel((col,0), 255)
-        img.paste(rimg.resize((dim,1), Image.BILINEAR), (0,row))
-        row += 1
-        prevind = ind
-    for col in range(prevind, n-1):
-        rimg.putpixel((col,0), 127)
-    rcomp = rimg.resize((dim,1), Image.BILINEAR)
-    while row < n:
-        img.paste(rcomp, (0,row))
-        row += 1
-    return img.resize((dim,dim), Image.BILINEAR)
+    cols = max(1, n - 1)
+    data = bytearray()
+    for r in range(dim):
+        i = min(n - 1, (2 * r + 1) * n // (2 * dim))
+        if i in revealed.revealed:
+            lo = hi = i
+        else:
+            lo, hi = revealed.revealed.neighbors(i)
+            lo = 0 if lo is None else lo
+            hi = cols if hi is None else hi
+        data += row_spans(dim, cols, ((lo, 255), (hi, 127)), 0)
+    return Image.frombytes('L', (dim, dim), bytes(data))
+
+def row_spans(dim, cols, spans, last):
+    """Draws one row of dim pixels, showing cols columns. spans lists
+    (end, shade) for consecutive spans of columns starting at 0, and
+    the columns after the last span get the shade last. The pixels that
+    straddle the end of a span get the average shade."""
+    bounds = [(end * dim / cols, shade) for end, shade in spans]
+    bounds.append((dim, last))
+    row = bytearray(dim)
+    start = 0
+    for end, shade in bounds:
+        first, stop = math.ceil(start), math.floor(end)
+        if stop > first:
+            row[first:stop] = bytes([shade]) * (stop - first)
+        start = end
+    for end, _ in bounds[:-1]:
+        pix = int(end)
+        if pix < dim:
+            total = 0
+            start = 0
+            for end2, shade in bounds:
+                total += shade * max(0, min(end2, pix+1) - max(start, pix))
+                start = end2
+            row[pix] = min(255, round(total))
+    return row
 
 def main(datafile, num_queries, image_dims, imfile):
     """Creates a POPE instance, inserts everything from the data file,
@@ -135,15 +210,17 @@ def main(datafile, num_queries, image_dims, imfile):
 
     # read data into a list of (key, value) pairs
     data = []
-    with open(datafile) as data_in:
-        for line in data_in:
-            try:
-                name, salstring = line.strip().split(',')
-                salary = float(salstring)
-                data.append((salary, name))
-            except ValueError:
-                print("WARNING: invalid read of line:")
-                print(line.rstrip())
+    if salary.is_dataset(datafile):
+        data = [(x, name) for x, ck, name in salary.load(datafile)[0]]
+    else:
+        with open(datafile) as data_in:
+            for line in data_in:
+                try:
+                    name, salstring = line.strip().split(',')
+                    data.append((float(salstring), name))
+                except ValueError:
+                    print("WARNING: invalid read of line:")
+                    print(line.rstrip())
 
     print("Successfully read {:,} entries from {}".format(len(data), datafile))
 
@@ -161,13 +238,13 @@ def main(datafile, num_queries, image_dims, imfile):
     print("Successfully inserted {:,} entries into POPE".format(len(data)))
 
     # perform random range queries and collect data
-    revealed = RevealedKeys(allkeys)
-    rct = set()
-    img = Image.new('L', (image_dims[0], num_queries[-1]+1), 127)
+    # newly promoted pivots are reported by the server as they happen
+    revealed = RevealedKeys(allkeys, image_dims[0])
+    client._serv.watch(revealed.watcher(client._crypt))
+    # the big image has one row per query, drawn from revealed.shade
+    rows = bytearray(revealed.shade)
     count = 0
 
-    update_bigimage(count, img, allkeys, revealed)
-
     while count < num_queries[-1]:
         print(".", end='')
         sys.stdout.flush()
@@ -176,11 +253,10 @@ def main(datafile, num_queries, image_dims, imfile):
         bkey = client._crypt.encode(convkey(b, right=True))
         client._serv.range_search(akey, bkey)
         count += 1
-        update_revealed(client._serv._root, revealed, client, rct)
-        update_bigimage(count, img, allkeys, revealed)
+        rows += revealed.shade
         if count in num_queries:
             sqim = make_sqimage(min(image_dims), allkeys, revealed)
-            aim = img.crop((0, 0, image_dims[0], count))
+            aim = Image.frombytes('L', (image_dims[0], count), bytes(rows[:image_dims[0]*count]))
             aim = aim.resize(image_dims, Image.NEAREST)
             print("\nGenerated images for count", count)
             if imfile:
@@ -196,12 +272,12 @@ def main(datafile, num_queries, image_dims, imfile):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
             description="Incomparable elements experiment",)
-    parser.add_argument('datafile', help="csv file with name,salary entries")
+    parser.add_argument('datafile', help="csv file with name,salary entries, or a file from salary.py")
     parser.add_argument('queries', nargs='*', type=int, default=[1000],
             help="How many random queries to perform, and when to draw squares (default 1000)")
-    parser.add_argument('--width', '-w', default=1024,
+    parser.add_argument('--width', '-w', type=int, default=1024,
             help="Image width in pixels (default 1024)"),
-    parser.add_argument('--height', '-H', default=768,
+    parser.add_argument('--height', '-H', type=int, default=768,
             help="Image height in pixels (default 768)")
     parser.add_argument('--output', '-o', default=None,
             help="Filename to save the image to (default just display)")
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+Compares oracle rounds and running time of mOPE for different fanouts,
+against POPE with the same oracle storage size L.
+
+Each experiment inserts the same random keys and then performs the
+same random range queries, with everything running locally.
+The mOPE fanout is always equal to L. mOPE is run twice, inserting one
+key at a time and then in batches with Mope.insert_many.
+"""
+
+import argparse
+import random
+import time
+import sys
+
+from ope import ciphers
+from ope.oracle import Oracle
+from ope.mope import Mope
+from ope.pope import Pope
+
+
+def run(algo, crypt, L, inserts, queries, batch=0):
+    """Returns (insert rounds, insert seconds, query rounds, query seconds)
+    for one experiment. If batch is positive, inserts are done with
+    insert_many, batch at a time."""
+    orc = Oracle(crypt, L)
+    serv = algo(orc)
+    res = []
+    if batch > 0:
+        inserts = [inserts[i:i+batch] for i in range(0, len(inserts), batch)]
+    for ops in (inserts, queries):
+        orc.counts(True)
+        elapsed = -time.time()
+        for op in ops:
+            if batch > 0 and ops is inserts:
+                serv.insert_many(op)
+            elif len(op) == 2:
+                serv.insert(*op)
+            else:
+                for _ in serv.range_search(op[0], op[1]):
+                    pass
+        elapsed += time.time()
+        res.extend([orc.counts()[2], elapsed])
+    return res
+
+def main(size, nqueries, fanouts, batch, crypt):
+    keys = ["{:010d}".format(random.randrange(10**10)) for _ in range(size)]
+    inserts = [(crypt.encode(k), crypt.encode(str(i))) for i, k in enumerate(keys)]
+    queries = []
+    for _ in range(nqueries):
+        a, b = sorted(random.sample(keys, 2))
+        queries.append((crypt.encode(a), crypt.encode(b), None))
+
+    print("{:>6} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        'L', 'algo', 'ins rnds', 'ins sec', 'qry rnds', 'qry sec'))
+    for L in fanouts:
+        for algo, b in ((Mope, 0), (Mope, batch), (Pope, 0)):
+            name = algo.__name__ + ("/{}".format(b) if b else "")
+            ir, it, qr, qt = run(algo, crypt, L, inserts, queries, b)
+            print("{:>6} {:>10} {:>10} {:>10.3f} {:>10} {:>10.3f}".format(
+                L, name, ir, it, qr, qt))
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="mOPE fanout benchmark")
+    parser.add_argument('size', nargs='?', type=int, default=10000,
+            help="How many random keys to insert (default 10000)")
+    parser.add_argument('queries', nargs='?', type=int, default=100,
+            help="How many random range queries to perform (default 100)")
+    parser.add_argument('-L', '--fanouts', type=int, nargs='+',
+            default=[4, 16, 64, 256, 1024],
+            help="Oracle sizes (and mOPE fanouts) to try")
+    parser.add_argument('-b', '--batch', type=int, default=100,
+            help="Batch size for mOPE insert_many (default 100)")
+    parser.add_argument('-s','--seed', type=int, default=1984,
+            help="Seed to use for PRNG to make the keys and queries")
+    parser.add_argument('-d','--dumb', action='store_true',
+            help="Use the (insecure, but faster) dummy cipher")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    print("The seed is", args.seed, file=sys.stderr)
+
+    crypt = ciphers.DumbCipher('key') if args.dumb else ciphers.AES()
+    main(args.size, args.queries, args.fanouts, args.batch, crypt)
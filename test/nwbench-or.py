@@ -16,6 +16,7 @@ This version ONLY runs the oracle over the network.
 import argparse
 import random
 import progbar
+import salary
 import time
 import os
 import pickle
@@ -25,6 +26,7 @@ from ope import pope
 from ope import nworacle
 from ope import ciphers
 from ope import opec
+from ope.throttle import ThrottleProxy
 
 
 def convkey(x, left=False, right=False):
@@ -54,28 +56,17 @@ def get_inserts(datafile):
     return data
 
 def get_queries(ins, num, size=100):
-    qtimes = sorted(random.randrange(len(ins)) for _ in range(num))
-    res = {}
-    assert len(ins) >= size
-    for _ in range(num):
-        qtime = random.randrange(len(ins))
-        contents = ins[:qtime+1]
-        contents.sort()
-        startind = random.randrange(len(contents))
-        while startind > 0 and contents[startind-1][0] == contents[startind][0]:
-            startind -= 1
-        endind = min(len(contents) - 1, startind + size - 1)
-        while endind+1 < len(contents) and contents[endind+1][0] == contents[endind][0]:
-            endind += 1
-        start = convkey(contents[startind][0], left=True)
-        end = convkey(contents[endind][0] + 0.00, right=True)
-        out = [(ck, v) for (k,ck,v) in contents[startind:endind+1]]
-        res[qtime] = (start, end, out)
-    return res
+    """Random range queries with their expected results, computed
+    incrementally by the salary module."""
+    return salary.results(ins, salary.make_queries(ins, num, size, random))
 
 def main(datafile, queries, passphrase, orc, qfile):
-    ins = get_inserts(datafile)
-    if qfile:
+    if salary.is_dataset(datafile):
+        ins, quer = salary.load(datafile)
+        quer = salary.results(ins, quer)
+        print("Loaded", len(ins), "inserts and", len(quer), "queries from", datafile, file=sys.stderr)
+    elif qfile:
+        ins = get_inserts(datafile)
         if os.path.exists(qfile):
             with open(qfile, 'rb') as qin:
                 quer = pickle.load(qin)
@@ -86,6 +77,7 @@ def main(datafile, queries, passphrase, orc, qfile):
                 pickle.dump(quer, qout)
             print("Saved queries to", qfile, file=sys.stderr)
     else:
+        ins = get_inserts(datafile)
         quer = get_queries(ins, queries)
 
     crypt = ciphers.AES(passphrase)
@@ -112,16 +104,35 @@ if __name__ == '__main__':
     parser.add_argument('oracle_hostname')
     parser.add_argument('oracle_port', type=int)
     parser.add_argument('passphrase')
-    parser.add_argument('datafile', help="csv file with name,salary entries")
+    parser.add_argument('datafile', help="csv file with name,salary entries, or a file from salary.py")
     parser.add_argument('queries', nargs='?', type=int, default=[1000],
             help="How many random queries to perform (default 1000)")
     parser.add_argument('-s','--seed', type=int, default=1984,
             help="Seed to use for PRNG to make the random queries")
     parser.add_argument('-f','--queryfile', help="file name to load/store queries")
+    parser.add_argument('--rtt', type=float, default=0,
+            help="Emulated round-trip time in ms, through a local proxy")
+    parser.add_argument('--bandwidth', type=float,
+            help="Emulated bandwidth in kbits/sec, through a local proxy")
+    parser.add_argument('--jitter', type=float, default=0,
+            help="Emulated random jitter in ms, through a local proxy")
     args = parser.parse_args()
 
     random.seed(args.seed)
     print("The seed is", args.seed, file=sys.stderr)
 
-    with nworacle.OracleClient(args.oracle_hostname, args.oracle_port) as orc:
-        main(args.datafile, args.queries, args.passphrase, orc, args.queryfile)
+    if args.rtt or args.bandwidth or args.jitter:
+        proxy = ThrottleProxy(args.oracle_hostname, args.oracle_port,
+                              args.rtt, args.bandwidth, args.jitter).start()
+        print("Throttling through", *proxy.address, file=sys.stderr)
+        hostname, port = proxy.address
+    else:
+        proxy = None
+        hostname, port = args.oracle_hostname, args.oracle_port
+
+    try:
+        with nworacle.OracleClient(hostname, port) as orc:
+            main(args.datafile, args.queries, args.passphrase, orc, args.queryfile)
+    finally:
+        if proxy:
+            proxy.stop()
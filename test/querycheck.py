@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+
+"""
+Checks the results of POPE queries against a plain dictionary.
+
+Each check builds a Pope with a local oracle, runs a mix of inserts and
+queries, and asserts that every answer matches what a dictionary of the
+same items gives. Usage: querycheck.py [seed]
+"""
+
+import random
+import sys
+import threading
+import time
+
+import workload
+
+from ope.ciphers import DumbCipher
+from ope import nwopec
+from ope.opec import OpeClient
+from ope.oracle import Oracle
+from ope.pope import Pope
+from ope.replica import Follower, Primary
+from ope import validate
+
+crypt = DumbCipher('enkey')
+
+def check_repeated_leaf():
+    """A leaf split whose random pivots are all copies of the largest key
+    must not take the smaller keys for copies too."""
+    for seed in range(300):
+        random.seed(seed)
+        cl = OpeClient(Pope(Oracle(crypt, 5), validation=validate.INCREMENTAL), crypt)
+        for i in range(5):
+            cl.insert('b', 'b' + str(i))
+        cl.insert('a', 'a0')
+        assert cl.lookup('a') == 'a0', seed
+        assert cl.lookup('b') is not None, seed
+        assert cl.lookup('c') is None, seed
+
+def check_duplicate_lookups(seed):
+    """Lookups on a workload with many repeated keys."""
+    random.seed(seed)
+    for L in (4, 10, 50):
+        serv = Pope(Oracle(crypt, L), validation=validate.INCREMENTAL)
+        values = {}
+        for op in workload.generate(3000, 5, 'dups', 0.01, 0.5, seed):
+            if op[0] == 'insert':
+                serv.insert(crypt.encode(op[1]), op[2])
+                values.setdefault(op[1], set()).add(op[2])
+            elif op[0] == 'lookup':
+                res = serv.lookup(crypt.encode(op[1]))
+                assert res in values[op[1]], (L, op)
+        for key in values:
+            assert serv.lookup(crypt.encode(key)) in values[key], (L, key)
+        assert serv.lookup(crypt.encode('x')) is None
+        serv.check(True)
+
+def in_range(items, key1, key2):
+    return sorted((k, v) for k, v in items if key1 < k <= key2)
+
+def decoded(pairs):
+    return sorted((crypt.decode(k), v) for k, v in pairs)
+
+def check_snapshots(seed):
+    """Snapshot traversals and range scans, read while more inserts go
+    on, against copies of the items as they were."""
+    rand = random.Random(seed)
+    for L in (4, 10, 50):
+        serv = Pope(Oracle(crypt, L), validation=validate.INCREMENTAL)
+        items = []
+        snaps = []
+        scans = []
+        for op in workload.generate(3000, 5, 'dups', 0.05, 0.2, seed):
+            if op[0] == 'insert':
+                serv.insert(crypt.encode(op[1]), op[2])
+                items.append((op[1], op[2]))
+            elif op[0] == 'range':
+                results, snap = serv.range_scan(crypt.encode(op[1]), crypt.encode(op[2]))
+                scans.append((results, snap, in_range(items, op[1], op[2])))
+            if rand.random() < 0.01:
+                snaps.append((serv.snapshot(), list(items)))
+            if scans and rand.random() < 0.1:
+                results, snap, expected = scans.pop(rand.randrange(len(scans)))
+                assert decoded(results) == expected, L
+                snap.release()
+            if snaps and rand.random() < 0.005:
+                snap, copy = snaps.pop(rand.randrange(len(snaps)))
+                assert decoded(snap.traverse()) == sorted(copy), L
+                snap.release()
+        for results, snap, expected in scans:
+            assert decoded(results) == expected, L
+            snap.release()
+        # clearing the tree leaves the pinned snapshots as they were
+        serv.clear()
+        serv.insert(crypt.encode('x'), 'x')
+        for snap, copy in snaps:
+            assert snap.size() == len(copy)
+            assert decoded(snap.traverse()) == sorted(copy), L
+            snap.release()
+        assert serv.snapshot_counts()['versions'] == 0
+        assert decoded(serv.traverse()) == [('x', 'x')]
+
+def check_search_many(seed):
+    """Batches of lookups and range searches, with shared and repeated
+    keys, answered together by search_many."""
+    rand = random.Random(seed)
+    for L in (4, 10, 50):
+        serv = Pope(Oracle(crypt, L), validation=validate.INCREMENTAL)
+        values = {}
+        items = []
+        batch = []
+        for op in workload.generate(3000, 2, 'dups', 0.05, 0.5, seed):
+            if op[0] == 'insert':
+                serv.insert(crypt.encode(op[1]), op[2])
+                values.setdefault(op[1], set()).add(op[2])
+                items.append((op[1], op[2]))
+            elif op[0] == 'lookup':
+                batch.append(('lookup', op[1]))
+            else:
+                batch.append(('range_search', op[1], op[2]))
+            if batch and rand.random() < 0.2:
+                if rand.random() < 0.3:
+                    # the same query twice, and a missing key
+                    batch.append(batch[0])
+                    batch.append(('lookup', 'x'))
+                queries = [(q[0],) + tuple(crypt.encode(k) for k in q[1:]) for q in batch]
+                for query, res in zip(batch, serv.search_many(queries)):
+                    if query[0] == 'lookup':
+                        assert res in values.get(query[1], {None}), (L, query)
+                    else:
+                        assert decoded(res) == in_range(items, *query[1:]), (L, query)
+                batch = []
+        serv.check(True)
+
+def check_paging(seed):
+    """Paged range searches, continued while lookups and inserts go on,
+    against the items as they were when each search started."""
+    rand = random.Random(seed)
+    for L in (4, 10, 50):
+        serv = Pope(Oracle(crypt, L), validation=validate.INCREMENTAL)
+        serv.max_cursors = 20
+        items = []
+        open_cursors = {}
+        expired = []
+        for op in workload.generate(3000, 5, 'dups', 0.05, 0.3, seed):
+            if op[0] == 'insert':
+                serv.insert(crypt.encode(op[1]), op[2])
+                items.append((op[1], op[2]))
+            elif op[0] == 'lookup':
+                serv.lookup(crypt.encode(op[1]))
+            else:
+                page, cursor = serv.range_search(
+                    crypt.encode(op[1]), crypt.encode(op[2]), rand.randrange(1, 20))
+                expected = in_range(items, op[1], op[2])
+                if cursor is None:
+                    assert decoded(page) == expected, L
+                else:
+                    open_cursors[cursor] = (page, expected)
+            for cursor in list(open_cursors):
+                if cursor not in serv._cursors:
+                    expired.append(cursor)
+                    del open_cursors[cursor]
+                elif rand.random() < 0.2:
+                    page, expected = open_cursors.pop(cursor)
+                    more, cursor = serv.range_next(cursor)
+                    page = page + more
+                    if cursor is None:
+                        assert decoded(page) == expected, L
+                    else:
+                        open_cursors[cursor] = (page, expected)
+        assert expired
+        for cursor in expired:
+            try:
+                serv.range_next(cursor)
+            except ValueError:
+                pass
+            else:
+                assert False, "expired cursor still works"
+        assert serv.snapshot_counts()['pinned'] == len(serv._cursors)
+        serv.clear()
+        assert serv.snapshot_counts()['pinned'] == 0
+        assert serv.snapshot_counts()['versions'] == 0
+
+def check_cursor_owners():
+    """Cursors can only be continued by their owner, and end when the
+    owner drops them, when they go unused too long, and when a
+    connection that left them open closes."""
+    serv = Pope(Oracle(crypt, 10))
+    for i in range(200):
+        serv.insert(crypt.encode('{:03d}'.format(i)), crypt.encode(str(i)))
+    low, high = crypt.encode('000'), crypt.encode('100')
+    alice, bob = object(), object()
+    _, cursor = serv.range_search(low, high, 10, owner=alice)
+    try:
+        serv.range_next(cursor, owner=bob)
+    except ValueError:
+        pass
+    else:
+        assert False, "another owner's cursor works"
+    _, cursor = serv.range_next(cursor, owner=alice)
+    serv.drop_cursors(alice)
+    assert cursor not in serv._cursors
+    assert serv.snapshot_counts()['pinned'] == 0
+
+    serv.cursor_ttl = 0
+    _, cursor = serv.range_search(low, high, 10)
+    time.sleep(0.01)
+    serv.insert(crypt.encode('500'), crypt.encode('500'))
+    assert cursor not in serv._cursors
+    assert serv.snapshot_counts()['pinned'] == 0
+
+    server = nwopec.get_pope_server(serv, 'localhost', 0, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    address = server.server_address[:2]
+    with nwopec.NwOpeClient(*address, crypt, clearit=False) as one, \
+         nwopec.NwOpeClient(*address, crypt, clearit=False) as two:
+        serv.cursor_ttl = 300
+        page, cursor = one.range_search('000', '100', 10)
+        assert len(page) == 10
+        try:
+            two.range_next(cursor)
+        except ValueError:
+            pass
+        else:
+            assert False, "another connection's cursor works"
+        # both connections carry on after the bad cursor
+        assert two.size() == 201
+        more, cursor = one.range_next(cursor)
+        assert [k for k, v in page + more] == ['{:03d}'.format(i) for i in range(1, 21)]
+        assert serv.snapshot_counts()['pinned'] == 1
+    for _ in range(100):
+        if serv.snapshot_counts()['pinned'] == 0:
+            break
+        time.sleep(0.01)
+    assert serv.snapshot_counts()['pinned'] == 0
+    server.shutdown()
+    server.server_close()
+
+def check_replication(seed):
+    """A follower applying a primary's log, with many repeated keys,
+    ends up with the same tree without asking its own oracle anything."""
+    for L in (4, 10, 50):
+        prim = Primary(Oracle(crypt, L))
+        for op in workload.generate(3000, 5, 'dups', 0.05, 0.5, seed):
+            if op[0] == 'insert':
+                prim.insert(crypt.encode(op[1]), op[2])
+            elif op[0] == 'lookup':
+                prim.lookup(crypt.encode(op[1]))
+            else:
+                prim.range_search(crypt.encode(op[1]), crypt.encode(op[2]))
+        orc = Oracle(crypt, L)
+        fol = Follower(orc)
+        fol.apply(prim.log.read(0))
+        assert orc.comm_rounds() == 0, (L, orc.comm_rounds())
+        assert decoded(fol.traverse()) == decoded(prim.traverse()), L
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1].startswith('-'):
+        print("Checks query results against a dictionary")
+        print("Usage:", sys.argv[0], "[seed]")
+        exit(1)
+
+    nwopec.DEBUG = False
+    seed = int(sys.argv[1]) if len(sys.argv) >= 2 else random.randrange(100000)
+    print("seed is", seed)
+
+    print("Checking repeated leaves...")
+    check_repeated_leaf()
+    print("Checking lookups with duplicate keys...")
+    check_duplicate_lookups(seed)
+    print("Checking batched queries...")
+    check_search_many(seed)
+    print("Checking paged range searches...")
+    check_paging(seed)
+    check_cursor_owners()
+    print("Checking snapshots...")
+    check_snapshots(seed)
+    print("Checking replication...")
+    check_replication(seed)
+    print("All checks passed!")
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+
+"""
+Plays a write-heavy workload on a POPE primary while reader threads
+send more range queries to its read replicas (see ope/replica.py), and
+prints the ingest rate, the readers' query rate and how far the
+replicas fell behind.
+
+The workload's own queries go to the primary, since the replicas never
+split anything themselves: it is the primary's queries that keep the
+tree in shape for theirs.
+
+The oracle server, the primary and each replica run in child
+processes on localhost. With 0 replicas, the readers query the primary
+itself, for comparison.
+"""
+
+import argparse
+import contextlib
+import sys
+import threading
+import time
+
+import workload
+
+from ope import ciphers
+from ope import nworacle
+from ope import nwopec
+from ope import replica
+from ope.cluster import ProcessComponent, oracle_server, remote_stats
+
+def reader(address, crypt, queries, stop, counts):
+    """Sends the queries to the server at address, round and round,
+    until stop is set, counting them in counts."""
+    with nwopec.NwOpeClient(*address, crypt, clearit=False) as client:
+        while not stop.is_set():
+            for op in queries:
+                if stop.is_set():
+                    break
+                client.range_search(op[1], op[2])
+                counts[0] += 1
+
+def follower_lag(address):
+    return remote_stats(address, nwopec.STATS)['tree']['lag']
+
+def run(crypt, L, replicas, readers, ops, queries, poll):
+    """Plays ops on a primary while readers send the range queries in
+    queries to the replicas, and returns a dictionary of results."""
+    inserts = sum(1 for op in ops if op[0] == 'insert')
+    with contextlib.ExitStack() as stack:
+        orc = ProcessComponent(oracle_server, crypt, L)
+        stack.callback(orc.stop)
+        prim = ProcessComponent(replica.primary_server, orc.address)
+        stack.callback(prim.stop)
+        fols = []
+        for _ in range(replicas):
+            fols.append(ProcessComponent(replica.follower_server, orc.address, prim.address))
+            stack.callback(fols[-1].stop)
+        targets = [fol.address for fol in fols] or [prim.address]
+
+        stop = threading.Event()
+        counts = [[0] for _ in range(readers)]
+        threads = [threading.Thread(target=reader,
+                                    args=(targets[i % len(targets)], crypt,
+                                          queries, stop, counts[i]))
+                   for i in range(readers)]
+        worst = 0.0
+        with nwopec.NwOpeClient(*prim.address, crypt, clearit=False) as writer:
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for i, op in enumerate(ops):
+                if op[0] == 'insert':
+                    writer.insert(op[1], op[2])
+                else:
+                    writer.range_search(op[1], op[2])
+                if fols and i % poll == 0:
+                    worst = max(worst, max(follower_lag(addr)['last_seconds']
+                                           for addr in targets))
+            # inserts get no reply, so wait for the last ones
+            writer.size()
+            ingest = time.perf_counter() - start
+            stop.set()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+            log_end = writer.stats()['tree']['log']
+
+        # wait for the replicas to apply everything
+        catchup = 0.0
+        if fols:
+            begin = time.perf_counter()
+            lags = [follower_lag(addr) for addr in targets]
+            while any(lag['applied'] < log_end for lag in lags):
+                time.sleep(0.01)
+                lags = [follower_lag(addr) for addr in targets]
+            catchup = time.perf_counter() - begin
+            worst = max([worst] + [lag['max_seconds'] for lag in lags])
+
+        return {
+            'ingest': ingest,
+            'inserts': inserts,
+            'queries': sum(c[0] for c in counts),
+            'elapsed': elapsed,
+            'max_lag': worst,
+            'catchup': catchup,
+        }
+
+def main(args):
+    nworacle.DEBUG = nwopec.DEBUG = False
+    crypt = ciphers.DumbCipher('key') if args.dumb else ciphers.AES()
+    ops = workload.generate(args.size, args.ratio, args.dist, args.width,
+                            0.0, args.seed)
+    # the readers' queries, different from the primary's
+    queries = [op for op in workload.generate(args.size, 1, args.dist, args.width,
+                                              0.0, args.seed + 1)
+               if op[0] == 'range']
+    print("{:>8} {:>8} {:>12} {:>12} {:>10} {:>10}".format(
+        'replicas', 'readers', 'inserts/sec', 'queries/sec', 'max lag', 'catch-up'))
+    for count in args.replicas:
+        res = run(crypt, args.L, count, args.readers, ops, queries, args.poll)
+        print("{:>8} {:>8} {:>12.1f} {:>12.1f} {:>10.3f} {:>10.3f}".format(
+            count, args.readers, res['inserts'] / res['ingest'],
+            res['queries'] / res['elapsed'], res['max_lag'], res['catchup']))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="POPE read replica benchmark")
+    parser.add_argument('size', nargs='?', type=int, default=20000,
+            help="Number of inserts (default 20000)")
+    parser.add_argument('-n', '--replicas', type=int, nargs='+', default=[0, 2],
+            help="Numbers of read replicas to try (default 0 2)")
+    parser.add_argument('-t', '--readers', type=int, default=2,
+            help="Number of reader threads (default 2)")
+    parser.add_argument('-L', type=int, default=100, help="Oracle size (default 100)")
+    parser.add_argument('-k', '--dist', choices=workload.DISTRIBUTIONS, default='uniform')
+    parser.add_argument('-r', '--ratio', type=float, default=10,
+            help="Average inserts per query (default 10)")
+    parser.add_argument('-w', '--width', type=float, default=0.001,
+            help="Range width as a fraction of the key domain")
+    parser.add_argument('-p', '--poll', type=int, default=500,
+            help="Check the replicas' lag every this many operations (default 500)")
+    parser.add_argument('-s', '--seed', type=int, default=1984)
+    parser.add_argument('-d', '--dumb', action='store_true',
+            help="Use the (insecure, but faster) dummy cipher")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+Synthetic salary data, as a stand-in for the California salary
+database used by nwbench.py, nwbench-or.py and incomparable.py.
+
+Salaries come from a seeded mixture of full-time, part-time and
+high earners, with many of them rounded so that duplicates are common,
+and names are made from a skewed choice of first and last names.
+The same size and seed always give the same data.
+
+Query ground truth is computed incrementally while replaying the
+inserts into a cheater.SortedChunks index, so building Q queries on n
+inserts costs O(n log n + Q n/load) instead of a sort per query.
+The whole workload can be saved in a compact binary file, which the
+benchmarks accept in place of the CSV file.
+
+    salary.py 100000 -o salary-100k.csv
+    salary.py 100000 -q 1000 -o salary-100k.sal
+"""
+
+import argparse
+import math
+import random
+import struct
+import sys
+import zlib
+
+from ope.cheater import SortedChunks
+
+MAGIC = b'POPESAL1'
+MAX_SALARY = 9999999.99
+
+FIRST = ['JOHN', 'MARIA', 'DAVID', 'JENNIFER', 'MICHAEL', 'LINDA', 'JOSE',
+         'SUSAN', 'ROBERT', 'PATRICIA', 'JAMES', 'ELIZABETH', 'CARLOS',
+         'MARY', 'DANIEL', 'KAREN', 'WILLIAM', 'LISA', 'RICHARD', 'NANCY',
+         'THOMAS', 'ANA', 'KEVIN', 'SANDRA', 'STEVEN', 'LAURA', 'MARK',
+         'ROSA', 'PAUL', 'DEBORAH', 'JUAN', 'KIM', 'BRIAN', 'ANGELA']
+LAST = ['SMITH', 'GARCIA', 'JOHNSON', 'MARTINEZ', 'LOPEZ', 'WILLIAMS',
+        'HERNANDEZ', 'BROWN', 'GONZALEZ', 'JONES', 'RODRIGUEZ', 'MILLER',
+        'NGUYEN', 'DAVIS', 'PEREZ', 'SANCHEZ', 'WILSON', 'RAMIREZ', 'LEE',
+        'ANDERSON', 'TORRES', 'TAYLOR', 'FLORES', 'THOMAS', 'KIM', 'MOORE',
+        'RIVERA', 'CHEN', 'MARTIN', 'WONG', 'JACKSON', 'REYES', 'WHITE']
+
+
+def convkey(x, rand, left=False, right=False):
+    """Turns a numerical salary value into a string preserving comparison,
+    the same way as in nwbench.py, but with the given PRNG."""
+    assert not (left and right)
+    if left:
+        appendix = '0'
+    elif right:
+        appendix = '9'
+    else:
+        appendix = '5'
+    appendix += ''.join(chr(rand.randrange(32,127)) for _ in range(5))
+    return "{:0>10.2f}".format(x) + appendix
+
+
+class SalarySource:
+    """Draws salary-like values and names from a seeded PRNG.
+
+    Two thirds of the salaries are full-time (log-normal around 60,000),
+    most of the rest are part-time (log-normal around 6,000, with a wide
+    spread), and a few are a Pareto tail above 150,000. A quarter are
+    rounded to the dollar hundred and a tenth to the thousand.
+    """
+
+    def __init__(self, rand):
+        self.rand = rand
+        self._fweights = [1 / (i+1) for i in range(len(FIRST))]
+        self._lweights = [1 / (i+1)**0.8 for i in range(len(LAST))]
+
+    def salary(self):
+        rand = self.rand
+        kind = rand.random()
+        if kind < 0.66:
+            x = rand.lognormvariate(math.log(60000), 0.45)
+        elif kind < 0.96:
+            x = rand.lognormvariate(math.log(6000), 1.3)
+        else:
+            x = 150000 * rand.paretovariate(3)
+        kind = rand.random()
+        if kind < 0.25:
+            x = round(x, -2)
+        elif kind < 0.35:
+            x = round(x, -3)
+        return min(MAX_SALARY, max(0.01, round(x, 2)))
+
+    def name(self):
+        rand = self.rand
+        return "{} {}".format(
+            rand.choices(FIRST, self._fweights)[0],
+            rand.choices(LAST, self._lweights)[0])
+
+
+def generate(size, rand):
+    """Returns size inserts (salary, key, name), where key is the salary
+    as a string from convkey()."""
+    source = SalarySource(rand)
+    res = []
+    for _ in range(size):
+        x = source.salary()
+        res.append((x, convkey(x, rand), source.name()))
+    return res
+
+def make_queries(ins, num, size, rand):
+    """Returns random range queries as a dictionary from insert index
+    to (start key, end key, expected results).
+
+    Each query happens right after one of the inserts, and covers the
+    salaries from a random one of those inserted so far through the one
+    size-1 places later in sorted order, always including every copy
+    of the first and last salary, like nwbench.get_queries.
+    Expected results are the indices into ins of the matching inserts.
+    """
+    assert len(ins) >= size
+    qtimes = sorted(set(rand.randrange(len(ins)) for _ in range(num)))
+    index = SortedChunks()
+    res = {}
+    done = 0
+    for qtime in qtimes:
+        for i in range(done, qtime+1):
+            index.insert(ins[i][1], i)
+        done = qtime + 1
+        startind = rand.randrange(len(index))
+        endind = min(len(index) - 1, startind + size - 1)
+        first = ins[index.at(startind)[1]][0]
+        last = ins[index.at(endind)[1]][0]
+        start = convkey(first, rand, left=True)
+        end = convkey(last, rand, right=True)
+        res[qtime] = (start, end, list(index.range(start, end)))
+    return res
+
+def results(ins, quer):
+    """Turns the insert indices in the queries from make_queries() into
+    (key, name) pairs, as expected by nwbench.py."""
+    return {qtime: (start, end, [ins[i][1:] for i in out])
+            for qtime, (start, end, out) in quer.items()}
+
+
+def save(fname, ins, quer):
+    """Writes inserts and queries to a compact, compressed binary file.
+
+    Salaries are stored in cents, keys by their random suffix only, and
+    query results as lists of insert indices.
+    """
+    parts = [struct.pack('<II', len(ins), len(quer))]
+    for x, ck, name in ins:
+        bname = name.encode()
+        parts.append(struct.pack('<Q5sB', round(x * 100), ck[-5:].encode(), len(bname)))
+        parts.append(bname)
+    for qtime in sorted(quer):
+        start, end, out = quer[qtime]
+        parts.append(struct.pack('<I16s16sI', qtime, start.encode(), end.encode(), len(out)))
+        parts.append(struct.pack('<{}I'.format(len(out)), *out))
+    with open(fname, 'wb') as fout:
+        fout.write(MAGIC)
+        fout.write(zlib.compress(b''.join(parts), 9))
+
+def is_dataset(fname):
+    """Whether fname is a file written by save()."""
+    with open(fname, 'rb') as fin:
+        return fin.read(len(MAGIC)) == MAGIC
+
+def load(fname):
+    """Reads back the inserts and queries from save()."""
+    with open(fname, 'rb') as fin:
+        assert fin.read(len(MAGIC)) == MAGIC
+        data = zlib.decompress(fin.read())
+    nins, nquer = struct.unpack_from('<II', data)
+    pos = struct.calcsize('<II')
+    ins = []
+    for _ in range(nins):
+        cents, suffix, namelen = struct.unpack_from('<Q5sB', data, pos)
+        pos += struct.calcsize('<Q5sB')
+        name = data[pos:pos+namelen].decode()
+        pos += namelen
+        x = cents / 100
+        ins.append((x, "{:0>10.2f}5{}".format(x, suffix.decode()), name))
+    quer = {}
+    for _ in range(nquer):
+        qtime, start, end, nout = struct.unpack_from('<I16s16sI', data, pos)
+        pos += struct.calcsize('<I16s16sI')
+        out = list(struct.unpack_from('<{}I'.format(nout), data, pos))
+        pos += 4 * nout
+        quer[qtime] = (start.decode(), end.decode(), out)
+    return ins, quer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate synthetic salary data")
+    parser.add_argument('size', type=int, help="How many entries")
+    parser.add_argument('-q', '--queries', type=int, default=0,
+            help="How many random queries to precompute (binary output only)")
+    parser.add_argument('-r', '--rsize', type=int, default=100,
+            help="Number of results in each query (default 100)")
+    parser.add_argument('-s', '--seed', type=int, default=1984)
+    parser.add_argument('-o', '--output', required=True,
+            help="Output file, as CSV if it ends in .csv and binary otherwise")
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    ins = generate(args.size, rand)
+    if args.output.endswith('.csv'):
+        with open(args.output, 'w') as fout:
+            for x, ck, name in ins:
+                print("{},{:.2f}".format(name, x), file=fout)
+    else:
+        save(args.output, ins, make_queries(ins, args.queries, args.rsize, rand))
+    print("Wrote", args.size, "entries to", args.output, file=sys.stderr)
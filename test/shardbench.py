@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+
+"""
+Runs one synthetic workload through a ShardedClient (see ope/shard.py)
+with different numbers of shards, and prints the time, the oracle
+rounds and the items returned for each.
+
+With -m net, every shard is a POPE server with its own oracle server,
+each in a child process (one cluster.Cluster per shard), so the shards
+really run in parallel. With -m local, the shards are stand-ins in this
+process, which checks the coordinator but cannot go any faster.
+"""
+
+import argparse
+import contextlib
+import sys
+import time
+
+import workload
+
+from ope import ciphers
+from ope import nworacle
+from ope import nwopec
+from ope import shard
+from ope.cluster import Cluster
+
+def run(shards, policy, ops):
+    """Plays ops on the shards, and returns (seconds, items returned, stats)."""
+    returned = 0
+    with shard.ShardedClient(shards, policy) as client:
+        start = time.perf_counter()
+        for op in ops:
+            if op[0] == 'insert':
+                client.insert(op[1], op[2])
+            elif op[0] == 'lookup':
+                client.lookup(op[1])
+            else:
+                returned += sum(1 for _ in client.range_iter(op[1], op[2]))
+        # inserts get no reply, so wait for the last ones
+        client.size()
+        elapsed = time.perf_counter() - start
+        return elapsed, returned, client.stats()
+
+def main(args):
+    nworacle.DEBUG = nwopec.DEBUG = False
+    crypt = ciphers.DumbCipher('key') if args.dumb else ciphers.AES()
+    ops = workload.generate(args.size, args.ratio, args.dist, args.width,
+                            args.lookups, args.seed)
+    print("{:>6} {:>6} {:>10} {:>10} {:>8} {:>9}".format(
+        'shards', 'mode', 'seconds', 'ops/sec', 'rounds', 'returned'))
+    for count in args.shards:
+        with contextlib.ExitStack() as stack:
+            if args.mode == 'net':
+                clusters = [stack.enter_context(Cluster(crypt, args.L, processes=True))
+                            for _ in range(count)]
+                shards = [clu.clients[0] for clu in clusters]
+            else:
+                shards = shard.local_shards(count, crypt, args.L)
+            elapsed, returned, stats = run(shards, args.policy, ops)
+        print("{:>6} {:>6} {:>10.3f} {:>10.1f} {:>8} {:>9}".format(
+            count, args.mode, elapsed, len(ops) / elapsed,
+            stats['total']['rounds'], returned))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sharded POPE benchmark")
+    parser.add_argument('size', nargs='?', type=int, default=20000,
+            help="Number of inserts (default 20000)")
+    parser.add_argument('-n', '--shards', type=int, nargs='+', default=[1, 2, 4],
+            help="Numbers of shards to try (default 1 2 4)")
+    parser.add_argument('-m', '--mode', choices=('local', 'net'), default='net')
+    parser.add_argument('-p', '--policy', choices=sorted(shard.POLICIES),
+            default='round_robin')
+    parser.add_argument('-L', type=int, default=100, help="Oracle size (default 100)")
+    parser.add_argument('-k', '--dist', choices=workload.DISTRIBUTIONS, default='uniform')
+    parser.add_argument('-r', '--ratio', type=float, default=10,
+            help="Average inserts per query (default 10)")
+    parser.add_argument('-w', '--width', type=float, default=0.001,
+            help="Range width as a fraction of the key domain")
+    parser.add_argument('-l', '--lookups', type=float, default=0.0,
+            help="Fraction of queries that are lookups")
+    parser.add_argument('-s', '--seed', type=int, default=1984)
+    parser.add_argument('-d', '--dumb', action='store_true',
+            help="Use the (insecure, but faster) dummy cipher")
+    args = parser.parse_args()
+
+    main(args)
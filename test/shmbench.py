@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+Compares the TCP oracle transport (nworacle) against the shared memory
+one (shmoracle), with the oracle server in a separate process on the
+same host, for several oracle sizes L.
+
+For each L and each transport, a fresh oracle server is forked, a POPE
+instance in this process runs the same synthetic workload through it,
+and the wall time, oracle rounds, time per round and bytes moved are
+printed.
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+import workload
+
+from ope import ciphers
+from ope import nworacle
+from ope import shmoracle
+from ope.oracle import Oracle
+from ope.pope import Pope
+
+TRANSPORTS = ('tcp', 'shm')
+
+def serve(transport, crypt, L, conn):
+    """Runs in the child process: serves one oracle until killed."""
+    nworacle.DEBUG = False
+    orc = Oracle(crypt, L)
+    if transport == 'tcp':
+        serv = nworacle.get_oracle_server(orc, 'localhost', 0)
+        conn.send(serv.server_address[:2])
+    else:
+        path = os.path.join(tempfile.mkdtemp(), 'oracle.sock')
+        serv = shmoracle.get_shm_oracle_server(orc, path)
+        conn.send((path,))
+    try:
+        serv.serve_forever()
+    finally:
+        serv.server_close()
+
+def run(transport, crypt, L, ops, seed):
+    """Returns (seconds, rounds, bytes) for the workload over one transport."""
+    ctx = multiprocessing.get_context('fork')
+    parent, child = ctx.Pipe()
+    proc = ctx.Process(target=serve, args=(transport, crypt, L, child), daemon=True)
+    proc.start()
+    address = parent.recv()
+    client = (nworacle.OracleClient if transport == 'tcp'
+              else shmoracle.ShmOracleClient)(*address)
+    try:
+        with client:
+            random.seed(seed)
+            serv = Pope(client)
+            start = time.perf_counter()
+            for op in ops:
+                if op[0] == 'insert':
+                    serv.insert(crypt.encode(op[1]), crypt.encode(op[2]))
+                elif op[0] == 'lookup':
+                    serv.lookup(crypt.encode(op[1]))
+                else:
+                    serv.range_search(crypt.encode(op[1]), crypt.encode(op[2]))
+            elapsed = time.perf_counter() - start
+            rounds = client.stats()['oracle']['rounds']
+            comm = client.comm_stats()
+    finally:
+        proc.terminate()
+        proc.join()
+    return elapsed, rounds, comm['sent'] + comm['received']
+
+def main(args):
+    crypt = ciphers.DumbCipher('key') if args.dumb else ciphers.AES()
+    ops = workload.generate(args.size, args.ratio, args.dist, seed=args.seed)
+    print("{:>6} {:>5} {:>10} {:>8} {:>12} {:>12}".format(
+        'L', 'trans', 'seconds', 'rounds', 'ms/round', 'bytes'))
+    for L in args.L:
+        for transport in args.transports:
+            elapsed, rounds, nbytes = run(transport, crypt, L, ops, args.seed)
+            print("{:>6} {:>5} {:>10.3f} {:>8} {:>12.3f} {:>12}".format(
+                L, transport, elapsed, rounds,
+                1000 * elapsed / rounds if rounds else 0, nbytes))
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="TCP versus shared memory oracle transport")
+    parser.add_argument('size', nargs='?', type=int, default=20000,
+            help="Number of inserts (default 20000)")
+    parser.add_argument('-L', type=int, nargs='+', default=[100, 1000, 10000],
+            help="Oracle sizes (default 100 1000 10000)")
+    parser.add_argument('-t', '--transports', nargs='+', choices=TRANSPORTS,
+            default=list(TRANSPORTS))
+    parser.add_argument('-r', '--ratio', type=float, default=10,
+            help="Average inserts per query (default 10)")
+    parser.add_argument('-k', '--dist', choices=workload.DISTRIBUTIONS, default='uniform')
+    parser.add_argument('-s', '--seed', type=int, default=1984)
+    parser.add_argument('-d', '--dumb', action='store_true',
+            help="Use the (insecure, but faster) dummy cipher")
+    args = parser.parse_args()
+
+    main(args)
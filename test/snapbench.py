@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+
+"""
+Measures what copy-on-write snapshots (see Pope.snapshot) cost the
+writers: plays one synthetic workload on a local Pope with no
+snapshots, then with a snapshot pinned every so many operations and
+held for a while, like long-running scans would, and prints the insert
+throughput, the slowdown, and the node versions copied and kept.
+Each setting is timed several times and the fastest run is used, since
+single runs vary by more than the overhead being measured.
+"""
+
+import argparse
+import collections
+import gc
+import sys
+import time
+
+import workload
+
+from ope import ciphers
+from ope import oracle
+from ope import pope
+
+def run(crypt, L, ops, every, hold):
+    """Plays ops, pinning a snapshot every so many operations (never if
+    every is 0) and releasing each one hold operations later. Returns
+    (seconds, largest number of versions kept, counts)."""
+    serv = pope.Pope(oracle.Oracle(crypt, L))
+    pinned = collections.deque()
+    gc.collect()
+    most = 0
+    start = time.perf_counter()
+    for i, op in enumerate(ops):
+        if op[0] == 'insert':
+            serv.insert(op[1], op[2])
+        elif op[0] == 'lookup':
+            serv.lookup(op[1])
+        else:
+            serv.range_search(op[1], op[2])
+        if every and i % every == 0:
+            pinned.append((i + hold, serv.snapshot()))
+        if pinned and pinned[0][0] <= i:
+            most = max(most, serv.snapshot_counts()['versions'])
+            while pinned and pinned[0][0] <= i:
+                pinned.popleft()[1].release()
+    elapsed = time.perf_counter() - start
+    while pinned:
+        pinned.popleft()[1].release()
+    return elapsed, most, serv.snapshot_counts()
+
+def main(args):
+    crypt = ciphers.DumbCipher('key') if args.dumb else ciphers.AES()
+    ops = [(op[0],) + tuple(crypt.encode(x) for x in op[1:]) if op[0] != 'insert'
+           else (op[0], crypt.encode(op[1]), op[2])
+           for op in workload.generate(args.size, args.ratio, args.dist, args.width,
+                                       args.lookups, args.seed)]
+    inserts = sum(1 for op in ops if op[0] == 'insert')
+    print("{:>8} {:>8} {:>12} {:>9} {:>8} {:>8}".format(
+        'every', 'hold', 'inserts/sec', 'overhead', 'copied', 'kept'))
+    base = None
+    for every in [0] + args.every:
+        elapsed, most, counts = min(run(crypt, args.L, ops, every, args.hold)
+                                    for _ in range(args.repeat))
+        if base is None:
+            base = elapsed
+        print("{:>8} {:>8} {:>12.1f} {:>8.1f}% {:>8} {:>8}".format(
+            every or '-', args.hold if every else '-', inserts / elapsed,
+            100 * (elapsed - base) / base, counts['copied'], most))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="POPE snapshot overhead benchmark")
+    parser.add_argument('size', nargs='?', type=int, default=50000,
+            help="Number of inserts (default 50000)")
+    parser.add_argument('-e', '--every', type=int, nargs='+', default=[1000, 100, 10],
+            help="Pin a snapshot every this many operations (default 1000 100 10)")
+    parser.add_argument('-H', '--hold', type=int, default=500,
+            help="Operations each snapshot stays pinned (default 500)")
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+            help="Runs of each setting to take the fastest of (default 3)")
+    parser.add_argument('-L', type=int, default=100, help="Oracle size (default 100)")
+    parser.add_argument('-k', '--dist', choices=workload.DISTRIBUTIONS, default='uniform')
+    parser.add_argument('-r', '--ratio', type=float, default=10,
+            help="Average inserts per query (default 10)")
+    parser.add_argument('-w', '--width', type=float, default=0.001,
+            help="Range width as a fraction of the key domain")
+    parser.add_argument('-l', '--lookups', type=float, default=0.0,
+            help="Fraction of queries that are lookups")
+    parser.add_argument('-s', '--seed', type=int, default=1984)
+    parser.add_argument('-d', '--dumb', action='store_true',
+            help="Use the (insecure, but faster) dummy cipher")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+##################################################################
+# This file is part of the POPE implementation.                  #
+# Paper at https://eprint.iacr.org/2015/1106                     #
+# U.S. Government work product, in the public domain.            #
+# Written in 2015 by Daniel S. Roche, roche@usna.edu             #
+##################################################################
+
+"""
+Synthetic workloads for the OPE benchmarks.
+
+A workload is a list of operations, each one of
+    ('insert', key, value)
+    ('lookup', key)
+    ('range', key1, key2)
+where keys and values are plaintext strings. The same parameters and
+seed always give the same list, without any external data files.
+"""
+
+import argparse
+import bisect
+import itertools
+import random
+
+DOMAIN = 10**9
+DISTRIBUTIONS = ('uniform', 'zipf', 'dups', 'sorted')
+
+def fmtkey(x):
+    """Turns a number in the key domain into a string preserving order."""
+    return "{:010d}".format(x)
+
+
+class KeySource:
+    """Draws numbers in range(DOMAIN) from one of the distributions:
+
+    uniform: independent and uniform.
+    zipf: from a fixed set of distinct keys, where the i'th most popular
+          one is drawn with probability proportional to 1/i**skew.
+    dups: uniform among only a few distinct keys, so almost every
+          insert is a duplicate.
+    sorted: increasing, with uniform random gaps.
+    """
+
+    def __init__(self, dist, size, rand, skew=1.1, distinct=None):
+        assert dist in DISTRIBUTIONS
+        self.dist = dist
+        self.rand = rand
+        if dist == 'zipf':
+            distinct = distinct or max(1, size)
+            self.keys = rand.sample(range(DOMAIN), distinct)
+            self.cdf = list(itertools.accumulate(
+                1 / (i+1)**skew for i in range(distinct)))
+        elif dist == 'dups':
+            distinct = distinct or max(1, int(size**.5) // 4)
+            self.keys = rand.sample(range(DOMAIN), distinct)
+        elif dist == 'sorted':
+            self.gap = max(1, DOMAIN // (2 * max(1, size)))
+            self.last = 0
+
+    def next(self):
+        if self.dist == 'uniform':
+            return self.rand.randrange(DOMAIN)
+        elif self.dist == 'zipf':
+            r = self.rand.random() * self.cdf[-1]
+            return self.keys[min(bisect.bisect_left(self.cdf, r), len(self.keys)-1)]
+        elif self.dist == 'dups':
+            return self.rand.choice(self.keys)
+        else:
+            self.last = min(DOMAIN-1, self.last + self.rand.randrange(1, 2*self.gap))
+            return self.last
+
+
+def generate(size, ratio=10, dist='uniform', width=0.001, lookups=0.0,
+             seed=1984, skew=1.1, distinct=None):
+    """Returns a workload with size inserts.
+
+    ratio is the average number of inserts per query, and a query is a
+    lookup with probability lookups and a range search otherwise.
+    width is the width of each range as a fraction of the key domain.
+    Query keys are drawn from the keys inserted so far.
+    """
+    rand = random.Random(seed)
+    source = KeySource(dist, size, rand, skew, distinct)
+    span = max(1, int(width * DOMAIN))
+    ops = []
+    inserted = []
+    for i in range(size):
+        x = source.next()
+        inserted.append(x)
+        ops.append(('insert', fmtkey(x), str(i)))
+        if ratio > 0 and rand.random() * ratio < 1:
+            y = rand.choice(inserted)
+            if rand.random() < lookups:
+                ops.append(('lookup', fmtkey(y)))
+            else:
+                start = max(0, y - rand.randrange(span))
+                ops.append(('range', fmtkey(start), fmtkey(min(DOMAIN-1, start + span))))
+    return ops
+
+def counts(ops):
+    """Returns a dictionary with the number of operations of each kind."""
+    res = {'insert': 0, 'lookup': 0, 'range': 0}
+    for op in ops:
+        res[op[0]] += 1
+    return res
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Print a synthetic OPE workload")
+    parser.add_argument('size', type=int, help="How many inserts")
+    parser.add_argument('-r', '--ratio', type=float, default=10,
+            help="Average inserts per query (default 10)")
+    parser.add_argument('-d', '--dist', choices=DISTRIBUTIONS, default='uniform')
+    parser.add_argument('-w', '--width', type=float, default=0.001,
+            help="Range width as a fraction of the key domain")
+    parser.add_argument('-l', '--lookups', type=float, default=0.0,
+            help="Fraction of queries that are lookups")
+    parser.add_argument('-s', '--seed', type=int, default=1984)
+    args = parser.parse_args()
+
+    for op in generate(args.size, args.ratio, args.dist, args.width,
+                       args.lookups, args.seed):
+        print(*op)